@@ -0,0 +1,269 @@
+# Embedding providers for reg_retrieval.
+# - OpenAIEmbeddings: the embeddings API, on an OpenAI and/or AsyncOpenAI client
+# - LocalHashEmbeddings: deterministic hashed word / word-pair / character-trigram features
+#   with a sparse random projection; NumPy only, no network or key
+# - FixtureEmbeddings: vectors recorded from another provider, replayed by text hash
+#   (record once with a key, then build and benchmark offline / in CI)
+#
+# A provider's `model` is stored in the index, so vectors from different providers are
+# never mixed: switching provider re-embeds, and a query embedded by another provider
+# than the index is not used for dense search.
+#
+# EMBED_DIMENSIONS shortens text-embedding-3 vectors (the API's `dimensions` parameter,
+# e.g. 256 or 512 instead of 1536); the model id becomes "<model>@<dims>". These models
+# are trained so a prefix of the full vector, renormalized, is the shorter embedding, so
+# an index built at full size is shrunk in place instead of re-embedded.
+#
+# EMBED_PROVIDER picks the provider: "openai" (default; needs a client), "local", or
+# "fixture" (EMBED_FIXTURE_PATH; misses are recorded through the OpenAI client if there
+# is one, otherwise they fail).
+
+import os, json, hashlib, inspect, logging, re, threading, asyncio
+from collections import Counter
+from typing import List, Optional, Any
+import numpy as np
+import openai
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+EMBED_PROVIDER = os.getenv("EMBED_PROVIDER", "openai")
+EMBED_FIXTURE_PATH = os.getenv(
+    "EMBED_FIXTURE_PATH", os.path.join(os.path.dirname(__file__), "embedding_fixture.jsonl")
+)
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "0")) or None  # None = the model's native size
+LOCAL_EMBED_DIM = int(os.getenv("LOCAL_EMBED_DIM", "384"))
+
+log = logging.getLogger("uvicorn")
+
+def read_jsonl(path: str):
+    """Rows of a JSONL file, skipping lines torn by a crash mid-write (anywhere in the file:
+    appends after a torn line keep going)."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def append_jsonl(path: str):
+    """`path` opened for appending, positioned at the start of a line: a torn last line
+    gets its newline, so the next row isn't glued onto it."""
+    torn = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    f = open(path, "a", encoding="utf-8")
+    if torn:
+        f.write("\n")
+    return f
+
+def model_id(model: str, dimensions: Optional[int] = None) -> str:
+    return f"{model}@{dimensions}" if dimensions else model
+
+def split_model_id(mid: str) -> tuple:
+    """("text-embedding-3-small", 512) for "text-embedding-3-small@512"; dims None if native."""
+    base, _, dims = mid.partition("@")
+    return base, (int(dims) if dims.isdigit() else None)
+
+def truncation_dim(old_model: str, old_dim: int, new_model: str) -> Optional[int]:
+    """The prefix length that turns vectors of `old_model` (old_dim wide) into `new_model`
+    vectors, or None if they must be re-embedded."""
+    old_base, _ = split_model_id(old_model)
+    new_base, new_dims = split_model_id(new_model)
+    if old_base != new_base or not old_base.startswith("text-embedding-3"):
+        return None
+    return new_dims if new_dims is not None and new_dims < old_dim else None
+
+class EmbeddingProvider:
+    """Turns texts into an (n, dim) float32 matrix (rows not necessarily normalized)."""
+
+    model: str = ""
+    retryable: tuple = ()  # exception types worth retrying with backoff
+
+    def embed(self, texts: List[str]) -> tuple:
+        """(vectors, prompt tokens or None)."""
+        raise NotImplementedError
+
+    async def embed_async(self, texts: List[str]) -> tuple:
+        return await asyncio.to_thread(self.embed, texts)
+
+    def with_timeout(self, seconds: float) -> "EmbeddingProvider":
+        """A copy that gives up after `seconds` without retrying (query-time use)."""
+        return self
+
+class OpenAIEmbeddings(EmbeddingProvider):
+    retryable = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+    def __init__(self, client: Any = None, async_client: Any = None, model: str = EMBED_MODEL,
+                 dimensions: Optional[int] = EMBED_DIMENSIONS):
+        self.client = client
+        self.async_client = async_client
+        self.api_model = model
+        self.dimensions = dimensions
+        self.model = model_id(model, dimensions)
+
+    def _params(self, texts: List[str]) -> dict:
+        params = {"model": self.api_model, "input": texts}
+        if self.dimensions:
+            params["dimensions"] = self.dimensions
+        return params
+
+    def embed(self, texts: List[str]) -> tuple:
+        res = self.client.embeddings.create(**self._params(texts))
+        usage = getattr(res, "usage", None)
+        # OpenAI returns 'data' items in order
+        return (np.asarray([d.embedding for d in res.data], dtype=np.float32),
+                getattr(usage, "prompt_tokens", None))
+
+    async def embed_async(self, texts: List[str]) -> tuple:
+        if self.async_client is None:
+            return await super().embed_async(texts)
+        res = await self.async_client.embeddings.create(**self._params(texts))
+        usage = getattr(res, "usage", None)
+        return (np.asarray([d.embedding for d in res.data], dtype=np.float32),
+                getattr(usage, "prompt_tokens", None))
+
+    def with_timeout(self, seconds: float) -> "OpenAIEmbeddings":
+        def limited(c):
+            return c.with_options(timeout=seconds, max_retries=0) if hasattr(c, "with_options") else c
+        return OpenAIEmbeddings(limited(self.client) if self.client is not None else None,
+                                limited(self.async_client) if self.async_client is not None else None,
+                                self.api_model, self.dimensions)
+
+_LOCAL_WORD_RE = re.compile(r"[a-z0-9]+")
+
+class LocalHashEmbeddings(EmbeddingProvider):
+    """Feature hashing + sparse random projection (each feature adds +-weight at
+    `probes` pseudo-random coordinates), with sublinear term frequency. Deterministic
+    across processes and machines: hashes are blake2b, never Python's salted hash()."""
+
+    def __init__(self, dim: int = LOCAL_EMBED_DIM, probes: int = 3):
+        self.dim = dim
+        self.probes = probes
+        self.model = f"local-hash-v1-d{dim}"
+
+    def _features(self, text: str) -> Counter:
+        words = _LOCAL_WORD_RE.findall(text.lower())
+        feats: Counter = Counter()
+        for w in words:
+            feats["w:" + w] += 1.0
+            padded = f"<{w}>"
+            for i in range(len(padded) - 2):
+                feats["c:" + padded[i : i + 3]] += 0.25
+        for a, b in zip(words, words[1:]):
+            feats[f"b:{a} {b}"] += 0.5
+        return feats
+
+    def _vector(self, text: str) -> np.ndarray:
+        feats = self._features(text)
+        vec = np.zeros(self.dim, dtype=np.float32)
+        if not feats:
+            return vec
+        pos = np.empty(len(feats) * self.probes, dtype=np.int64)
+        val = np.empty(len(feats) * self.probes, dtype=np.float32)
+        for j, (feat, tf) in enumerate(feats.items()):
+            digest = hashlib.blake2b(feat.encode("utf-8"), digest_size=4 * self.probes).digest()
+            weight = 1.0 + np.log(tf) if tf >= 1 else tf
+            for p in range(self.probes):
+                h = int.from_bytes(digest[4 * p : 4 * p + 4], "little")
+                pos[j * self.probes + p] = (h >> 1) % self.dim
+                val[j * self.probes + p] = weight if h & 1 else -weight
+        np.add.at(vec, pos, val)
+        return vec
+
+    def embed(self, texts: List[str]) -> tuple:
+        vecs = np.stack([self._vector(t) for t in texts]) if texts else np.zeros((0, self.dim), np.float32)
+        return vecs, None
+
+class FixtureEmbeddings(EmbeddingProvider):
+    """Replays vectors recorded in a JSONL file of {"sha", "model", "embedding"} rows
+    (the build checkpoint format). With `record`, misses are embedded by it and appended."""
+
+    def __init__(self, path: str, record: Optional[EmbeddingProvider] = None):
+        self.path = path
+        self.record = record
+        self.vectors: dict = {}
+        self.model = record.model if record is not None else ""
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            for row in read_jsonl(path):
+                if self.model and row.get("model") != self.model:
+                    continue
+                self.model = self.model or row.get("model", "")
+                self.vectors[row["sha"]] = row["embedding"]
+        if not self.model:
+            raise ValueError(f"embedding fixture {path!r} is empty and there is nothing to record from")
+        self.retryable = record.retryable if record is not None else ()
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _missing(self, texts: List[str]) -> tuple:
+        keys = [self._key(t) for t in texts]
+        missing = [i for i, k in enumerate(keys) if k not in self.vectors]
+        if missing and self.record is None:
+            raise KeyError(f"{len(missing)} of {len(texts)} texts are not in embedding fixture {self.path}")
+        return keys, missing
+
+    def _store(self, keys: List[str], missing: List[int], vecs: np.ndarray) -> None:
+        with self._lock, append_jsonl(self.path) as f:
+            for i, v in zip(missing, vecs):
+                self.vectors[keys[i]] = v.tolist()
+                f.write(json.dumps({"sha": keys[i], "model": self.model, "embedding": v.tolist()}) + "\n")
+
+    def _result(self, keys: List[str], tokens: Optional[int]) -> tuple:
+        return np.asarray([self.vectors[k] for k in keys], dtype=np.float32).reshape(len(keys), -1), tokens
+
+    def embed(self, texts: List[str]) -> tuple:
+        keys, missing = self._missing(texts)
+        tokens = None
+        if missing:
+            vecs, tokens = self.record.embed([texts[i] for i in missing])
+            self._store(keys, missing, vecs)
+        return self._result(keys, tokens)
+
+    async def embed_async(self, texts: List[str]) -> tuple:
+        keys, missing = self._missing(texts)
+        tokens = None
+        if missing:
+            vecs, tokens = await self.record.embed_async([texts[i] for i in missing])
+            await asyncio.to_thread(self._store, keys, missing, vecs)
+        return self._result(keys, tokens)
+
+    def with_timeout(self, seconds: float) -> "FixtureEmbeddings":
+        if self.record is None:
+            return self
+        limited = FixtureEmbeddings.__new__(FixtureEmbeddings)
+        limited.__dict__.update(self.__dict__)
+        limited.record = self.record.with_timeout(seconds)
+        return limited
+
+_FIXTURES: dict = {}
+_FIXTURES_LOCK = threading.Lock()
+
+def as_provider(client: Any, provider: Optional[str] = None) -> Optional[EmbeddingProvider]:
+    """The configured EmbeddingProvider for `client` (an OpenAI / AsyncOpenAI client, a
+    provider, or None). None when the OpenAI provider is configured and there's no client."""
+    if isinstance(client, EmbeddingProvider):
+        return client
+    provider = provider or EMBED_PROVIDER
+    if provider == "local":
+        return LocalHashEmbeddings()
+    remote = None
+    if client is not None:
+        is_async = inspect.iscoroutinefunction(getattr(getattr(client, "embeddings", None), "create", None))
+        remote = OpenAIEmbeddings(async_client=client) if is_async else OpenAIEmbeddings(client)
+    if provider == "fixture":
+        with _FIXTURES_LOCK:
+            fixture = _FIXTURES.get(EMBED_FIXTURE_PATH)
+            if fixture is None or (remote is not None and fixture.record is None):
+                fixture = _FIXTURES[EMBED_FIXTURE_PATH] = FixtureEmbeddings(EMBED_FIXTURE_PATH, remote)
+            elif remote is not None and isinstance(fixture.record, OpenAIEmbeddings):
+                # the same fixture serves sync and async callers; remember both clients
+                fixture.record.client = fixture.record.client or remote.client
+                fixture.record.async_client = fixture.record.async_client or remote.async_client
+        return fixture
+    if provider != "openai":
+        raise ValueError(f"unknown EMBED_PROVIDER {provider!r}")
+    return remote
@@ -9,6 +9,8 @@ import os
 import logging
 import re
 
+from llm_gateway import chat_model, complete_async, get_async_client
+
 router = APIRouter()
 log = logging.getLogger("uvicorn")
 
@@ -576,13 +578,8 @@ async def documentation_helper(data: DocumentationHelperRequest, request: Reques
     if DEMO_MODE:
         return _demo_documentation_helper(data.message, context)
 
-    # Try to get OpenAI client
-    try:
-        from main import get_openai_client, OPENAI_MODEL
-        client = get_openai_client()
-    except ImportError:
-        return _demo_documentation_helper(data.message, context)
-
+    # Shared AsyncOpenAI client: the call below awaits instead of blocking the event loop
+    client = get_async_client()
     if client is None:
         return _demo_documentation_helper(data.message, context)
 
@@ -609,16 +606,12 @@ async def documentation_helper(data: DocumentationHelperRequest, request: Reques
     )
 
     try:
-        rsp = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": data.message}
-            ],
-            response_format={"type": "json_object"}
-        )
+        rsp = await complete_async([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": data.message}
+        ], chat_model(), client=client, response_format={"type": "json_object"})
 
-        result = json.loads(rsp.choices[0].message.content)
+        result = json.loads(rsp.content)
         return result
 
     except Exception as e:
@@ -0,0 +1,306 @@
+# One place for chat-completion calls, and for the retry policy of every OpenAI call.
+# - Owns the OpenAI / AsyncOpenAI clients: one of each per process, on httpx pools with
+#   tuned connection limits and keep-alive, so concurrent requests reuse connections
+# - RetryPolicy: retries 429 / 5xx / connection errors with full-jitter exponential
+#   backoff, honouring Retry-After, within a per-call deadline (each attempt gets the time
+#   left, capped at LLM_TIMEOUT); the SDK's own retries are off so attempts aren't
+#   multiplied. CHAT_RETRY covers completions, EMBED_RETRY index-build embedding batches
+#   (reg_retrieval), sync and async alike
+# - A chat completion that timed out is not retried: the generation may still be running
+#   (and billed) server-side, and a second attempt would be as slow
+# - Returns an LLMResult (content, usage dict, latency, model, attempts) and keeps
+#   per-model counters for /api/admin/llm/stats
+# - complete_stream() yields the answer's text as it is generated; it retries only until
+#   the first chunk arrives, since text already sent to a user can't be taken back
+#
+# The key and the chat model (OPENAI_MODEL) are read on first use (after main's
+# load_dotenv), not at import.
+
+import os, time, random, logging, threading, asyncio, itertools
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "600"))           # seconds per attempt (the SDK's default)
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "900"))         # seconds per call, retries included
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "0.5"))     # first backoff ceiling, doubles per retry
+LLM_RETRY_MAX = float(os.getenv("LLM_RETRY_MAX", "8"))
+EMBED_MAX_ATTEMPTS = int(os.getenv("EMBED_MAX_ATTEMPTS", "5"))  # per index-build embedding batch
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+
+log = logging.getLogger("uvicorn")
+
+RETRYABLE = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+T = TypeVar("T")
+
+@dataclass
+class LLMResult:
+    content: str
+    usage: Dict[str, Any] = field(default_factory=dict)  # prompt/completion/total_tokens, ...
+    latency_ms: float = 0.0  # wall time of the call, backoff included
+    model: str = ""          # the model that answered, as reported by the API
+    attempts: int = 1
+    first_token_ms: Optional[float] = None  # streamed calls: time until the first text arrived
+
+def _api_key() -> str:
+    return (os.getenv("OPENAI_API_KEY") or "").strip()
+
+def chat_model() -> str:
+    """The chat model for every generator: OPENAI_MODEL, default gpt-5-nano."""
+    return os.getenv("OPENAI_MODEL", "gpt-5-nano")
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                        keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+@lru_cache(maxsize=1)
+def get_client() -> Optional[OpenAI]:
+    """The process-wide OpenAI client, or None without OPENAI_API_KEY."""
+    key = _api_key()
+    if not key:
+        return None
+    return OpenAI(api_key=key, max_retries=0, timeout=_timeout(),
+                  http_client=openai.DefaultHttpxClient(limits=_limits(), timeout=_timeout()))
+
+@lru_cache(maxsize=1)
+def get_async_client() -> Optional[AsyncOpenAI]:
+    """The process-wide AsyncOpenAI client, or None without OPENAI_API_KEY."""
+    key = _api_key()
+    if not key:
+        return None
+    return AsyncOpenAI(api_key=key, max_retries=0, timeout=_timeout(),
+                       http_client=openai.DefaultAsyncHttpxClient(limits=_limits(), timeout=_timeout()))
+
+def usage_dict(usage: Any) -> Dict[str, Any]:
+    if hasattr(usage, "model_dump"):
+        usage = usage.model_dump()
+    return dict(usage or {})
+
+# ── Retry policy ──────────────────────────────────────────────────────────
+@dataclass(frozen=True)
+class RetryPolicy:
+    retryable: tuple = RETRYABLE
+    max_retries: int = LLM_MAX_RETRIES
+    deadline: Optional[float] = LLM_DEADLINE  # seconds per call, retries included; None = no limit
+    timeout: Optional[float] = LLM_TIMEOUT    # cap on one attempt; None = the call's own timeout
+    retry_timeouts: bool = True               # False: APITimeoutError is final
+
+    def start(self, deadline: Optional[float] = None) -> "RetryRun":
+        return RetryRun(self, deadline or self.deadline)
+
+    def should_retry(self, error: Exception) -> bool:
+        if isinstance(error, openai.APITimeoutError) and not self.retry_timeouts:
+            return False
+        return isinstance(error, self.retryable)
+
+def _backoff(attempt: int, error: Exception) -> float:
+    """Full-jitter exponential backoff, or the server's Retry-After if it sent one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), LLM_RETRY_MAX)
+    except ValueError:
+        pass
+    return random.uniform(0, min(LLM_RETRY_MAX, LLM_RETRY_BASE * 2 ** attempt))
+
+class RetryRun:
+    """One call under a RetryPolicy: the timeout for the next attempt, and after a failure
+    whether (and how long) to wait before trying again."""
+
+    def __init__(self, policy: RetryPolicy, deadline: Optional[float]):
+        self.policy = policy
+        self.started = time.perf_counter()
+        self.stop = self.started + deadline if deadline else None
+        self.attempts = 0
+
+    @property
+    def elapsed_ms(self) -> float:
+        return 1000 * (time.perf_counter() - self.started)
+
+    def timeout(self) -> Optional[float]:
+        """Seconds the next attempt may take: the policy's cap, or less near the deadline."""
+        self.attempts += 1
+        if self.stop is None:
+            return self.policy.timeout
+        left = max(self.stop - time.perf_counter(), 1.0)
+        return min(self.policy.timeout, left) if self.policy.timeout else left
+
+    def backoff(self, error: Exception) -> Optional[float]:
+        """Seconds to wait before retrying after `error`, or None to give up (re-raise)."""
+        if not self.policy.should_retry(error) or self.attempts > self.policy.max_retries:
+            return None
+        wait = _backoff(self.attempts - 1, error)
+        if self.stop is not None and time.perf_counter() + wait >= self.stop:
+            return None
+        return wait
+
+# completions aren't idempotent: a timed-out generation is not sent again
+CHAT_RETRY = RetryPolicy(retry_timeouts=False)
+# embedding batches are: retry everything transient, with no per-build deadline
+EMBED_RETRY = RetryPolicy(max_retries=EMBED_MAX_ATTEMPTS - 1, deadline=None, timeout=None)
+
+def call_with_retries(call: Callable[[Optional[float]], T], run: RetryRun, label: str) -> T:
+    """call(timeout) until it succeeds or `run` gives up; the last error propagates."""
+    while True:
+        try:
+            return call(run.timeout())
+        except Exception as e:
+            wait = run.backoff(e)
+            if wait is None:
+                raise
+            log.warning(f"{label} failed ({type(e).__name__}: {e}); retry {run.attempts} in {wait:.1f}s")
+            time.sleep(wait)
+
+async def call_with_retries_async(call: Callable[[Optional[float]], Awaitable[T]], run: RetryRun, label: str) -> T:
+    """call_with_retries for coroutines; backoff sleeps don't block the event loop."""
+    while True:
+        try:
+            return await call(run.timeout())
+        except Exception as e:
+            wait = run.backoff(e)
+            if wait is None:
+                raise
+            log.warning(f"{label} failed ({type(e).__name__}: {e}); retry {run.attempts} in {wait:.1f}s")
+            await asyncio.sleep(wait)
+
+# ── Metrics ───────────────────────────────────────────────────────────────
+_STATS: Dict[str, Dict[str, float]] = {}
+_STATS_LOCK = threading.Lock()
+
+def _record(model: str, latency_ms: float, attempts: int, usage: Optional[Dict[str, Any]], failed: bool) -> None:
+    with _STATS_LOCK:
+        row = _STATS.setdefault(model, {"calls": 0, "failures": 0, "retries": 0, "latency_ms": 0.0,
+                                        "max_latency_ms": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+        row["calls"] += 1
+        row["failures"] += int(failed)
+        row["retries"] += attempts - 1
+        row["latency_ms"] += latency_ms
+        row["max_latency_ms"] = max(row["max_latency_ms"], latency_ms)
+        row["prompt_tokens"] += (usage or {}).get("prompt_tokens") or 0
+        row["completion_tokens"] += (usage or {}).get("completion_tokens") or 0
+
+def llm_stats() -> Dict[str, Dict[str, float]]:
+    """Per-model call counters since start; latency_ms is the mean."""
+    with _STATS_LOCK:
+        return {m: {**row, "latency_ms": round(row["latency_ms"] / max(1, row["calls"]), 1)}
+                for m, row in _STATS.items()}
+
+# ── Calls ─────────────────────────────────────────────────────────────────
+def _result(rsp: Any, model: str, run: RetryRun) -> LLMResult:
+    usage = usage_dict(getattr(rsp, "usage", None))
+    latency = run.elapsed_ms
+    _record(model, latency, run.attempts, usage, False)
+    return LLMResult(rsp.choices[0].message.content or "", usage, latency,
+                     getattr(rsp, "model", None) or model, run.attempts)
+
+def complete(messages: List[Dict[str, Any]], model: str, client: Optional[OpenAI] = None,
+             deadline: Optional[float] = None, **params) -> LLMResult:
+    """One chat completion under CHAT_RETRY (`deadline` overrides its LLM_DEADLINE).
+
+    `client` defaults to get_client(); `params` go to chat.completions.create as-is
+    (temperature, response_format, ...). Raises the last error once retries or the
+    deadline run out, and RuntimeError if there is no client.
+    """
+    client = client or get_client()
+    if client is None:
+        raise RuntimeError("OPENAI_API_KEY not set")
+    run = CHAT_RETRY.start(deadline)
+    try:
+        rsp = call_with_retries(lambda timeout: client.with_options(timeout=timeout).chat.completions.create(
+            model=model, messages=messages, **params), run, f"LLM call to {model}")
+    except Exception:
+        _record(model, run.elapsed_ms, run.attempts, None, True)
+        raise
+    return _result(rsp, model, run)
+
+async def complete_async(messages: List[Dict[str, Any]], model: str, client: Optional[AsyncOpenAI] = None,
+                         deadline: Optional[float] = None, **params) -> LLMResult:
+    """complete() on the AsyncOpenAI client; backoff sleeps don't block the event loop."""
+    client = client or get_async_client()
+    if client is None:
+        raise RuntimeError("OPENAI_API_KEY not set")
+    run = CHAT_RETRY.start(deadline)
+    try:
+        rsp = await call_with_retries_async(lambda timeout: client.with_options(timeout=timeout).chat.completions.create(
+            model=model, messages=messages, **params), run, f"LLM call to {model}")
+    except Exception:
+        _record(model, run.elapsed_ms, run.attempts, None, True)
+        raise
+    return _result(rsp, model, run)
+
+class LLMStream:
+    """Iterates a streamed completion's text deltas; `result` (an LLMResult with the whole
+    content, usage and first_token_ms) is set once iteration finishes. Opening the stream
+    (up to its first chunk) follows CHAT_RETRY; errors after the first chunk propagate.
+    Stopping early (e.g. the HTTP client went away) closes the upstream response."""
+
+    def __init__(self, client: OpenAI, messages: List[Dict[str, Any]], model: str,
+                 deadline: Optional[float], params: Dict[str, Any]):
+        self.client = client
+        self.messages = messages
+        self.model = model
+        self.deadline = deadline
+        self.params = params
+        self.result: Optional[LLMResult] = None
+
+    def _open(self, timeout: Optional[float]) -> tuple:
+        response = self.client.with_options(timeout=timeout).chat.completions.create(
+            model=self.model, messages=self.messages, stream=True,
+            stream_options={"include_usage": True}, **self.params)
+        chunks = iter(response)
+        first = next(chunks, None)  # connection and server errors surface here
+        return response, (itertools.chain([first], chunks) if first is not None else chunks)
+
+    def __iter__(self):
+        run = CHAT_RETRY.start(self.deadline)
+        try:
+            response, chunks = call_with_retries(self._open, run, f"LLM stream to {self.model}")
+        except Exception:
+            _record(self.model, run.elapsed_ms, run.attempts, None, True)
+            raise
+        parts: List[str] = []
+        usage: Dict[str, Any] = {}
+        model = self.model
+        first_token_ms = None
+        try:
+            for chunk in chunks:
+                if getattr(chunk, "usage", None):
+                    usage = usage_dict(chunk.usage)  # the final chunk (include_usage)
+                model = getattr(chunk, "model", None) or model
+                for choice in chunk.choices:
+                    text = getattr(choice.delta, "content", None)
+                    if text:
+                        if first_token_ms is None:
+                            first_token_ms = run.elapsed_ms
+                        parts.append(text)
+                        yield text
+        except Exception:
+            _record(self.model, run.elapsed_ms, run.attempts, None, True)
+            raise
+        finally:
+            close = getattr(response, "close", None)
+            if close is not None:
+                close()
+        latency = run.elapsed_ms
+        _record(self.model, latency, run.attempts, usage, False)
+        self.result = LLMResult("".join(parts), usage, latency, model, run.attempts, first_token_ms)
+
+def complete_stream(messages: List[Dict[str, Any]], model: str, client: Optional[OpenAI] = None,
+                    deadline: Optional[float] = None, **params) -> LLMStream:
+    """complete(), streamed: iterate the returned LLMStream for text, then read `.result`."""
+    client = client or get_client()
+    if client is None:
+        raise RuntimeError("OPENAI_API_KEY not set")
+    return LLMStream(client, messages, model, deadline, params)
@@ -1,12 +1,12 @@
-import os, json, yaml, time, logging
+import os, json, yaml, time, hashlib, logging, threading, asyncio
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, UploadFile, Form, Request
-from outreach import router as outreach_router
+from fastapi import FastAPI, HTTPException, UploadFile, Form, Request, Depends
+from outreach import router as outreach_router, require_admin
 from intake import router as intake_router
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -14,19 +14,22 @@ from fastapi.responses import FileResponse
 from pydantic import BaseModel
 from sqlmodel import SQLModel, Field, create_engine, Session, select
 from dotenv import load_dotenv
-from functools import lru_cache
 
-# OpenAI (used only when DEMO_MODE=0)
-from openai import OpenAI
+# OpenAI (used only when DEMO_MODE=0); every chat completion goes through llm_gateway
+from llm_gateway import chat_model, complete, complete_stream, get_client, llm_stats
+from response_cache import ResponseCache
+from suggested_questions import SUGGESTED_QUESTIONS
 from fastapi.responses import FileResponse
 from pathlib import Path
 
 
 # Optional retrieval (skip when demo)
 try:
-    from reg_retrieval import build_or_load_index, retrieve
+    from reg_retrieval import (open_corpus, retrieve, filters_for_outcome, pack_context, base_context,
+                               query_cache_stats, discover_shards)
 except Exception:
-    build_or_load_index = retrieve = None
+    open_corpus = retrieve = filters_for_outcome = pack_context = base_context = query_cache_stats = None
+    discover_shards = None
 
 # ── Env ───────────────────────────────────────────────────────────────────
 load_dotenv()
@@ -35,15 +38,16 @@ log = logging.getLogger("uvicorn")
 DEMO_MODE = os.getenv("DEMO_MODE", "0") == "1"
 INVITE_TOKEN = os.getenv("INVITE_TOKEN", "")
 OPENAI_API_KEY = (os.getenv("OPENAI_API_KEY") or "").strip()
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5-nano")
+OPENAI_MODEL = chat_model()
 PRICE_PER_1K = float(os.getenv("OPENAI_PRICE_PER_1K", "0.03"))
+# chunks retrieved per prompt; the packer keeps what fits CONTEXT_TOKEN_BUDGET
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "8"))
+# part of every response-cache key: bump when a document generator or checklist prompt changes
+GENERATOR_PROMPT_VERSION = 1
 
-@lru_cache(maxsize=1)
 def get_openai_client():
-    """Create the OpenAI client only if/when a key is available."""
-    if not OPENAI_API_KEY:
-        return None
-    return OpenAI(api_key=OPENAI_API_KEY)
+    """The shared, pooled OpenAI client (llm_gateway), or None without a key."""
+    return get_client() if OPENAI_API_KEY else None
 
 # Demo assets
 DEMO_DIR = Path(__file__).parent / "demo"
@@ -99,18 +103,90 @@ class Project(SQLModel, table=True):
 
 SQLModel.metadata.create_all(engine)
 
+# Generated documents / checklists by (generator, model, prompt version, canonical inputs)
+RESPONSE_CACHE = ResponseCache(engine)
+
+def _cache_key(generator: str, data: "OutcomeDocumentationInput", requirements_text: str, **extra) -> str:
+    return ResponseCache.key(generator, OPENAI_MODEL, GENERATOR_PROMPT_VERSION, {
+        "outcome": data.outcome,
+        "answers": data.answers,
+        "requirements": hashlib.sha256(requirements_text.encode("utf-8")).hexdigest(),
+        **extra,
+    })
+
+def _cache_usage(hits: int, misses: int, tokens_saved: int) -> dict:
+    return {"hits": hits, "misses": misses, "tokens_saved": tokens_saved}
+
 # ── Retrieval index (skip in demo / if no key) ────────────────────────────
+# Sharded corpus: every shard is built now (never on the request path); RETRIEVAL_SHARDS,
+# or the default shard, is loaded now and the others on first search
 REG_INDEX = None
-if not DEMO_MODE and build_or_load_index and OPENAI_API_KEY:
+if not DEMO_MODE and open_corpus and OPENAI_API_KEY:
     try:
         _client = get_openai_client()
         if _client:
-            REG_INDEX = build_or_load_index(_client)
+            REG_INDEX = open_corpus(_client)
         else:
             log.warning("OpenAI client missing; skipping retrieval index build.")
     except Exception as e:
         log.warning(f"Skipping retrieval index build: {e}")
 
+# Hot reload: rebuild (BM25 indexes included) in a background thread, then swap REG_INDEX
+# in one assignment. Handlers read REG_INDEX once per request, so in-flight requests finish
+# on the old index (its memory-mapped files stay valid after save_index replaces them).
+_INDEX_RELOAD = {"thread": None, "started_at": None, "finished_at": None, "error": None, "previous_version": None}
+_INDEX_RELOAD_LOCK = threading.Lock()
+
+def _index_version(index) -> Optional[str]:
+    return index.version if index is not None else None
+
+def _reload_index(shards=None):
+    global REG_INDEX
+    try:
+        client = get_openai_client()
+        if REG_INDEX is None:
+            new_index = open_corpus(client)
+        else:
+            # only `shards` (default: every loaded shard) is rebuilt; the rest carry over
+            new_index = REG_INDEX.rebuilt(client, shards)
+        _INDEX_RELOAD["previous_version"] = _index_version(REG_INDEX)
+        REG_INDEX = new_index
+        _INDEX_RELOAD["error"] = None
+        log.info(f"Retrieval index reloaded: version {new_index.version}, {len(new_index)} chunks.")
+    except Exception as e:
+        _INDEX_RELOAD["error"] = str(e)
+        log.warning(f"Retrieval index reload failed; keeping the current index: {e}")
+    finally:
+        _INDEX_RELOAD["finished_at"] = datetime.utcnow().isoformat()
+
+def start_index_reload(shards=None) -> bool:
+    """Start a background rebuild unless one is running; True if this call started it."""
+    with _INDEX_RELOAD_LOCK:
+        running = _INDEX_RELOAD["thread"]
+        if running is not None and running.is_alive():
+            return False
+        t = threading.Thread(target=_reload_index, args=(shards,), name="reg-index-reload", daemon=True)
+        _INDEX_RELOAD.update(thread=t, started_at=datetime.utcnow().isoformat(), finished_at=None)
+        t.start()
+        return True
+
+def _index_status() -> dict:
+    t, index = _INDEX_RELOAD["thread"], REG_INDEX
+    return {
+        "version": _index_version(index),
+        "chunks": len(index) if index is not None else 0,
+        "shards": {
+            name: ({"version": sub.version, "chunks": len(sub)} if sub is not None else None)
+            for name in (index.names if index is not None else [])
+            for sub in [index.loaded.get(name)]
+        },
+        "reloading": bool(t is not None and t.is_alive()),
+        "last_reload_started_at": _INDEX_RELOAD["started_at"],
+        "last_reload_finished_at": _INDEX_RELOAD["finished_at"],
+        "last_reload_error": _INDEX_RELOAD["error"],
+        "previous_version": _INDEX_RELOAD["previous_version"],
+    }
+
 # ── Rate limit (very simple) ──────────────────────────────────────────────
 _REQ_LOG: dict[str, list[float]] = {}
 _WINDOW = 60.0
@@ -147,11 +223,31 @@ class ChatMessage(BaseModel):
     context: Optional[dict] = None  # User context (outcome, answers, etc.)
 
 # ── Helpers ───────────────────────────────────────────────────────────────
-def _compose_context_snippets(snips):
-    lines = []
-    for s in snips:
-        lines.append(f"[{s.key}] {s.title} — {s.source}\n{s.text.strip()}\n")
-    return "\n".join(lines)
+def _retrieve_context(client, index, query, base_query=None, outcome=None, doc_type=None, filters=None,
+                      trace=None):
+    """Context candidates: the precomputed base context for the outcome/document type (a
+    table lookup) topped up by a live search for the user-specific `query`. Without a
+    table, one live search for `base_query` (query plus classification) fills all slots.
+    `trace` (a dict), if given, receives the retrieval diagnostics."""
+    base = base_context(index, outcome=outcome, doc_type=doc_type)
+    if not base:
+        live = retrieve(client, index, base_query or query, k=CONTEXT_CANDIDATES, filters=filters)
+    else:
+        live = retrieve(client, index, query, k=max(2, CONTEXT_CANDIDATES - len(base)), filters=filters)
+    if trace is not None:
+        trace["retrieval"] = live.debug()
+        trace["base_context"] = [c.key for c in base]
+    seen = {c.key for c in live}
+    return list(live) + [c for c in base if c.key not in seen]
+
+def _compose_context_snippets(index, snips, trace=None):
+    """(prompt context, snippets it includes): packed to the token budget, adjacent chunks merged."""
+    started = time.perf_counter()
+    packed = pack_context(index, snips)
+    if trace is not None:
+        trace["packed"] = {"keys": [c.key for c in packed.chunks], "tokens": packed.tokens,
+                           "ms": round(1000 * (time.perf_counter() - started), 2)}
+    return packed.text, packed.chunks
 
 def _meta_block(model_meta: str) -> str:
     if not model_meta:
@@ -162,7 +258,7 @@ def _meta_block(model_meta: str) -> str:
     return f"\n### Model Metadata (Uploaded)\n\n```yaml\n{snippet}\n```\n"
 
 # ── Core report generation ────────────────────────────────────────────────
-def _make_report(data: QuickInput, model_meta: str, skip_store: bool):
+def _make_report(data: QuickInput, model_meta: str, skip_store: bool, debug: bool = False):
     # DEMO fast‑path: canned CAIA compliance doc + injected metadata
     if DEMO_MODE:
         report_md = DEMO_MD.replace("{{MODEL_META_BLOCK}}", _meta_block(model_meta))
@@ -191,14 +287,16 @@ def _make_report(data: QuickInput, model_meta: str, skip_store: bool):
 
     top_snips = []
     regulatory_context = ""
-    if REG_INDEX and retrieve:
+    trace = {} if debug else None
+    index = REG_INDEX  # one version for the whole request, even if a reload swaps it
+    if index and retrieve:
         query = (
             f"NAME: {data.system_name}\nPURPOSE: {data.intended_purpose}\nUSE_CASE: {data.use_case}\n"
             f"RISK:\n{data.risk_notes or ''}\nEXTRA:\n{data.free_text_notes or ''}\nMODEL_META:\n{model_meta or ''}\n"
         )
         try:
-            top_snips = retrieve(client, REG_INDEX, query, k=5)
-            regulatory_context = _compose_context_snippets(top_snips)
+            top_snips = _retrieve_context(client, index, query, doc_type="compliance_report", trace=trace)
+            regulatory_context, top_snips = _compose_context_snippets(index, top_snips, trace)
         except Exception as e:
             log.warning(f"Retrieval failed; continuing without context: {e}")
 
@@ -222,20 +320,16 @@ MODEL METADATA:
 
 (Write sections 0..9 + Action Items exactly as in our earlier template.)
 """
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "Precise compliance analyst. No overclaiming."},
-            {"role": "user", "content": prompt},
-        ]
-        # temperature=0.15,
-    )
-    report_md = rsp.choices[0].message.content
-
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    total_tokens = (usage or {}).get("total_tokens")
+    rsp = complete([
+        {"role": "system", "content": "Precise compliance analyst. No overclaiming."},
+        {"role": "user", "content": prompt},
+    ], OPENAI_MODEL, client=client)
+    report_md = rsp.content
+    if trace is not None:
+        trace["llm_ms"] = round(rsp.latency_ms, 2)
+
+    usage = rsp.usage
+    total_tokens = usage.get("total_tokens")
     cost = round((total_tokens or 0) / 1000 * PRICE_PER_1K, 4) if total_tokens else None
 
     sources = [{"key": sn.key, "title": sn.title, "source": sn.source, "excerpt": sn.text.strip()} for sn in top_snips]
@@ -255,7 +349,10 @@ MODEL METADATA:
             s.add(obj); s.commit(); s.refresh(obj)
             project_id = obj.id
 
-    return {"report": report_md, "usage": usage, "sources": sources, "project_id": project_id}
+    result = {"report": report_md, "usage": usage, "sources": sources, "project_id": project_id}
+    if trace is not None:
+        result["debug"] = trace
+    return result
 
 # ── Routes ────────────────────────────────────────────────────────────────
 @app.get("/api/health")
@@ -286,9 +383,10 @@ def demo_metadata_yaml():
     return FileResponse(str(f), media_type="text/yaml", filename="hr_model_meta.yaml")
 
 @app.post("/api/generate")
-def generate(data: QuickInput, request: Request):
+def generate(data: QuickInput, request: Request, debug: bool = False):
+    """?debug=true adds retrieval scores and per-stage timings to the response."""
     _rate_limit(request.client.host); _check_invite(request)
-    return _make_report(data, "", bool(data.ephemeral))
+    return _make_report(data, "", bool(data.ephemeral), debug)
 
 @app.post("/api/generate-with-file")
 async def generate_with_file(
@@ -509,6 +607,14 @@ You do not need to create developer documentation, conduct pre-deployment testin
 
 # ── Specialized Document Generation Agents ────────────────────────────
 
+def _draft_document(client, system_content: str, prompt: str) -> tuple[str, dict]:
+    """(document markdown, usage) for one generator prompt."""
+    rsp = complete([
+        {"role": "system", "content": system_content},
+        {"role": "user", "content": prompt},
+    ], OPENAI_MODEL, client=client)
+    return rsp.content, rsp.usage
+
 def _generate_general_statement(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
     """Generate General Statement of Uses (Developer) - § 6-1-1702(2)(a)"""
     prompt = f"""You are a compliance documentation specialist for the Colorado AI Act.
@@ -543,19 +649,7 @@ CRITICAL INSTRUCTIONS:
 - Be specific and actionable for deployers receiving this document
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a precision compliance documentation specialist. Generate complete, implementable documents."},
-            {"role": "user", "content": prompt}
-        ],
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a precision compliance documentation specialist. Generate complete, implementable documents.", prompt)
 
 
 def _generate_technical_summary(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -595,19 +689,7 @@ CRITICAL INSTRUCTIONS:
 - Be specific about data types, formats, and requirements
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a technical compliance documentation specialist. Generate precise, actionable technical documents."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a technical compliance documentation specialist. Generate precise, actionable technical documents.", prompt)
 
 
 def _generate_evaluation_artifact(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -647,19 +729,7 @@ CRITICAL INSTRUCTIONS:
 - Be specific about what deployers must monitor and report back
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a technical compliance documentation specialist for AI evaluation. Generate complete, metric-driven documents."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a technical compliance documentation specialist for AI evaluation. Generate complete, metric-driven documents.", prompt)
 
 
 def _generate_risk_management_policy(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -704,19 +774,7 @@ CRITICAL INSTRUCTIONS:
 - Write in formal policy language suitable for internal governance
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a compliance policy specialist. Generate formal, implementable governance documents aligned with NIST AI RMF."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a compliance policy specialist. Generate formal, implementable governance documents aligned with NIST AI RMF.", prompt)
 
 
 def _generate_impact_assessment(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -766,19 +824,7 @@ CRITICAL INSTRUCTIONS:
 - Include specific, measurable metrics where possible
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a regulatory impact assessment specialist. Generate thorough, analytical assessment documents."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a regulatory impact assessment specialist. Generate thorough, analytical assessment documents.", prompt)
 
 
 def _generate_public_website_statement(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -835,19 +881,7 @@ CRITICAL INSTRUCTIONS:
 - Maintain professional tone that builds public trust
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a public communications specialist for AI compliance. Generate clear, trustworthy public disclosures."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a public communications specialist for AI compliance. Generate clear, trustworthy public disclosures.", prompt)
 
 
 def _generate_consumer_notice(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -896,19 +930,7 @@ CRITICAL INSTRUCTIONS:
 - Format for easy implementation (copy-paste ready)
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a consumer communications specialist. Generate clear, accessible consumer notices in plain language."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a consumer communications specialist. Generate clear, accessible consumer notices in plain language.", prompt)
 
 
 def _generate_adverse_action_notice(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -959,19 +981,7 @@ CRITICAL INSTRUCTIONS:
 - Format for easy implementation
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a consumer rights specialist. Generate clear, empathetic adverse action notices that protect consumer rights."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a consumer rights specialist. Generate clear, empathetic adverse action notices that protect consumer rights.", prompt)
 
 
 def _generate_interaction_notice(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -1013,19 +1023,7 @@ CRITICAL INSTRUCTIONS:
 - Each disclosure should be copy-paste ready
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a user experience writer specializing in AI disclosures. Generate brief, clear interaction notices."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a user experience writer specializing in AI disclosures. Generate brief, clear interaction notices.", prompt)
 
 
 def _generate_synthetic_content_disclosure(client, outcome_title: str, requirements_text: str, answers_text: str, user_role: Optional[str] = None) -> tuple[str, dict]:
@@ -1064,110 +1062,41 @@ CRITICAL INSTRUCTIONS:
 - Each disclosure should be implementation-ready
 """
     
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a media transparency specialist. Generate clear, prominent synthetic content disclosures."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    
-    content = rsp.choices[0].message.content
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-    return content, usage or {}
+    return _draft_document(client, "You are a media transparency specialist. Generate clear, prominent synthetic content disclosures.", prompt)
 
 
 # ── Outcome Documentation Generation (Refactored) ─────────────────────
 
-@app.post("/api/generate-outcome-documentation")
-def generate_outcome_documentation(data: OutcomeDocumentationInput, request: Request):
-    """Generate compliance documentation based on survey outcome and user answers."""
-    _rate_limit(request.client.host)
-    # Note: not checking invite for this endpoint to allow broader access
-    
-    # Load outcome requirements from markdown files
-    outcome_title, requirements_text = _load_outcome_requirements(data.outcome)
-    
-    # DEMO mode: return outcome requirements with sample answers
-    if DEMO_MODE:
-        demo_report = f"""# {outcome_title}
-
-{requirements_text}
-
----
-
-## Your Provided Information
-
-"""
-        for qid, answer in data.answers.items():
-            if answer:
-                demo_report += f"**{qid}**: {answer[:200]}{'...' if len(answer) > 200 else ''}\n\n"
-        
-        if not data.answers:
-            demo_report += "*No specific answers provided yet.*\n"
-        
-        demo_report += "\n*This is demo mode. In production, AI-generated personalized documentation would appear here.*"
-        
-        return {"documents": {"demo_report": demo_report}, "usage": {"total_tokens": 0}}
-    
-    # Check if outcome is "not regulated" (outcomes 1, 3, 4)
-    # For these, return empty documents dict
-    if data.outcome in ["outcome1", "outcome3", "outcome4"]:
-        return {
-            "documents": {},
-            "usage": {"total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
-        }
-    
-    # Normal path with LLM for regulated outcomes
-    client = get_openai_client()
-    if client is None:
-        raise HTTPException(status_code=503, detail="OPENAI_API_KEY not set on server")
-    
-    # Format user's detailed answers for the prompt
-    answers_text = ""
-    if data.answers:
-        for qid, answer in data.answers.items():
-            if answer:
-                answers_text += f"\n**{qid}**: {answer}\n"
-    
-    # Determine which documents to generate based on outcome
-    documents_to_generate = []
-    
-    if data.outcome == "outcome2":  # Exempt Deployer
-        documents_to_generate = [
+def _documents_to_generate(outcome: str) -> list:
+    """(document name, generator) pairs for a classification; empty when none are generated."""
+    if outcome == "outcome2":  # Exempt Deployer
+        return [
             ("consumer_notice", _generate_consumer_notice),
             ("adverse_action_notice", _generate_adverse_action_notice),
             ("public_website_statement", _generate_public_website_statement),
         ]
-    elif data.outcome == "outcome5":  # General AI with Disclosure Duty
-        documents_to_generate = [
+    elif outcome == "outcome5":  # General AI with Disclosure Duty
+        return [
             ("interaction_notice", _generate_interaction_notice),
             ("synthetic_content_disclosure", _generate_synthetic_content_disclosure),
         ]
-    elif data.outcome == "outcome6":  # Not a Regulated System
-        return {
-            "documents": {},
-            "usage": {"total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
-        }
-    elif data.outcome == "outcome7":  # Developer of High-Risk AI
-        documents_to_generate = [
+    elif outcome == "outcome7":  # Developer of High-Risk AI
+        return [
             ("general_statement", _generate_general_statement),
             ("technical_summary", _generate_technical_summary),
             ("evaluation_artifact", _generate_evaluation_artifact),
             ("public_website_statement", _generate_public_website_statement),
         ]
-    elif data.outcome == "outcome8":  # Deployer of High-Risk AI
-        documents_to_generate = [
+    elif outcome == "outcome8":  # Deployer of High-Risk AI
+        return [
             ("risk_management_policy", _generate_risk_management_policy),
             ("impact_assessment", _generate_impact_assessment),
             ("consumer_notice", _generate_consumer_notice),
             ("adverse_action_notice", _generate_adverse_action_notice),
             ("public_website_statement", _generate_public_website_statement),
         ]
-    elif data.outcome == "outcome9":  # Both Developer and Deployer
-        documents_to_generate = [
+    elif outcome == "outcome9":  # Both Developer and Deployer
+        return [
             # Developer documents
             ("general_statement", _generate_general_statement),
             ("technical_summary", _generate_technical_summary),
@@ -1180,63 +1109,185 @@ def generate_outcome_documentation(data: OutcomeDocumentationInput, request: Req
             # Shared
             ("public_website_statement", _generate_public_website_statement),
         ]
-    else:
-        # Unknown outcome - return empty
-        return {
-            "documents": {},
-            "usage": {"total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
-        }
-    
-    # Determine user role for role-aware functions
-    user_role = None
+    # Not regulated (outcomes 1, 3, 4, 6) or unknown: nothing to generate
+    return []
+
+def _user_role(outcome_title: str) -> Optional[str]:
+    """Role for the role-aware generators."""
     if "Developer" in outcome_title and "Deployer" in outcome_title:
-        user_role = "both"
+        return "both"
     elif "Developer" in outcome_title:
-        user_role = "developer"
+        return "developer"
     elif "Deployer" in outcome_title:
-        user_role = "deployer"
-    
+        return "deployer"
+    return None
+
+def _answers_text(answers: dict) -> str:
+    # Format user's detailed answers for the prompt
+    answers_text = ""
+    for qid, answer in (answers or {}).items():
+        if answer:
+            answers_text += f"\n**{qid}**: {answer}\n"
+    return answers_text
+
+def _demo_outcome_report(data: OutcomeDocumentationInput, outcome_title: str, requirements_text: str) -> str:
+    demo_report = f"""# {outcome_title}
+
+{requirements_text}
+
+---
+
+## Your Provided Information
+
+"""
+    for qid, answer in data.answers.items():
+        if answer:
+            demo_report += f"**{qid}**: {answer[:200]}{'...' if len(answer) > 200 else ''}\n\n"
+
+    if not data.answers:
+        demo_report += "*No specific answers provided yet.*\n"
+
+    demo_report += "\n*This is demo mode. In production, AI-generated personalized documentation would appear here.*"
+    return demo_report
+
+def _empty_usage() -> dict:
+    return {"total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+def _iter_outcome_documents(client, data: OutcomeDocumentationInput, outcome_title: str,
+                            requirements_text: str, usage_stats: dict):
+    """Yield (doc_name, content, usage, status) for each document of data.outcome, status
+    being "cached", "generated" or "error": cache hits first, then each generated
+    document as soon as its future completes. Aggregates into `usage_stats` as it goes.
+
+    Generated documents are cached from the future's callback, so documents still in
+    flight when a streaming client disconnects are cached for its retry.
+    """
+    documents_to_generate = _documents_to_generate(data.outcome)
+    user_role = _user_role(outcome_title)
+    answers_text = _answers_text(data.answers)
+    usage_stats.setdefault("per_document", {})
+
+    # Serve unchanged documents from the response cache; only misses reach the LLM
+    cache_keys = {doc_name: _cache_key(doc_name, data, requirements_text, role=user_role)
+                  for doc_name, _ in documents_to_generate}
+    hits, tokens_saved, misses = [], 0, []
+    for doc_name, doc_func in documents_to_generate:
+        cached = RESPONSE_CACHE.get(cache_keys[doc_name])
+        if cached is not None:
+            hits.append((doc_name, cached))
+            tokens_saved += cached[1].get("total_tokens") or 0
+        else:
+            misses.append((doc_name, doc_func))
+    usage_stats["cache"] = _cache_usage(len(hits), len(misses), tokens_saved)
+    for doc_name, (content, usage) in hits:
+        usage_stats["per_document"][doc_name] = {**usage, "cached": True}
+        yield doc_name, content, usage, "cached"
+    if not misses:
+        return
+
+    def cache_result(doc_name, future):
+        if not future.cancelled() and future.exception() is None:
+            content, usage = future.result()
+            RESPONSE_CACHE.put(cache_keys[doc_name], doc_name, OPENAI_MODEL, content, usage)
+
     # Generate all documents in parallel using ThreadPoolExecutor
-    documents = {}
-    usage_stats = {
-        "total_tokens": 0,
-        "prompt_tokens": 0,
-        "completion_tokens": 0,
-        "per_document": {}
-    }
-    
-    with ThreadPoolExecutor(max_workers=len(documents_to_generate)) as executor:
+    with ThreadPoolExecutor(max_workers=len(misses)) as executor:
         # Submit all document generation tasks
-        future_to_doc = {
-            executor.submit(
-                doc_func, 
-                client, 
-                outcome_title, 
-                requirements_text, 
-                answers_text,
-                user_role
-            ): doc_name
-            for doc_name, doc_func in documents_to_generate
-        }
-        
+        future_to_doc = {}
+        for doc_name, doc_func in misses:
+            future = executor.submit(doc_func, client, outcome_title, requirements_text, answers_text, user_role)
+            future.add_done_callback(lambda f, name=doc_name: cache_result(name, f))
+            future_to_doc[future] = doc_name
+
         # Collect results as they complete
         for future in as_completed(future_to_doc):
             doc_name = future_to_doc[future]
             try:
                 content, usage = future.result()
-                documents[doc_name] = content
-                
-                # Aggregate usage stats
-                usage_stats["per_document"][doc_name] = usage
-                usage_stats["total_tokens"] += usage.get("total_tokens", 0)
-                usage_stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
-                usage_stats["completion_tokens"] += usage.get("completion_tokens", 0)
             except Exception as e:
                 log.error(f"Failed to generate {doc_name}: {e}")
-                documents[doc_name] = f"# Error\n\nFailed to generate this document: {str(e)}"
-    
+                yield doc_name, f"# Error\n\nFailed to generate this document: {str(e)}", None, "error"
+                continue
+
+            # Aggregate usage stats
+            usage_stats["per_document"][doc_name] = usage
+            usage_stats["total_tokens"] += usage.get("total_tokens", 0)
+            usage_stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            usage_stats["completion_tokens"] += usage.get("completion_tokens", 0)
+            yield doc_name, content, usage, "generated"
+
+@app.post("/api/generate-outcome-documentation")
+def generate_outcome_documentation(data: OutcomeDocumentationInput, request: Request):
+    """Generate compliance documentation based on survey outcome and user answers."""
+    _rate_limit(request.client.host)
+    # Note: not checking invite for this endpoint to allow broader access
+
+    # Load outcome requirements from markdown files
+    outcome_title, requirements_text = _load_outcome_requirements(data.outcome)
+
+    # DEMO mode: return outcome requirements with sample answers
+    if DEMO_MODE:
+        demo_report = _demo_outcome_report(data, outcome_title, requirements_text)
+        return {"documents": {"demo_report": demo_report}, "usage": {"total_tokens": 0}}
+
+    # Not regulated or unknown outcomes: empty documents dict
+    if not _documents_to_generate(data.outcome):
+        return {"documents": {}, "usage": _empty_usage()}
+
+    # Normal path with LLM for regulated outcomes
+    client = get_openai_client()
+    if client is None:
+        raise HTTPException(status_code=503, detail="OPENAI_API_KEY not set on server")
+
+    usage_stats = {**_empty_usage(), "per_document": {}}
+    documents = {
+        doc_name: content
+        for doc_name, content, _, _ in _iter_outcome_documents(client, data, outcome_title, requirements_text, usage_stats)
+    }
     return {"documents": documents, "usage": usage_stats}
 
+def _sse(event: str, payload) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def _event_stream(events) -> StreamingResponse:
+    # sync generators: Starlette iterates them in a worker thread, so they may block
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/api/generate-outcome-documentation/stream")
+def generate_outcome_documentation_stream(data: OutcomeDocumentationInput, request: Request):
+    """Server-Sent Events variant of /api/generate-outcome-documentation.
+
+    Emits a `document` event ({name, content, usage, status}) for each document as soon as
+    it is ready (cached ones first), then a `usage` event with the same summary as the
+    non-streaming response, then `done`.
+    """
+    _rate_limit(request.client.host)
+    outcome_title, requirements_text = _load_outcome_requirements(data.outcome)
+
+    client = None
+    if not DEMO_MODE and _documents_to_generate(data.outcome):
+        client = get_openai_client()
+        if client is None:
+            raise HTTPException(status_code=503, detail="OPENAI_API_KEY not set on server")
+
+    def events():
+        if DEMO_MODE:
+            demo_report = _demo_outcome_report(data, outcome_title, requirements_text)
+            yield _sse("document", {"name": "demo_report", "content": demo_report, "usage": None, "status": "generated"})
+            yield _sse("usage", {"total_tokens": 0})
+        elif client is None:
+            yield _sse("usage", _empty_usage())
+        else:
+            usage_stats = {**_empty_usage(), "per_document": {}}
+            for doc_name, content, usage, status in _iter_outcome_documents(
+                    client, data, outcome_title, requirements_text, usage_stats):
+                yield _sse("document", {"name": doc_name, "content": content, "usage": usage, "status": status})
+            yield _sse("usage", usage_stats)
+        yield _sse("done", {})
+
+    return _event_stream(events())
+
 
 @app.post("/api/generate-checklist")
 def generate_checklist(data: OutcomeDocumentationInput, request: Request):
@@ -1279,6 +1330,15 @@ def generate_checklist(data: OutcomeDocumentationInput, request: Request):
             if answer:
                 answers_text += f"\n**{qid}**: {answer}\n"
 
+    cache_key = _cache_key("checklist", data, requirements_text)
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        content, usage = cached
+        return {"checklist": _parse_checklist(content), "usage": {
+            "total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached": True,
+            "cache": _cache_usage(1, 0, usage.get("total_tokens") or 0),
+        }}
+
     prompt = f"""You are an expert legal compliance assistant for the Colorado AI Act (CAIA).
 
 CLASSIFICATION: {outcome_title}
@@ -1304,16 +1364,15 @@ Example Output:
 * Implement bias testing protocol
 """
 
-    rsp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a precise legal assistant. Output only a bulleted list."},
-            {"role": "user", "content": prompt},
-        ]
-    )
+    rsp = complete([
+        {"role": "system", "content": "You are a precise legal assistant. Output only a bulleted list."},
+        {"role": "user", "content": prompt},
+    ], OPENAI_MODEL, client=client)
 
-    content = rsp.choices[0].message.content
-    
+    RESPONSE_CACHE.put(cache_key, "checklist", OPENAI_MODEL, rsp.content, rsp.usage)
+    return {"checklist": _parse_checklist(rsp.content), "usage": {**rsp.usage, "cache": _cache_usage(0, 1, 0)}}
+
+def _parse_checklist(content: str) -> list:
     # Parse bullet points
     checklist_items = []
     for line in content.split('\n'):
@@ -1323,12 +1382,7 @@ Example Output:
             clean_line = line.lstrip('*- ').strip()
             if clean_line:
                 checklist_items.append(clean_line)
-    
-    usage = getattr(rsp, "usage", None)
-    if hasattr(usage, "model_dump"):
-        usage = usage.model_dump()
-
-    return {"checklist": checklist_items, "usage": usage}
+    return checklist_items
 
 
 # ── Survey-based document generation ──────────────────────────────────────
@@ -1899,13 +1953,19 @@ Maintain records of:
 
 
 @app.post("/api/chat/compliance-assistant")
-def compliance_chat(data: ChatMessage, request: Request):
-    """RAG-powered chatbot for SB 24-205 compliance questions"""
+def compliance_chat(data: ChatMessage, request: Request, debug: bool = False, stream: bool = False):
+    """RAG-powered chatbot for SB 24-205 compliance questions (?debug=true adds retrieval diagnostics).
+
+    `?stream=true` answers with Server-Sent Events instead: `meta` ({citations,
+    suggested_questions}) as soon as retrieval is done, a `token` event ({text}) per chunk
+    of the answer as the model writes it, then `done` ({message, usage, debug?}). A failure
+    after `meta` is reported as an `error` event ({detail}).
+    """
     _rate_limit(request.client.host)
 
     # DEMO mode: simple responses
     if DEMO_MODE:
-        return {
+        result = {
             "message": f"Demo mode: I received your question '{data.message}'. In production, I would use RAG to answer based on SB 24-205.",
             "citations": [],
             "suggested_questions": [
@@ -1914,6 +1974,13 @@ def compliance_chat(data: ChatMessage, request: Request):
                 "What are deployer obligations?"
             ]
         }
+        if stream:
+            return _event_stream(iter([
+                _sse("meta", {"citations": result["citations"], "suggested_questions": result["suggested_questions"]}),
+                _sse("token", {"text": result["message"]}),
+                _sse("done", {"message": result["message"], "usage": None}),
+            ]))
+        return result
 
     # Normal path with RAG
     client = get_openai_client()
@@ -1945,13 +2012,16 @@ User Classification: {outcome_title}
 User Question: {data.message}
 """
 
-    # Retrieve relevant SB 24-205 sections using RAG
+    # Retrieve relevant SB 24-205 sections using RAG, scoped to the user's classification
     top_snips = []
     regulatory_context = ""
-    if REG_INDEX and retrieve:
+    trace = {} if debug else None
+    index = REG_INDEX  # read once: retrieval and snippet composition use the same snapshot
+    if index and retrieve:
         try:
-            top_snips = retrieve(client, REG_INDEX, enhanced_query, k=5)
-            regulatory_context = _compose_context_snippets(top_snips)
+            top_snips = _retrieve_context(client, index, data.message, base_query=enhanced_query,
+                                          outcome=outcome, filters=filters_for_outcome(outcome), trace=trace)
+            regulatory_context, top_snips = _compose_context_snippets(index, top_snips, trace)
         except Exception as e:
             log.warning(f"Retrieval failed; continuing without context: {e}")
 
@@ -1973,50 +2043,102 @@ RELEVANT LAW SECTIONS FROM SB 24-205:
 {regulatory_context or '<<No relevant sections found>>'}
 """
 
+    # Generate suggested follow-up questions based on classification
+    if "outcome7" in outcome or "outcome9" in outcome:  # Developer
+        suggested_questions = SUGGESTED_QUESTIONS["developer"]
+    elif "outcome8" in outcome or "outcome9" in outcome:  # Deployer
+        suggested_questions = SUGGESTED_QUESTIONS["deployer"]
+    else:
+        suggested_questions = SUGGESTED_QUESTIONS["general"]
+    citations = [{"key": s.key, "title": s.title, "source": s.source} for s in top_snips]
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": data.message}
+    ]
+
+    if stream:
+        def events():
+            # citations and follow-ups don't depend on the answer: send them before the first token
+            yield _sse("meta", {"citations": citations, "suggested_questions": suggested_questions})
+            answer = complete_stream(messages, OPENAI_MODEL, client=client, temperature=0.1)
+            try:
+                for text in answer:
+                    yield _sse("token", {"text": text})
+            except Exception as e:
+                log.error(f"Chat completion failed: {e}")
+                yield _sse("error", {"detail": "Failed to generate response"})
+                return
+            done = {"message": answer.result.content, "usage": answer.result.usage}
+            if trace is not None:
+                trace["llm_ms"] = round(answer.result.latency_ms, 2)
+                trace["first_token_ms"] = (round(answer.result.first_token_ms, 2)
+                                           if answer.result.first_token_ms is not None else None)
+                done["debug"] = trace
+            yield _sse("done", done)
+
+        return _event_stream(events())
+
     # Call LLM
     try:
-        response = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": data.message}
-            ],
-            temperature=0.1,  # Low temperature for accuracy
-        )
+        response = complete(messages, OPENAI_MODEL, client=client, temperature=0.1)  # Low temperature for accuracy
 
-        answer = response.choices[0].message.content
+        answer = response.content
+        if trace is not None:
+            trace["llm_ms"] = round(response.latency_ms, 2)
 
-        # Generate suggested follow-up questions based on classification
-        suggested_questions = []
-        if "outcome7" in outcome or "outcome9" in outcome:  # Developer
-            suggested_questions = [
-                "What documentation must I provide to deployers?",
-                "What are my notification obligations to the Attorney General?",
-                "What is 'reasonable care' for developers?"
-            ]
-        elif "outcome8" in outcome or "outcome9" in outcome:  # Deployer
-            suggested_questions = [
-                "How often must I conduct impact assessments?",
-                "What is required in a risk management program?",
-                "What are consumer notification requirements?"
-            ]
-        else:
-            suggested_questions = [
-                "What is a 'consequential decision'?",
-                "What is 'algorithmic discrimination'?",
-                "When does SB 24-205 take effect?"
-            ]
-
-        return {
+        result = {
             "message": answer,
-            "citations": [{"key": s.key, "title": s.title, "source": s.source} for s in top_snips],
+            "citations": citations,
             "suggested_questions": suggested_questions
         }
+        if trace is not None:
+            result["debug"] = trace
+        return result
 
     except Exception as e:
         log.error(f"Chat completion failed: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate response")
 
+@app.post("/api/admin/reload-index")
+async def reload_index(wait: bool = False, shard: Optional[str] = None,
+                       admin_ok: bool = Depends(require_admin)):
+    """Rebuild the retrieval index from backend/regs in the background and swap it in.
+
+    `?shard=<name>` rebuilds just that shard (default: every loaded shard); 404 if no
+    such shard exists under backend/regs. Returns immediately with the serving version;
+    `?wait=true` returns once the new index is live. Requests keep being served from the
+    current index meanwhile.
+    """
+    if DEMO_MODE or open_corpus is None:
+        raise HTTPException(503, "Retrieval is disabled on this server")
+    if shard and shard not in discover_shards():  # the reload rediscovers shards the same way
+        raise HTTPException(404, f"Unknown retrieval shard {shard!r}")
+    started = start_index_reload([shard] if shard else None)
+    if wait:
+        t = _INDEX_RELOAD["thread"]
+        await asyncio.to_thread(t.join)
+    return {"started": started, **_index_status()}
+
+@app.get("/api/admin/index")
+def index_status(admin_ok: bool = Depends(require_admin)):
+    return _index_status()
+
+@app.get("/api/admin/llm/stats")
+def llm_call_stats(admin_ok: bool = Depends(require_admin)):
+    """Per-model chat-completion counters (calls, failures, retries, latency, tokens) and
+    response-cache counters."""
+    return {"models": llm_stats(), "response_cache": RESPONSE_CACHE.stats()}
+
+@app.get("/api/admin/index/stats")
+def index_stats(admin_ok: bool = Depends(require_admin)):
+    """Chunk count, dimensions, memory, version and build time of each loaded shard,
+    plus query-embedding cache counters."""
+    index = REG_INDEX
+    return {
+        "index": index.stats() if index is not None else None,
+        "query_cache": query_cache_stats() if query_cache_stats else None,
+    }
+
 @app.get("/checkup", include_in_schema=False)
 def readiness_check():
     base = Path(__file__).resolve().parent
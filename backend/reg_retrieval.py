@@ -1,19 +1,188 @@
-import os, glob, json, re
-from dataclasses import dataclass
-from typing import List, Dict, Any
+import os, glob, json, re, hashlib, logging, sqlite3, threading, time, zlib, asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from typing import List, Dict, Any, Optional
 import numpy as np
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from embeddings import (EMBED_DIMENSIONS, EMBED_MODEL, EmbeddingProvider, as_provider, model_id, truncation_dim,
+                        read_jsonl, append_jsonl)
+from llm_gateway import EMBED_RETRY, call_with_retries, call_with_retries_async, get_client
+from suggested_questions import SUGGESTED_QUESTIONS
+from tiered_cache import CacheStore, TieredCache
 
 # Simple, file-based retrieval with OpenAI embeddings.
 # - Reads all .md files in backend/regs/
-# - Chunks them by ~1200 chars w/ overlap
-# - Builds embeddings on startup (or loads from cache json)
+# - Chunks them on markdown headings and statute section/subsection boundaries
+#   (long sections split on sentences, no overlap) and records a section-id table, so
+#   a query citing "§ 6-1-1703(4)" resolves by lookup instead of vector search
+# - Collapses exact (same hash) and near-duplicate (MinHash) chunks into one canonical
+#   chunk that lists the other source files as aliases, before anything is embedded
+# - Tags chunks with facets (source, kind, role, outcome) kept as per-value row lists, so
+#   retrieve(..., filters=...) scores only the matching slice of the corpus
+# - Builds embeddings on startup (or loads the cached binary index), re-embedding
+#   only chunks whose content hash is new; unchanged chunks keep their vector and key
+# - Embeds in token-sized batches on a bounded worker pool, retrying failed batches and
+#   checkpointing finished ones so an interrupted build resumes where it stopped
+# - Also keeps an in-process BM25 index over the same chunks: retrieval can run
+#   lexical-only (no network), dense-only, or hybrid (rank fusion of both), and hybrid
+#   falls back to lexical when the embeddings API is slow or down
+# - Keeps all vectors in one pre-normalized float32 matrix; chunk metadata lives beside it.
+#   Optionally (INDEX_QUANTIZATION) a float16 or int8 copy is searched instead and only
+#   the top candidates are re-scored exactly against the memory-mapped float32 rows
+# - Async variants (build_or_load_index_async, retrieve_async, retrieve_many_async) take
+#   an AsyncOpenAI client, so request handlers don't park a thread on embedding calls
+# - Caches query embeddings by (model, normalized query) in memory and in SQLite, so a
+#   repeated question skips the embeddings request
+# - Large corpora get an IVF-flat index (k-means centroids + inverted lists, persisted
+#   beside the matrix); dense search switches from exact to probing the nearest lists
+#   automatically by corpus size
+# - pack_context() turns retrieved chunks into prompt context under a token budget:
+#   MMR for diversity, adjacent chunks of one source merged with their overlap removed
+# - The corpus is split into shards (one per jurisdiction / document family), each with
+#   its own index files: built when the corpus is opened, memory-mapped on first use,
+#   rebuilt independently. ShardedIndex searches the selected shards in parallel and
+#   merges their rankings
+# - Embeddings come from a provider (embeddings.py): OpenAI, a local hashing embedder, or
+#   a recorded fixture, so the index builds and retrieval benchmarks run without a key.
+#   The provider's model id is stored in the index; a mismatch re-embeds on build, and a
+#   query embedded by a different model drops dense search instead of mixing spaces
+#
+# On-disk index (written atomically, metadata last):
+#   regs_index.npy        float32 (n, dim) matrix, memory-mapped read-only on load so
+#                         pages come straight from the page cache and are shared by workers
+#   regs_index.txt        UTF-8 blob of all chunk texts, back to back
+#   regs_index.meta.json  format/version header, checksum, embedding model, per-file
+#                         sha256, and per-chunk [key, source#, title#, text byte offset,
+#                         text byte length, text sha256, section ids, alias sources]
+#                         (the checksum is verified after builds and conversions, by
+#                         `reg_retrieval.py verify`, and on load only with INDEX_VERIFY=1)
+#   regs_index.f16.npy    float16 copy of the matrix
+#   regs_index.i8.npy     int8 copy, with per-row scales in regs_index.i8scale.npy
+#   regs_index.ivf.npz    IVF centroids and inverted lists (only for large indexes)
+#   regs_index.ctx.json   precomputed base-context table (chunk keys per outcome/document type)
 
-EMBED_MODEL = "text-embedding-3-small"
-CHUNK_SIZE = 1200
-CHUNK_OVERLAP = 150
-INDEX_PATH = os.path.join(os.path.dirname(__file__), "regs_index.json")
+CHUNK_SIZE = 1500      # max chars per chunk; smaller sections are merged up to this
+CHUNKER_VERSION = 3    # bump when chunking/dedup changes so unchanged files are re-chunked
+
+# Near-duplicate detection: MinHash over word shingles, LSH banding for candidates
+SHINGLE_WORDS = 5
+MINHASH_PERMS = 64
+MINHASH_BANDS = 16
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.85"))  # est. Jaccard
+INDEX_PATH = os.path.join(os.path.dirname(__file__), "regs_index.npy")
+LEGACY_JSON_PATH = os.path.join(os.path.dirname(__file__), "regs_index.json")
+INDEX_FORMAT = "clarynt-regs-index"
+INDEX_VERSION = 4
+READABLE_INDEX_VERSIONS = (2, 3, 4)  # v2 rows lack section ids, v3 rows lack aliases
+# 1 = every load_index reads and hashes the whole index against its checksum. Off by default,
+# so a load only maps the files; builds and conversions always verify what they wrote
+INDEX_VERIFY = os.getenv("INDEX_VERIFY", "0") == "1"
 REGS_DIR = os.path.join(os.path.dirname(__file__), "regs")
+# Shards: the .md files directly in REGS_DIR are DEFAULT_SHARD (index at INDEX_PATH);
+# each subdirectory REGS_DIR/<name>/ is shard <name> with its own regs_index.<name>.* files
+DEFAULT_SHARD = os.getenv("DEFAULT_SHARD", "co")
+RETRIEVAL_SHARDS = [n.strip() for n in os.getenv("RETRIEVAL_SHARDS", "").split(",") if n.strip()]  # [] = all
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "4"))
+
+# Embedding request sizing. The API caps each input at 8191 tokens and each request at
+# 2048 inputs / 300k tokens; stay well under so one slow batch doesn't dominate a build.
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "60000"))
+EMBED_BATCH_INPUTS = int(os.getenv("EMBED_BATCH_INPUTS", "256"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+# retries per batch follow llm_gateway.EMBED_RETRY (EMBED_MAX_ATTEMPTS, shared backoff)
+
+# Query-time retrieval: "hybrid" | "dense" | "lexical"
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+QUERY_EMBED_TIMEOUT = float(os.getenv("QUERY_EMBED_TIMEOUT", "5"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # reciprocal rank fusion damping; 60 is the usual default
+
+# "none" | "float16" | "int8": which matrix the coarse dense search scans
+INDEX_QUANTIZATION = os.getenv("INDEX_QUANTIZATION", "none")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "8"))  # x k, re-scored in float32
+SCORE_BLOCK_ROWS = 2048  # bounds the float32 temporary when scoring a compact matrix
+# Async retrieval scores in a worker thread above this many matrix elements (rows x dim x
+# queries); below it the product takes well under a millisecond and runs on the loop
+ASYNC_SCORE_OFFLOAD = int(os.getenv("ASYNC_SCORE_OFFLOAD", "2000000"))
+
+# Approximate dense search (IVF-flat). "auto" uses it once a search would scan at least
+# ANN_MIN_ROWS rows and exact search below that; "exact" never; "ivf" whenever possible.
+ANN_MODE = os.getenv("ANN_MODE", "auto")
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "20000"))
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))  # inverted lists; 0 = 4 * sqrt(n)
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))  # lists scanned per query: recall vs latency
+ANN_TRAIN_ITERS = int(os.getenv("ANN_TRAIN_ITERS", "12"))
+ANN_TRAIN_SAMPLE = 256  # k-means trains on at most this many rows per list
+
+# Prompt context packing: token budget for the regulatory excerpts, and MMR's trade-off
+# between retrieval rank (1.0) and novelty against excerpts already picked (0.0)
+# (the default stays under what the previous top-5 verbatim excerpts cost, ~2000-2400)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1800"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+
+# Query-embedding cache: in-memory LRU (entries, seconds) in front of a SQLite file.
+# The default path is in backend/, which on Fly (no volume mounted; machines auto-stop) is
+# reset on every boot, so there the cache is per-boot. Point QUERY_CACHE_PATH at a mounted
+# volume to keep it across restarts; "" disables the file.
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", os.path.join(os.path.dirname(__file__), "regs_query_cache.sqlite3"))
+QUERY_CACHE_DISK_MAX = int(os.getenv("QUERY_CACHE_DISK_MAX", "50000"))
+
+# Facets for filtered retrieval. A chunk with no role/outcome tag is general and matches
+# any value of that facet (e.g. definitions apply to developers and deployers alike).
+FACETS = ("source", "kind", "role", "outcome")
+OUTCOME_ROLES = {
+    "outcome2": ["deployer"],
+    "outcome5": [],
+    "outcome6": [],
+    "outcome7": ["developer"],
+    "outcome8": ["deployer"],
+    "outcome9": ["developer", "deployer"],
+}
+SECTION_ROLES = {"6-1-1702": ["developer"], "6-1-1703": ["deployer"]}
+SOURCE_ROLES = {
+    "developer.md": ["developer"],
+    "deployer.md": ["deployer"],
+    "impact_assessment.md": ["deployer"],
+    "risk_management_policy.md": ["deployer"],
+}
+
+# Base-context table: top-N chunks per classification and per generated document type,
+# retrieved once per index build so request handlers only search for what's user-specific.
+# Seeds cite the governing sections so those resolve by section lookup.
+CONTEXT_TABLE_TOP_N = int(os.getenv("CONTEXT_TABLE_TOP_N", "6"))
+OUTCOME_CONTEXT_QUERIES = {
+    "outcome2": "exempt deployer fewer than fifty employees exemption conditions § 6-1-1703(6) consumer notice",
+    "outcome5": "artificial intelligence system interacting with consumers disclosure § 6-1-1704",
+    "outcome6": "not a high-risk artificial intelligence system exclusions consequential decision substantial factor",
+    "outcome7": "developer of high-risk artificial intelligence system duties documentation § 6-1-1702",
+    "outcome8": "deployer of high-risk artificial intelligence system risk management impact assessment notices § 6-1-1703",
+    "outcome9": "developer and deployer obligations § 6-1-1702 § 6-1-1703 high-risk artificial intelligence system",
+}
+DOC_TYPE_CONTEXT_QUERIES = {
+    "general_statement": "§ 6-1-1702(2)(a) general statement reasonably foreseeable uses known harmful or inappropriate uses",
+    "technical_summary": "§ 6-1-1702(2)(b) training data limitations purpose intended benefits documentation",
+    "evaluation_artifact": "§ 6-1-1702(2)(c) evaluation for performance and mitigation of algorithmic discrimination",
+    "risk_management_policy": "§ 6-1-1703(2) risk management policy and program NIST AI RMF ISO 42001",
+    "impact_assessment": "§ 6-1-1703(3) impact assessment annually within ninety days of modification",
+    "public_website_statement": "§ 6-1-1702(4) § 6-1-1703(4) statement on website summarizing high-risk systems",
+    "consumer_notice": "§ 6-1-1703(4) notify consumer before consequential decision purpose nature of system",
+    "adverse_action_notice": "§ 6-1-1703(4) adverse consequential decision principal reasons correct data appeal human review",
+    "interaction_notice": "§ 6-1-1704 disclose to consumer interacting with an artificial intelligence system",
+    "synthetic_content_disclosure": "§ 6-1-1704 disclosure artificial intelligence system interacting consumers obvious to reasonable person",
+    "compliance_report": "high-risk artificial intelligence system developer deployer duties algorithmic discrimination reasonable care",
+}
+
+# Golden queries for offline retrieval evaluation: the chat assistant's suggested
+# follow-up questions (suggested_questions.py) plus the context-table seeds above.
+CHAT_SUGGESTED_QUESTIONS = [q for qs in SUGGESTED_QUESTIONS.values() for q in qs]
+GOLDEN_QUERIES = (CHAT_SUGGESTED_QUESTIONS + list(OUTCOME_CONTEXT_QUERIES.values())
+                  + list(DOC_TYPE_CONTEXT_QUERIES.values()))
+
+log = logging.getLogger("uvicorn")
 
 @dataclass
 class RegChunk:
@@ -21,10 +190,378 @@ class RegChunk:
     source: str      # filename
     title: str       # best-effort title (first heading)
     text: str        # chunk text
-    embedding: list  # vector
+    sha: str = ""    # sha256 of text; identifies the chunk across rebuilds
+    sections: List[str] = field(default_factory=list)  # e.g. ["6-1-1703(4)"]
+    aliases: List[str] = field(default_factory=list)   # other files with the same passage
+
+class RegIndex:
+    """Chunk metadata plus a contiguous (n, dim) float32 matrix of unit-length embeddings.
+
+    Row i of `matrix` is the embedding of `chunks[i]`. Rows are L2-normalized once at
+    load/build time so cosine similarity is a plain dot product at query time.
+    """
+
+    def __init__(self, chunks: List[RegChunk], matrix: np.ndarray, model: str = EMBED_MODEL,
+                 files: Optional[Dict[str, str]] = None, next_key: Optional[int] = None,
+                 chunker: int = CHUNKER_VERSION, compact: Optional[np.ndarray] = None,
+                 scales: Optional[np.ndarray] = None, ivf: Optional["IVFIndex"] = None,
+                 checksum: Optional[str] = None,
+                 context_table: Optional[Dict[str, Dict[str, List[str]]]] = None,
+                 built_at: Optional[float] = None, build_seconds: Optional[float] = None):
+        if len(chunks) != len(matrix):
+            raise ValueError(f"index has {len(chunks)} chunks but {len(matrix)} vectors")
+        self.chunks = chunks
+        self.matrix = matrix
+        self.model = model
+        self.files = files or {}  # source filename -> sha256 of its content
+        self.chunker = chunker
+        # optional float16/int8 copy of `matrix` (int8 rows are `scales[i] * compact[i]`)
+        self.compact = compact
+        self.scales = scales
+        self.ivf = ivf  # approximate search structure; None = exact search only
+        self.rows_by_key = {c.key: row for row, c in enumerate(chunks)}
+        self.checksum = checksum  # of the saved matrix + texts; None until saved/loaded
+        # {"outcome": {outcome: [keys]}, "doc_type": {doc type: [keys]}}, best first
+        self.context_table = context_table
+        self.built_at = built_at            # unix time the vectors were last (re)built
+        self.build_seconds = build_seconds  # wall time of that build, embedding included
+        # keys are never reused, so a citation to a removed chunk can't silently point elsewhere
+        self.next_key = next_key or max((_key_number(c.key) for c in chunks), default=0) + 1
+        self._lexical: Optional["LexicalIndex"] = None
+        # section id -> row ids; a subsection also registers under its base section
+        self.sections: Dict[str, List[int]] = {}
+        for row, c in enumerate(chunks):
+            for sid in c.sections:
+                for ref in dict.fromkeys([sid, _base_section(sid)]):
+                    rows = self.sections.setdefault(ref, [])
+                    if not rows or rows[-1] != row:
+                        rows.append(row)
+        # facet -> value -> ascending row ids; "*" holds the rows untagged for that facet
+        facet_rows: Dict[str, Dict[str, List[int]]] = {f: {} for f in FACETS}
+        for row, c in enumerate(chunks):
+            for facet, values in chunk_facets(c).items():
+                for v in values or ["*"]:
+                    facet_rows[facet].setdefault(v, []).append(row)
+        self.facets = {f: {v: np.asarray(r, dtype=np.int64) for v, r in vals.items()}
+                       for f, vals in facet_rows.items()}
+
+    @classmethod
+    def from_vectors(cls, chunks: List[RegChunk], vectors, **info) -> "RegIndex":
+        dim = len(vectors[0]) if len(vectors) else 0
+        matrix = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32).reshape(len(chunks), dim))
+        return cls(chunks, _normalize_rows(matrix), **info)
+
+    @property
+    def dim(self) -> int:
+        return int(self.matrix.shape[1]) if self.matrix.ndim == 2 else 0
+
+    @property
+    def version(self) -> str:
+        """Short content id of the saved index: changes whenever chunks or vectors do."""
+        return self.checksum[:12] if self.checksum else "unsaved"
+
+    @property
+    def quantization(self) -> str:
+        if self.compact is None:
+            return "none"
+        return "int8" if self.compact.dtype == np.int8 else "float16"
+
+    def stats(self) -> Dict[str, Any]:
+        """Size, memory and build facts for diagnostics. Memory-mapped arrays count at full
+        size but live in the page cache, shared between workers."""
+        memory = {
+            "matrix_bytes": int(self.matrix.nbytes),
+            "matrix_mapped": isinstance(self.matrix, np.memmap),
+            "compact_bytes": int(self.compact.nbytes) if self.compact is not None else 0,
+            "scales_bytes": int(self.scales.nbytes) if self.scales is not None else 0,
+            "ivf_bytes": int(self.ivf.centroids.nbytes + self.ivf.offsets.nbytes + self.ivf.rows.nbytes)
+                         if self.ivf is not None else 0,
+            "text_bytes": sum(len(c.text.encode("utf-8")) for c in self.chunks),
+        }
+        return {
+            "version": self.version,
+            "chunks": len(self),
+            "dim": self.dim,
+            "model": self.model,
+            "sources": len(self.files),
+            "quantization": self.quantization,
+            "ann": f"ivf(nlist={len(self.ivf.centroids)})" if self.ivf is not None else "exact",
+            "context_table": self.context_table is not None,
+            "memory": memory,
+            "built_at": self.built_at,
+            "build_seconds": self.build_seconds,
+        }
+
+    def select(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Ascending row ids matching `filters` ({facet: value or [values]}), or None for all.
+
+        Values within a facet are OR-ed, facets are AND-ed; for role/outcome, general
+        (untagged) rows always match. An empty value list matches nothing (only the
+        general rows, for role/outcome).
+        """
+        if not filters:
+            return None
+        rows: Optional[np.ndarray] = None
+        for facet, values in filters.items():
+            if facet not in self.facets:
+                raise ValueError(f"unknown retrieval filter {facet!r}; expected one of {FACETS}")
+            values = [values] if isinstance(values, str) else list(values)
+            if facet in ("role", "outcome"):
+                values.append("*")
+            empty = np.empty(0, dtype=np.int64)
+            matched = np.unique(np.concatenate([empty] + [self.facets[facet].get(v, empty) for v in values]))
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        return rows
+
+    def dense_top(self, q: np.ndarray, n: int, rows: Optional[np.ndarray] = None) -> tuple:
+        """(row ids, cosine scores) of the n nearest rows to unit vector `q`, best first.
+
+        `rows` restricts the search to those (ascending) row ids. With a compact matrix,
+        the scan runs on it and only n * RERANK_CANDIDATES candidates are re-scored
+        exactly against the float32 matrix.
+        """
+        return self.dense_top_many(q[None, :], n, rows)[0]
+
+    def dense_top_many(self, queries: np.ndarray, n: int, rows: Optional[np.ndarray] = None) -> List[tuple]:
+        """dense_top for an (m, dim) batch of unit query vectors, scored with one matrix product.
+
+        Uses the IVF index instead of a full scan when ANN_MODE allows it for the number
+        of rows searched (see ANN_MIN_ROWS).
+        """
+        scanned = len(rows) if rows is not None else len(self)
+        if self.ivf is not None and ANN_MODE != "exact" and (ANN_MODE == "ivf" or scanned >= ANN_MIN_ROWS):
+            out = []
+            for q, cand in zip(queries, self.ivf.probe(queries)):
+                if rows is not None:
+                    cand = np.intersect1d(cand, rows, assume_unique=True)
+                if len(cand) < n:  # too few rows near the query (tight filter): scan exactly
+                    out.append(self._scan(q[None, :], n, rows)[0])
+                else:
+                    out.append(self._scan(q[None, :], n, cand)[0])
+            return out
+        return self._scan(queries, n, rows)
+
+    def _scan(self, queries: np.ndarray, n: int, rows: Optional[np.ndarray]) -> List[tuple]:
+        if rows is not None:
+            matrix, compact = self.matrix[rows], (self.compact[rows] if self.compact is not None else None)
+            scales = self.scales[rows] if self.scales is not None else None
+        else:
+            matrix, compact, scales = self.matrix, self.compact, self.scales
+        if compact is None:
+            scores = queries @ matrix.T  # (m, n_rows)
+            out = []
+            for s in scores:
+                top = _top_k(s, n)
+                out.append(((top if rows is None else rows[top]), s[top]))
+            return out
+        coarse_scores = _compact_scores(compact, scales, queries.T)  # (n_rows, m)
+        out = []
+        for j, q in enumerate(queries):
+            coarse = _top_k(coarse_scores[:, j], max(n * RERANK_CANDIDATES, 32))
+            if rows is not None:
+                coarse = rows[coarse]
+            cand = np.sort(coarse)  # ascending rows: sequential page reads from the mapping
+            exact = self.matrix[cand] @ q
+            order = _top_k(exact, n)
+            out.append((cand[order], exact[order]))
+        return out
+
+    @property
+    def lexical(self) -> "LexicalIndex":
+        # built on first use from the chunk texts; ShardedIndex builds it before serving a
+        # shard (warm()), so requests don't pay for it
+        if self._lexical is None:
+            self._lexical = LexicalIndex([c.text for c in self.chunks])
+        return self._lexical
+
+    def __len__(self) -> int:
+        return len(self.chunks)
 
-def _read_files() -> List[Dict[str, Any]]:
-    files = sorted(glob.glob(os.path.join(REGS_DIR, "*.md")))
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __getitem__(self, i):
+        return self.chunks[i]
+
+# "§ 6-1-1703(4)(a)" -> 6-1-1703, 6-1-1703(4), 6-1-1703(4)(a), so a query citing either
+# the section or a subsection matches text citing the other
+_CITATION_RE = re.compile(r"\b(\d+-\d+-\d+(?:\.\d+)?)((?:\s?\([0-9a-zA-Z]{1,4}\))*)")
+_SUBSECTION_RE = re.compile(r"\(([0-9a-zA-Z]{1,4})\)")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was "
+    "were will with what which who how when does do i my our we you your".split()
+)
+
+def _citation_forms(m: "re.Match") -> List[str]:
+    """A citation match as progressively narrower ids: base section first."""
+    forms = [m.group(1)]
+    for sub in _SUBSECTION_RE.findall(m.group(2)):
+        forms.append(forms[-1] + f"({sub.lower()})")
+    return forms
+
+def _first_citation(text: str) -> Optional[str]:
+    m = _CITATION_RE.search(text)
+    return _citation_forms(m)[-1] if m else None
+
+def _base_section(sid: str) -> str:
+    return sid.split("(", 1)[0]
+
+def _tokenize(text: str) -> List[str]:
+    tokens = []
+    for m in _CITATION_RE.finditer(text):
+        tokens.extend(_citation_forms(m))
+    tokens.extend(w for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS)
+    return tokens
+
+class LexicalIndex:
+    """BM25 over chunk texts as an inverted index in CSR form.
+
+    Postings for term t are `rows[indptr[t]:indptr[t+1]]` with precomputed BM25 term
+    weights `weights[...]` (document-length normalization folded in), so scoring a query
+    is one vectorized add per query term.
+    """
+
+    def __init__(self, texts: List[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.n = len(texts)
+        vocab: Dict[str, int] = {}
+        postings: List[Dict[int, int]] = []
+        lengths = np.zeros(self.n, dtype=np.float32)
+        for row, text in enumerate(texts):
+            toks = _tokenize(text)
+            lengths[row] = len(toks)
+            for tok in toks:
+                tid = vocab.setdefault(tok, len(vocab))
+                if tid == len(postings):
+                    postings.append({})
+                postings[tid][row] = postings[tid].get(row, 0) + 1
+
+        self.vocab = vocab
+        self.indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum([len(p) for p in postings])
+        self.rows = np.fromiter((r for p in postings for r in p), dtype=np.int32, count=int(self.indptr[-1]))
+        tf = np.fromiter((c for p in postings for c in p.values()), dtype=np.float32, count=int(self.indptr[-1]))
+        avgdl = float(lengths.mean()) if self.n else 0.0
+        norm = k1 * (1 - b + b * lengths[self.rows] / (avgdl or 1.0))
+        self.weights = (tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+        df = np.diff(self.indptr).astype(np.float32)
+        self.idf = np.log1p((self.n - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    def scores(self, query: str) -> np.ndarray:
+        out = np.zeros(self.n, dtype=np.float32)
+        for tok in _tokenize(query):
+            tid = self.vocab.get(tok)
+            if tid is None:
+                continue
+            lo, hi = self.indptr[tid], self.indptr[tid + 1]
+            # row ids are unique within one posting list, so fancy-index += is safe
+            out[self.rows[lo:hi]] += self.idf[tid] * self.weights[lo:hi]
+        return out
+
+class IVFIndex:
+    """Inverted-file index over unit vectors: spherical k-means centroids, with each
+    row filed under its nearest centroid in CSR form (list j is
+    `rows[offsets[j]:offsets[j+1]]`, ascending). A query scans only the rows of its
+    `nprobe` nearest lists.
+    """
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, rows: np.ndarray):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, nlist: int = 0, iters: int = ANN_TRAIN_ITERS,
+              seed: int = 0) -> "IVFIndex":
+        n = len(matrix)
+        nlist = max(1, min(n, nlist or int(4 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(n, size=min(n, nlist * ANN_TRAIN_SAMPLE), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = _nearest_centroid(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            # re-seed empty lists from random sample rows so every list stays in use
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = _normalize_rows(sums)
+        assign = _nearest_centroid(matrix, centroids)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+        return cls(centroids.astype(np.float32), offsets, order.astype(np.int64))
+
+    def probe(self, queries: np.ndarray, nprobe: int = ANN_NPROBE) -> List[np.ndarray]:
+        """Ascending candidate row ids per query: the rows of its nprobe nearest lists."""
+        nprobe = max(1, min(nprobe, self.nlist))
+        near = queries @ self.centroids.T  # (m, nlist)
+        out = []
+        for s in near:
+            lists = _top_k(s, nprobe)
+            out.append(np.sort(np.concatenate([self.rows[self.offsets[j] : self.offsets[j + 1]] for j in lists])))
+        return out
+
+def _nearest_centroid(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    out = np.empty(len(matrix), dtype=np.int64)
+    for lo in range(0, len(matrix), SCORE_BLOCK_ROWS):
+        out[lo : lo + SCORE_BLOCK_ROWS] = np.argmax(np.asarray(matrix[lo : lo + SCORE_BLOCK_ROWS]) @ centroids.T, axis=1)
+    return out
+
+def _ann_wanted(n: int) -> bool:
+    return ANN_MODE == "ivf" or (ANN_MODE == "auto" and n >= ANN_MIN_ROWS)
+
+def chunk_facets(c: RegChunk) -> Dict[str, List[str]]:
+    """Facet tags of a chunk, derived from its source files (incl. aliases) and sections."""
+    sources = [c.source] + c.aliases
+    kinds: List[str] = []
+    roles: List[str] = []
+    outcomes: List[str] = []
+    for src in sources:
+        m = re.match(r"(outcome\d+)_", src)
+        if m:
+            kinds.append("outcome")
+            outcomes.append(m.group(1))
+            roles.extend(OUTCOME_ROLES.get(m.group(1), []))
+        elif "full_text" in src:
+            kinds.append("statute")
+        else:
+            kinds.append("definition")
+            roles.extend(SOURCE_ROLES.get(src, []))
+    for sid in c.sections:
+        roles.extend(SECTION_ROLES.get(_base_section(sid), []))
+    return {"source": sources, "kind": list(dict.fromkeys(kinds)),
+            "role": list(dict.fromkeys(roles)), "outcome": list(dict.fromkeys(outcomes))}
+
+def filters_for_outcome(outcome: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Retrieval filters for a survey classification, e.g. outcome8 -> deployer material."""
+    if outcome not in OUTCOME_ROLES:
+        return None
+    roles = OUTCOME_ROLES[outcome]
+    return {"outcome": outcome, "role": roles} if roles else {"outcome": outcome}
+
+def _key_number(key: str) -> int:
+    m = re.fullmatch(r"(?:[A-Z0-9]+-)?S(\d+)", key)
+    return int(m.group(1)) if m else 0
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _normalize_rows(m: np.ndarray) -> np.ndarray:
+    # in place; zero vectors stay zero instead of becoming NaN
+    norms = np.linalg.norm(m, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    m /= norms
+    return m
+
+def _read_files(regs_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+    files = sorted(glob.glob(os.path.join(regs_dir or REGS_DIR, "*.md")))
     docs = []
     for fp in files:
         with open(fp, "r", encoding="utf-8") as f:
@@ -32,77 +569,1608 @@ def _read_files() -> List[Dict[str, Any]]:
         # title = first markdown heading or filename
         m = re.search(r"^#\s*(.+)", content, flags=re.M)
         title = m.group(1).strip() if m else os.path.basename(fp)
-        docs.append({"path": fp, "title": title, "content": content})
+        docs.append({"path": fp, "title": title, "content": content, "sha": _sha256(content)})
     return docs
 
-def _chunk(text: str, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP) -> List[str]:
-    chunks = []
-    i = 0
-    while i < len(text):
-        chunks.append(text[i : i + size])
-        i += size - overlap
-    return [c.strip() for c in chunks if c.strip()]
-
-def _compute_embeddings(client: OpenAI, texts: List[str]) -> List[List[float]]:
-    # batched for fewer API calls (simple form)
-    res = client.embeddings.create(model=EMBED_MODEL, input=texts)
-    # OpenAI returns 'data' items in order
-    return [d.embedding for d in res.data]
-
-def build_or_load_index(client: OpenAI) -> List[RegChunk]:
-    if os.path.exists(INDEX_PATH):
-        with open(INDEX_PATH, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-        return [RegChunk(**r) for r in raw]
-
-    docs = _read_files()
-    chunks: List[RegChunk] = []
-    texts_to_embed = []
-    meta = []
-    k_counter = 1
+# Section boundaries. Statute text: "6-1-1703. Deployer duty ..." starts a section,
+# "(4) ON AND AFTER ..." at line start starts a subsection, "SECTION 2." a bill section.
+# Markdown: headings, and bold citation lines like "**§ 6-1-1703(2) — Risk Management**".
+_MD_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+_BOLD_CITE_RE = re.compile(r"^\*\*§\s*\d+-\d+-\d+.*\*\*$")
+# (the section title is required: a wrapped "... PURSUANT TO SECTION\n6-1-1707. " is not a heading)
+_STATUTE_SECTION_RE = re.compile(r"^(\d+-\d+-\d+)\.\s+[A-Z][a-z]")
+_BILL_SECTION_RE = re.compile(r"^SECTION \d+\.\s")
+_SUBSECTION_START_RE = re.compile(r"^\((\d+)\)\s")
+# page footers and the enrolled-bill legend repeat on every page of the full text
+_BOILERPLATE_RE = re.compile(
+    r"^PAGE \d+-SENATE BILL \d+-\d+\s*$"
+    r"|^Capital letters or bold[\s\S]*?is not part of\s+the act\.\s*$",
+    flags=re.M,
+)
+_SENTENCE_END_RE = re.compile(r"(?<=[.;:!?])\s+(?=[A-Z(\"*#-])")
+_KEEP = object()
 
-    for d in docs:
-        pieces = _chunk(d["content"])
-        for p in pieces:
-            key = f"S{k_counter}"
-            chunks.append(
-                RegChunk(
-                    key=key,
-                    source=os.path.basename(d["path"]),
-                    title=d["title"],
-                    text=p,
-                    embedding=[],
-                )
+def _split_blocks(text: str) -> List[tuple]:
+    """Split a document into (section_id or None, block text) at section boundaries."""
+    blocks: List[tuple] = []
+    lines: List[str] = []
+    cur_id: Optional[str] = None
+    headings: List[tuple] = []  # (level, citation or None) for the open markdown headings
+    statute: Optional[str] = None
+    last_sub = 0
+
+    for line in text.splitlines():
+        new_id: Any = _KEEP
+        m = _MD_HEADING_RE.match(line)
+        if m:
+            level = len(m.group(1))
+            while headings and headings[-1][0] >= level:
+                headings.pop()
+            headings.append((level, _first_citation(m.group(2))))
+            new_id = next((c for _, c in reversed(headings) if c), None)
+        elif _BOLD_CITE_RE.match(line.strip()):
+            new_id = _first_citation(line)
+            headings[-1:] = [(headings[-1][0] if headings else 7, new_id)]
+        elif _STATUTE_SECTION_RE.match(line):
+            statute, last_sub = _STATUTE_SECTION_RE.match(line).group(1), 0
+            new_id = statute
+        elif _BILL_SECTION_RE.match(line):
+            statute, new_id = None, None
+        elif statute and _SUBSECTION_START_RE.match(line):
+            # wrapped lines such as "(2) MUST BE REASONABLE ..." also start with "(n) ";
+            # accept only the next subsection number ((1) is often inline with the heading)
+            n = int(_SUBSECTION_START_RE.match(line).group(1))
+            if last_sub < n <= last_sub + 2:
+                last_sub = n
+                new_id = f"{statute}({n})"
+        if new_id is not _KEEP:
+            body = "\n".join(lines).strip()
+            if body:
+                blocks.append((cur_id, body))
+            lines, cur_id = [], new_id
+        lines.append(line)
+    body = "\n".join(lines).strip()
+    if body:
+        blocks.append((cur_id, body))
+    return blocks
+
+def _split_sentences(text: str, size: int) -> List[str]:
+    """Pack sentences into pieces of at most `size` chars; hard-wrap only runaway sentences."""
+    pieces: List[str] = []
+    cur = ""
+    for sent in _SENTENCE_END_RE.split(text):
+        while len(sent) > size:
+            cut = sent.rfind(" ", 0, size)
+            cut = cut if cut > size // 2 else size
+            if cur:
+                pieces.append(cur)
+                cur = ""
+            pieces.append(sent[:cut].strip())
+            sent = sent[cut:].strip()
+        if cur and len(cur) + 1 + len(sent) > size:
+            pieces.append(cur)
+            cur = ""
+        cur = f"{cur} {sent}" if cur else sent
+    if cur:
+        pieces.append(cur)
+    return pieces
+
+def _chunk(text: str, size: int = CHUNK_SIZE) -> List[tuple]:
+    """Section-aware chunks as (text, section_ids).
+
+    Consecutive blocks of the same statute section (or the same uncited stretch) are
+    merged up to `size` chars; longer blocks are split on sentence boundaries. A block
+    that is only a heading is carried into the block after it.
+    """
+    chunks: List[list] = []  # [text, section_ids, base]
+    carry = ""
+    for sid, body in _split_blocks(_BOILERPLATE_RE.sub("", text)):
+        if all(not ln.strip() or ln.lstrip().startswith("#") for ln in body.splitlines()):
+            carry = f"{carry}\n\n{body}" if carry else body
+            continue
+        if carry:
+            body, carry = f"{carry}\n\n{body}", ""
+        base = _base_section(sid) if sid else None
+        for part in ([body] if len(body) <= size else _split_sentences(body, size)):
+            prev = chunks[-1] if chunks else None
+            if prev and prev[2] == base and len(prev[0]) + 2 + len(part) <= size:
+                prev[0] = f"{prev[0]}\n\n{part}"
+                if sid and sid not in prev[1]:
+                    prev[1].append(sid)
+            else:
+                chunks.append([part, [sid] if sid else [], base])
+    if carry:
+        chunks.append([carry, [], None])
+    return [(t.strip(), ids) for t, ids, _ in chunks if t.strip()]
+
+def resolve_citations(index: "RegIndex", query: str) -> List[int]:
+    """Rows for statute sections cited in `query`, most specific match per citation.
+
+    Chunks that open with the cited section (the statute text itself) come before
+    chunks that only cover it further down (e.g. an outcome summary).
+    """
+    rows: List[int] = []
+    for m in _CITATION_RE.finditer(query):
+        for sid in reversed(_citation_forms(m)):
+            if sid in index.sections:
+                def position(row: int) -> tuple:
+                    ids = index.chunks[row].sections
+                    return next((i, x != sid) for i, x in enumerate(ids)
+                                if x == sid or _base_section(x) == sid)
+                rows.extend(r for r in sorted(index.sections[sid], key=position) if r not in rows)
+                break
+    return rows
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    words = _WORD_RE.findall(text.lower())
+    grams = [" ".join(words[i : i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))]
+    return np.unique(np.fromiter((zlib.crc32(g.encode()) for g in grams), dtype=np.uint64, count=len(grams)))
+
+def _minhash_signatures(texts: List[str]) -> np.ndarray:
+    """(n, MINHASH_PERMS) MinHash signatures from universal hashes (a*x + b) mod p."""
+    prime = np.uint64(4294967311)  # > 2**32, and a*x + b stays below 2**64
+    rng = np.random.default_rng(1703)
+    a = rng.integers(1, 2**31, MINHASH_PERMS, dtype=np.uint64)
+    b = rng.integers(0, 2**32, MINHASH_PERMS, dtype=np.uint64)
+    sigs = np.empty((len(texts), MINHASH_PERMS), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        sh = _shingle_hashes(text)
+        sigs[i] = ((a[:, None] * sh[None, :] + b[:, None]) % prime).min(axis=1)
+    return sigs
+
+def _dedup(chunks: List[RegChunk]) -> tuple:
+    """Collapse exact and near-duplicate chunks into the first occurrence (corpus order).
+
+    The canonical chunk absorbs the duplicates' section ids and lists their source files
+    in `aliases`. Returns (kept chunks, report rows of (kind, duplicate, canonical)).
+    """
+    parent = list(range(len(chunks)))
+    kind: Dict[int, str] = {}
+
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int, how: str) -> None:
+        ri, rj = root(i), root(j)
+        if ri != rj:
+            lo, hi = min(ri, rj), max(ri, rj)
+            parent[hi] = lo
+            kind.setdefault(hi, how)
+
+    first_by_sha: Dict[str, int] = {}
+    for i, c in enumerate(chunks):
+        union(first_by_sha.setdefault(c.sha, i), i, "exact")
+
+    # near duplicates: rows sharing any LSH band bucket are candidates, then confirmed
+    # by the estimated Jaccard similarity over the full signature
+    unique = [i for i in range(len(chunks)) if root(i) == i]
+    if len(unique) > 1:
+        sigs = _minhash_signatures([chunks[i].text for i in unique])
+        rows = MINHASH_PERMS // MINHASH_BANDS
+        for band in range(MINHASH_BANDS):
+            buckets: Dict[bytes, List[int]] = {}
+            for u, sig in enumerate(sigs[:, band * rows : (band + 1) * rows]):
+                buckets.setdefault(sig.tobytes(), []).append(u)
+            for members in buckets.values():
+                for u in members[1:]:
+                    if np.mean(sigs[members[0]] == sigs[u]) >= NEAR_DUP_THRESHOLD:
+                        union(unique[members[0]], unique[u], "near")
+
+    kept: List[RegChunk] = []
+    report: List[tuple] = []
+    for i, c in enumerate(chunks):
+        r = root(i)
+        if r == i:
+            kept.append(c)
+            continue
+        canon = chunks[r]
+        for sid in c.sections:
+            if sid not in canon.sections:
+                canon.sections.append(sid)
+        if c.source != canon.source and c.source not in canon.aliases:
+            canon.aliases.append(c.source)
+        report.append((kind.get(i, "exact"), c, canon))
+    return kept, report
+
+def _log_dedup_report(report: List[tuple]) -> None:
+    if not report:
+        return
+    exact = sum(1 for how, _, _ in report if how == "exact")
+    log.info(f"Dedup: collapsed {len(report)} chunks ({exact} exact, {len(report) - exact} near-duplicate).")
+    for how, dup, canon in report:
+        log.info(f"  {how:5s} {dup.source} -> {canon.source} [{canon.key}] {canon.text[:60]!r}")
+
+@lru_cache(maxsize=1)
+def _token_encoder():
+    # tiktoken is optional; without it we fall back to a conservative character estimate
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(EMBED_MODEL)
+    except Exception:
+        return None
+
+def _estimate_tokens(text: str) -> int:
+    enc = _token_encoder()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    # statute text is mostly upper case and citations, which tokenizes densely: ~3 chars/token
+    return len(text) // 3 + 1
+
+def _pack_batches(token_counts: List[int], max_tokens: int = EMBED_BATCH_TOKENS,
+                  max_inputs: int = EMBED_BATCH_INPUTS) -> List[List[int]]:
+    """Greedily group input positions into batches bounded by total tokens and input count."""
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    cur_tokens = 0
+    for i, n in enumerate(token_counts):
+        if cur and (cur_tokens + n > max_tokens or len(cur) >= max_inputs):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(i)
+        cur_tokens += n
+    if cur:
+        batches.append(cur)
+    return batches
+
+def _embed_retry(provider: EmbeddingProvider):
+    # the gateway's embedding policy, retrying what this provider calls transient (none for local)
+    return replace(EMBED_RETRY, retryable=provider.retryable).start()
+
+def _embed_batch_with_retry(provider: EmbeddingProvider, texts: List[str]) -> tuple:
+    """Embed one batch under llm_gateway.EMBED_RETRY, retrying the provider's transient
+    errors (for OpenAI: connection errors, 429s and 5xx).
+
+    Returns (vectors, prompt_tokens or None).
+    """
+    return call_with_retries(lambda _timeout: provider.embed(texts), _embed_retry(provider),
+                             f"Embedding batch of {len(texts)}")
+
+def _read_checkpoint(path: str, model: str) -> Dict[str, List[float]]:
+    """sha -> vector for batches finished by an earlier, interrupted build with this model."""
+    done: Dict[str, List[float]] = {}
+    if not os.path.exists(path):
+        return done
+    for row in read_jsonl(path):  # a crash mid-write leaves a torn line; it is skipped
+        if row.get("model") == model:
+            done[row["sha"]] = row["embedding"]
+    return done
+
+class _EmbedJob:
+    """Shared bookkeeping for embed_texts / embed_texts_async: dedup against the checkpoint,
+    token-sized batches, checkpoint appends and throughput stats."""
+
+    def __init__(self, texts: List[str], shas: Optional[List[str]], checkpoint_path: Optional[str], model: str):
+        self.texts = texts
+        self.model = model
+        self.shas = shas or [_sha256(t) for t in texts]
+        self.done = _read_checkpoint(checkpoint_path, model) if checkpoint_path else {}
+        todo: List[int] = []
+        seen = set(self.done)
+        for i, sha in enumerate(self.shas):
+            if sha not in seen:  # identical texts are sent once
+                seen.add(sha)
+                todo.append(i)
+        if self.done:
+            log.info(f"Embedding checkpoint: resuming with {len(self.done)} vectors already embedded.")
+        token_counts = [_estimate_tokens(texts[i]) for i in todo]
+        self.batches = [[todo[j] for j in b] for b in _pack_batches(token_counts)]
+        self.lock = threading.Lock()
+        self.stats = {"chunks": 0, "tokens": 0}
+        self.ckpt = append_jsonl(checkpoint_path) if checkpoint_path and self.batches else None
+        self.started = time.perf_counter()
+
+    def batch_texts(self, batch: List[int]) -> List[str]:
+        return [self.texts[i] for i in batch]
+
+    def record(self, batch: List[int], vecs: np.ndarray, used: Optional[int]) -> None:
+        with self.lock:
+            for i, v in zip(batch, vecs):
+                v = [float(x) for x in v]
+                self.done[self.shas[i]] = v
+                if self.ckpt:
+                    self.ckpt.write(json.dumps({"sha": self.shas[i], "model": self.model, "embedding": v}) + "\n")
+            if self.ckpt:
+                self.ckpt.flush()
+            self.stats["chunks"] += len(batch)
+            self.stats["tokens"] += used if used is not None else sum(_estimate_tokens(self.texts[i]) for i in batch)
+
+    def close(self) -> None:
+        if self.ckpt:
+            self.ckpt.close()
+
+    def result(self) -> np.ndarray:
+        elapsed = time.perf_counter() - self.started
+        if self.batches:
+            chunks, tokens = self.stats["chunks"], self.stats["tokens"]
+            log.info(
+                f"Embedded {chunks} chunks / {tokens} tokens in {len(self.batches)} batches, "
+                f"{elapsed:.1f}s ({chunks / elapsed:.1f} chunks/s, {tokens / elapsed:.0f} tokens/s)"
             )
-            texts_to_embed.append(p)
-            meta.append(len(chunks) - 1)
-            k_counter += 1
+        return np.asarray([self.done[sha] for sha in self.shas], dtype=np.float32).reshape(len(self.texts), -1)
+
+def _require_provider(client: Any) -> EmbeddingProvider:
+    provider = as_provider(client)
+    if provider is None:
+        raise RuntimeError("No embedding provider: pass a client or set EMBED_PROVIDER=local|fixture")
+    return provider
+
+def embed_texts(client: Any, texts: List[str], shas: Optional[List[str]] = None,
+                checkpoint_path: Optional[str] = None, workers: int = EMBED_WORKERS) -> np.ndarray:
+    """Embed many texts into an (n, dim) float32 matrix (not normalized), in input order.
+
+    `client` is an OpenAI client or an EmbeddingProvider (see embeddings.as_provider).
+    Texts are packed into token-bounded batches that run on `workers` threads; each batch
+    retries on its own. With `checkpoint_path`, every finished batch is appended to a JSONL
+    file keyed by `shas`, and texts already present there are not sent again.
+    """
+    provider = _require_provider(client)
+    job = _EmbedJob(texts, shas, checkpoint_path, provider.model)
+
+    def run(batch: List[int]):
+        job.record(batch, *_embed_batch_with_retry(provider, job.batch_texts(batch)))
+
+    try:
+        if job.batches:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(job.batches)))) as executor:
+                for future in as_completed([executor.submit(run, b) for b in job.batches]):
+                    future.result()
+    finally:
+        job.close()
+    return job.result()
+
+async def _embed_batch_with_retry_async(provider: EmbeddingProvider, texts: List[str]) -> tuple:
+    """Async twin of _embed_batch_with_retry."""
+    return await call_with_retries_async(lambda _timeout: provider.embed_async(texts), _embed_retry(provider),
+                                         f"Embedding batch of {len(texts)}")
+
+async def embed_texts_async(client: Any, texts: List[str], shas: Optional[List[str]] = None,
+                            checkpoint_path: Optional[str] = None, workers: int = EMBED_WORKERS) -> np.ndarray:
+    """embed_texts on an AsyncOpenAI client: at most `workers` batches in flight at once."""
+    provider = _require_provider(client)
+    job = await asyncio.to_thread(_EmbedJob, texts, shas, checkpoint_path, provider.model)
+    sem = asyncio.Semaphore(max(1, workers))
+
+    async def run(batch: List[int]):
+        async with sem:
+            vecs, used = await _embed_batch_with_retry_async(provider, job.batch_texts(batch))
+        job.record(batch, vecs, used)
+
+    try:
+        await asyncio.gather(*(run(b) for b in job.batches))
+    finally:
+        job.close()
+    return job.result()
+
+def _index_paths(path: str) -> Dict[str, str]:
+    base = path[:-4] if path.endswith(".npy") else path
+    return {"matrix": base + ".npy", "text": base + ".txt", "meta": base + ".meta.json",
+            "checkpoint": base + ".ckpt.jsonl", "float16": base + ".f16.npy",
+            "int8": base + ".i8.npy", "int8_scales": base + ".i8scale.npy", "ivf": base + ".ivf.npz",
+            "context": base + ".ctx.json"}
+
+def _checksum(matrix: np.ndarray, text_blob) -> str:
+    h = hashlib.sha256()
+    if isinstance(matrix, np.memmap):
+        # hash the file with plain reads rather than through the mapping, so verifying
+        # doesn't fault every page into this process (matters when only int8 is scanned)
+        with open(matrix.filename, "rb") as f:
+            f.seek(matrix.offset)
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    else:
+        h.update(np.ascontiguousarray(matrix).reshape(-1).view(np.uint8))
+    h.update(text_blob)
+    return h.hexdigest()
+
+def quantize(matrix: np.ndarray, kind: str) -> tuple:
+    """(compact matrix, per-row scales or None) for kind "float16" or "int8"."""
+    if kind == "float16":
+        return matrix.astype(np.float16), None
+    if kind == "int8":
+        scales = np.abs(matrix).max(axis=1).astype(np.float32) / 127.0
+        scales[scales == 0] = 1.0
+        q = np.rint(matrix / scales[:, None]).clip(-127, 127).astype(np.int8)
+        return q, scales
+    raise ValueError(f"unknown quantization {kind!r}")
+
+def _compact_scores(compact: np.ndarray, scales: Optional[np.ndarray], q: np.ndarray) -> np.ndarray:
+    """compact @ q for a (dim,) vector or (dim, m) batch, with int8 scales applied."""
+    # numpy upcasts float16/int8 operands to a full float32 copy; score in row blocks instead
+    out = np.empty((len(compact),) + q.shape[1:], dtype=np.float32)
+    for lo in range(0, len(compact), SCORE_BLOCK_ROWS):
+        out[lo : lo + SCORE_BLOCK_ROWS] = compact[lo : lo + SCORE_BLOCK_ROWS].astype(np.float32) @ q
+    if scales is not None:
+        out *= scales.reshape((-1,) + (1,) * (q.ndim - 1))
+    return out
 
-    if texts_to_embed:
-        vecs = _compute_embeddings(client, texts_to_embed)
-        for idx, v in zip(meta, vecs):
-            chunks[idx].embedding = v
+class IndexFormatError(ValueError):
+    """The on-disk index is missing, from another format version, or fails its checksum."""
 
-    # cache to json
-    with open(INDEX_PATH, "w", encoding="utf-8") as f:
-        json.dump([c.__dict__ for c in chunks], f)
+def save_index(index: RegIndex, path: str = INDEX_PATH) -> None:
+    paths = _index_paths(path)
+    sources: Dict[str, int] = {}
+    titles: Dict[str, int] = {}
+    rows, blob, offset = [], [], 0
+    for c in index.chunks:
+        data = c.text.encode("utf-8")
+        rows.append([c.key, sources.setdefault(c.source, len(sources)),
+                     titles.setdefault(c.title, len(titles)), offset, len(data),
+                     c.sha or _sha256(c.text), c.sections, c.aliases])
+        blob.append(data)
+        offset += len(data)
+    text_blob = b"".join(blob)
+    matrix = np.ascontiguousarray(index.matrix, dtype=np.float32)
+    meta = {
+        "format": INDEX_FORMAT,
+        "version": INDEX_VERSION,
+        "count": len(index),
+        "dim": index.dim,
+        "dtype": "float32",
+        "checksum": _checksum(matrix, text_blob),
+        "model": index.model,
+        "next_key": index.next_key,
+        "files": index.files,
+        "chunker": index.chunker,
+        "built_at": index.built_at or time.time(),
+        "build_seconds": index.build_seconds,
+        "sources": list(sources),
+        "titles": list(titles),
+        "chunks": rows,
+    }
+    # write data files first and the metadata last, so a crash never leaves a
+    # meta file pointing at half-written data (the checksum catches the rest)
+    np.save(paths["matrix"] + ".tmp.npy", matrix)
+    os.replace(paths["matrix"] + ".tmp.npy", paths["matrix"])
+    # compact copies are derived data (not checksummed); written for every index so the
+    # quantization can be switched without a rebuild
+    f16, _ = quantize(matrix, "float16")
+    i8, scales = quantize(matrix, "int8")
+    for name, arr in (("float16", f16), ("int8", i8), ("int8_scales", scales)):
+        np.save(paths[name] + ".tmp.npy", arr)
+        os.replace(paths[name] + ".tmp.npy", paths[name])
+    with open(paths["text"] + ".tmp", "wb") as f:
+        f.write(text_blob)
+    os.replace(paths["text"] + ".tmp", paths["text"])
+    _save_ivf(paths["ivf"], index.ivf if index.ivf is not None or not _ann_wanted(len(index))
+              else IVFIndex.train(matrix, ANN_NLIST), meta["checksum"])
+    with open(paths["meta"] + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, separators=(",", ":"))
+    os.replace(paths["meta"] + ".tmp", paths["meta"])
 
-    return chunks
+def load_index(path: str = INDEX_PATH, verify: Optional[bool] = None,
+               quantization: Optional[str] = None) -> RegIndex:
+    """Load a binary index; the matrix is memory-mapped (zero-copy), not read into the heap.
 
-def _cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
-    denom = (np.linalg.norm(a) * np.linalg.norm(b))
-    if denom == 0:
-        return 0.0
-    return float(np.dot(a, b) / denom)
+    Format, version, shapes and the text size are always checked. verify (default
+    INDEX_VERIFY) also hashes the matrix and texts against the stored checksum, which
+    reads the whole float32 file.
 
-def retrieve(client: OpenAI, index: List[RegChunk], query: str, k: int = 4) -> List[RegChunk]:
-    if not index:
+    quantization (default INDEX_QUANTIZATION): "float16"/"int8" also maps the compact copy
+    for the coarse scan; the float32 matrix is then only touched for re-ranking.
+    """
+    paths = _index_paths(path)
+    try:
+        with open(paths["meta"], "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except FileNotFoundError as e:
+        raise IndexFormatError(f"missing index metadata: {paths['meta']}") from e
+    if meta.get("format") != INDEX_FORMAT or meta.get("version") not in READABLE_INDEX_VERSIONS:
+        raise IndexFormatError(
+            f"unsupported index format {meta.get('format')!r} v{meta.get('version')}"
+        )
+
+    # an empty file cannot be mapped
+    matrix = np.load(paths["matrix"], mmap_mode="r" if meta["count"] else None)
+    if matrix.dtype != np.float32 or matrix.shape != (meta["count"], meta["dim"]):
+        raise IndexFormatError(f"index matrix is {matrix.dtype}{matrix.shape}, expected float32")
+    with open(paths["text"], "rb") as f:
+        text_blob = f.read()
+    text_size = max((off + n for _, _, _, off, n, *_ in meta["chunks"]), default=0)
+    if len(text_blob) != text_size:
+        raise IndexFormatError(f"index text is {len(text_blob)} bytes, expected {text_size}")
+    if (INDEX_VERIFY if verify is None else verify) and _checksum(matrix, text_blob) != meta["checksum"]:
+        raise IndexFormatError(f"index checksum mismatch: {paths['matrix']}")
+
+    sources, titles = meta["sources"], meta["titles"]
+    chunks = [
+        RegChunk(key=key, source=sources[s], title=titles[t],
+                 text=text_blob[off : off + n].decode("utf-8"), sha=sha,
+                 sections=rest[0] if rest else [], aliases=rest[1] if len(rest) > 1 else [])
+        for key, s, t, off, n, sha, *rest in meta["chunks"]
+    ]
+    compact = scales = None
+    quantization = quantization or INDEX_QUANTIZATION
+    if quantization != "none" and meta["count"]:
+        qpath = paths[quantization] if quantization in ("float16", "int8") else ""
+        if os.path.exists(qpath):
+            compact = np.load(qpath, mmap_mode="r")
+            if quantization == "int8":
+                scales = np.load(paths["int8_scales"])
+        else:
+            log.warning(f"No {quantization} copy of the index at {qpath!r}; quantizing in memory.")
+            compact, scales = quantize(np.asarray(matrix), quantization)
+        if compact.shape != matrix.shape:
+            raise IndexFormatError(f"{quantization} index copy is {compact.shape}, expected {matrix.shape}")
+    return RegIndex(chunks, matrix, model=meta["model"], files=meta["files"],
+                    next_key=meta["next_key"], chunker=meta.get("chunker", 1),
+                    compact=compact, scales=scales, ivf=_load_ivf(paths["ivf"], matrix, meta),
+                    checksum=meta["checksum"], context_table=_load_context_table(paths["context"], meta),
+                    built_at=meta.get("built_at"), build_seconds=meta.get("build_seconds"))
+
+def _context_seeds_sha() -> str:
+    seeds = {"outcome": OUTCOME_CONTEXT_QUERIES, "doc_type": DOC_TYPE_CONTEXT_QUERIES, "n": CONTEXT_TABLE_TOP_N}
+    return _sha256(json.dumps(seeds, sort_keys=True))
+
+def _load_context_table(path: str, meta: Dict[str, Any]) -> Optional[Dict[str, Dict[str, List[str]]]]:
+    # stale when the index or the seed queries changed since it was computed
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if saved.get("checksum") != meta["checksum"] or saved.get("seeds") != _context_seeds_sha():
+        return None
+    return saved["table"]
+
+def _context_seeds() -> List[tuple]:
+    seeds = [("outcome", o, q, filters_for_outcome(o)) for o, q in OUTCOME_CONTEXT_QUERIES.items()]
+    return seeds + [("doc_type", d, q, None) for d, q in DOC_TYPE_CONTEXT_QUERIES.items()]
+
+def build_context_table(index: RegIndex, client: Any, path: Optional[str] = None,
+                        qvecs: Optional[np.ndarray] = None) -> Dict[str, Dict[str, List[str]]]:
+    """Retrieve the top CONTEXT_TABLE_TOP_N chunks for every seed query (one embeddings
+    request for all of them, or precomputed `qvecs` from the index's model; lexical only
+    without either), attach the table to `index` and, given the index path, persist it."""
+    seeds = _context_seeds()
+    provider = as_provider(client)
+    if provider is not None and provider.model != index.model:
+        provider = None
+    mode = RETRIEVAL_MODE if provider is not None or qvecs is not None else "lexical"
+    if qvecs is None and provider is not None and len(index):
+        qvecs = _embed_queries(provider, [q for _, _, q, _ in seeds], mode)
+    table: Dict[str, Dict[str, List[str]]] = {"outcome": {}, "doc_type": {}}
+    for i, (kind, name, query, filters) in enumerate(seeds):
+        hits = _search_one(index, [query], CONTEXT_TABLE_TOP_N, mode, filters,
+                           qvecs[i : i + 1] if qvecs is not None else None)[0] if len(index) else []
+        table[kind][name] = [c.key for c in hits]
+    index.context_table = table
+    if path and index.checksum:
+        out = _index_paths(path)["context"]
+        with open(out + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"checksum": index.checksum, "seeds": _context_seeds_sha(), "table": table}, f)
+        os.replace(out + ".tmp", out)
+    return table
+
+def base_context(index: Any, outcome: Optional[str] = None, doc_type: Optional[str] = None) -> List[RegChunk]:
+    """Precomputed chunks for a classification and/or document type (a dict lookup, no
+    search). For a ShardedIndex the table of the default shard is used, since the seeds
+    are written for it. Empty when the index has no table."""
+    if isinstance(index, ShardedIndex):
+        index = index.loaded.get(DEFAULT_SHARD)
+    table = index.context_table if index is not None else None
+    if not table:
         return []
-    q_emb = _compute_embeddings(client, [query])[0]
-    q = np.array(q_emb, dtype=np.float32)
-    scored = []
-    for c in index:
-        v = np.array(c.embedding, dtype=np.float32)
-        scored.append((c, _cosine_sim(q, v)))
-    scored.sort(key=lambda x: x[1], reverse=True)
-    return [c for c, _ in scored[:k]]
+    keys = table["outcome"].get(outcome or "", []) + table["doc_type"].get(doc_type or "", [])
+    return [index.chunks[index.rows_by_key[k]] for k in dict.fromkeys(keys) if k in index.rows_by_key]
+
+def _save_ivf(path: str, ivf: Optional[IVFIndex], checksum: str) -> None:
+    # derived data like the compact copies; tagged with the matrix checksum it was built for
+    if ivf is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, centroids=ivf.centroids, offsets=ivf.offsets, rows=ivf.rows,
+                 checksum=np.array(checksum))
+    os.replace(path + ".tmp", path)
+
+def _load_ivf(path: str, matrix: np.ndarray, meta: Dict[str, Any]) -> Optional[IVFIndex]:
+    if ANN_MODE == "exact" or not meta["count"]:
+        return None
+    if os.path.exists(path):
+        with np.load(path) as z:
+            if str(z["checksum"]) == meta["checksum"] and len(z["rows"]) == meta["count"]:
+                return IVFIndex(z["centroids"], z["offsets"], z["rows"])
+        log.warning(f"IVF index at {path!r} is stale; ignoring it.")
+    if not _ann_wanted(meta["count"]):
+        return None
+    log.warning("No IVF index on disk; training one in memory.")
+    return IVFIndex.train(matrix, ANN_NLIST)
+
+def convert_json_index(json_path: str = LEGACY_JSON_PATH, path: str = INDEX_PATH) -> RegIndex:
+    """Migrate a legacy regs_index.json (chunks with inline embedding lists) to the binary format."""
+    with open(json_path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    vectors = [r.pop("embedding") for r in raw]
+    # the JSON cache predates per-file hashes; chunk hashes are recomputed from the text,
+    # and every JSON index was built with EMBED_MODEL
+    chunks = [RegChunk(**r, sha=_sha256(r["text"])) for r in raw]
+    index = RegIndex.from_vectors(chunks, vectors, model=EMBED_MODEL, chunker=1)
+    save_index(index, path)
+    return load_index(path, verify=True)
+
+@dataclass
+class Shard:
+    name: str
+    regs_dir: str
+    index_path: str
+    key_prefix: str = ""  # non-default shards prefix their keys ("AG-S3") so [S#] stays unique
+    legacy_json_path: Optional[str] = None
+
+def default_shard() -> Shard:
+    return Shard(DEFAULT_SHARD, REGS_DIR, INDEX_PATH, "", LEGACY_JSON_PATH)
+
+def discover_shards() -> Dict[str, Shard]:
+    """DEFAULT_SHARD plus one shard per subdirectory of REGS_DIR that holds .md files."""
+    shards = {DEFAULT_SHARD: default_shard()}
+    base = INDEX_PATH[:-4] if INDEX_PATH.endswith(".npy") else INDEX_PATH
+    for d in sorted(glob.glob(os.path.join(REGS_DIR, "*", ""))):
+        name = os.path.basename(os.path.dirname(d))
+        if name in shards or not glob.glob(os.path.join(d, "*.md")):
+            continue
+        prefix = re.sub(r"[^A-Z0-9]", "", name.upper()) + "-"
+        shards[name] = Shard(name, d, f"{base}.{name}.npy", prefix)
+    return shards
+
+def _load_existing_index(shard: Shard, convert: bool = True) -> Optional[RegIndex]:
+    """The shard's built index, or None; `convert` also migrates a legacy JSON index."""
+    if os.path.exists(_index_paths(shard.index_path)["meta"]):
+        try:
+            return load_index(shard.index_path)
+        except (IndexFormatError, OSError, ValueError, KeyError) as e:
+            log.warning(f"Discarding unreadable retrieval index {shard.index_path}: {e}")
+    if convert and shard.legacy_json_path and os.path.exists(shard.legacy_json_path):
+        try:
+            return convert_json_index(shard.legacy_json_path, shard.index_path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f"Discarding unreadable legacy index {shard.legacy_json_path}: {e}")
+    return None
+
+@dataclass
+class _BuildPlan:
+    shard: "Shard"
+    model: str
+    old: Optional[RegIndex]
+    chunks: List[RegChunk]
+    reuse_rows: List[int]  # per chunk: row of the old matrix, or -1 if it needs embedding
+    files: Dict[str, str]
+    next_key: int
+    truncate: Optional[int] = None  # reused rows are cut to this many dims (shortened model)
+    started: float = 0.0            # time.time() when planning began
+
+    @property
+    def missing(self) -> List[int]:
+        return [i for i, r in enumerate(self.reuse_rows) if r < 0]
+
+def _plan_build(shard: "Shard", model: str) -> Any:
+    """The shard's current index if nothing changed, otherwise a _BuildPlan of what to embed
+    with `model` (the embedding provider's model id)."""
+    started = time.time()
+    old = _load_existing_index(shard)
+    docs = _read_files(shard.regs_dir)
+    files = {os.path.basename(d["path"]): d["sha"] for d in docs}
+    if (old is not None and old.model == model and old.files == files
+            and old.chunker == CHUNKER_VERSION):
+        return old
+
+    same_model = old is not None and old.model == model
+    truncate = truncation_dim(old.model, old.dim, model) if old is not None and not same_model else None
+    old_chunks = old.chunks if old is not None else []
+    old_rows_by_sha: Dict[str, int] = {}
+    old_keys: Dict[tuple, List[str]] = {}
+    for i, c in enumerate(old_chunks):
+        old_rows_by_sha.setdefault(c.sha, i)
+        old_keys.setdefault((c.source, c.sha), []).append(c.key)
+    next_key = old.next_key if old is not None else 1
+
+    chunks: List[RegChunk] = []
+    for d in docs:
+        source = os.path.basename(d["path"])
+        for p, section_ids in _chunk(d["content"]):
+            chunks.append(RegChunk(key="", source=source, title=d["title"], text=p,
+                                   sha=_sha256(p), sections=section_ids))
+    chunks, dedup_report = _dedup(chunks)
+
+    reuse_rows: List[int] = []
+    for c in chunks:
+        keys = old_keys.get((c.source, c.sha))
+        if keys:
+            c.key = keys.pop(0)
+        else:
+            c.key = f"{shard.key_prefix}S{next_key}"
+            next_key += 1
+        reuse_rows.append(old_rows_by_sha.get(c.sha, -1) if same_model or truncate else -1)
+    _log_dedup_report(dedup_report)
+    if truncate:
+        log.info(f"Shrinking shard {shard.name} vectors from {old.dim} to {truncate} dims ({old.model} -> {model}).")
+    return _BuildPlan(shard, model, old, chunks, reuse_rows, files, next_key, truncate, started)
+
+def _finish_build(plan: _BuildPlan, new_vecs: Optional[np.ndarray]) -> RegIndex:
+    """Assemble reused and freshly embedded rows, save, and reload memory-mapped."""
+    old, chunks, missing = plan.old, plan.chunks, plan.missing
+    if missing:
+        dim = new_vecs.shape[1]
+    else:
+        dim = plan.truncate or (old.dim if old is not None else 0)
+    matrix = np.zeros((len(chunks), dim), dtype=np.float32)
+    reused = [(i, r) for i, r in enumerate(plan.reuse_rows) if r >= 0]
+    if reused:
+        dst, src = zip(*reused)
+        rows = np.asarray(old.matrix[list(src)])
+        matrix[list(dst)] = _normalize_rows(rows[:, :plan.truncate]) if plan.truncate else rows
+    if missing:
+        matrix[missing] = _normalize_rows(new_vecs)
+
+    old_shas = {c.sha for c in old.chunks} if old is not None else set()
+    dropped = len(old_shas - {c.sha for c in chunks})
+    log.info(
+        f"Retrieval index {plan.shard.name}: {len(chunks)} chunks ({len(reused)} reused, "
+        f"{len(missing)} embedded, {dropped} dropped)."
+    )
+    index = RegIndex(chunks, matrix, model=plan.model, files=plan.files, next_key=plan.next_key,
+                     built_at=time.time(), build_seconds=round(time.time() - plan.started, 3))
+    save_index(index, plan.shard.index_path)
+    checkpoint = _index_paths(plan.shard.index_path)["checkpoint"]
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return load_index(plan.shard.index_path, verify=True)
+
+def _stale_or_fail(plan: _BuildPlan) -> RegIndex:
+    if plan.old is not None:
+        log.warning(f"{len(plan.missing)} chunks of shard {plan.shard.name} changed but no embedding provider; "
+                    "serving the stale index.")
+        return plan.old
+    raise RuntimeError("An embedding client (or EMBED_PROVIDER=local|fixture) is required to build the retrieval index")
+
+def build_or_load_index(client: Any, shard: Optional["Shard"] = None) -> RegIndex:
+    """Load the index, re-embedding only new or changed chunks of backend/regs.
+
+    Unchanged files are reused wholesale (per-file hash). In changed files, a chunk whose
+    text hash was already indexed keeps its vector, and keeps its key if it is still in
+    the same source file, so [S#] citations saved with old projects stay valid. Chunks
+    that no longer exist are dropped. Changing the embedding model or provider re-embeds
+    everything but still preserves keys.
+
+    `client` is an OpenAI client or an EmbeddingProvider; EMBED_PROVIDER=local|fixture
+    builds without one. `shard` defaults to the top-level backend/regs corpus.
+    """
+    shard = shard or default_shard()
+    provider = as_provider(client)
+    plan = _plan_build(shard, provider.model if provider is not None else model_id(EMBED_MODEL, EMBED_DIMENSIONS))
+    if isinstance(plan, RegIndex):
+        return _with_context_table(plan, provider, shard)
+    missing = plan.missing
+    if missing and provider is None:
+        return _stale_or_fail(plan)
+    new_vecs = embed_texts(provider, [plan.chunks[i].text for i in missing],
+                           shas=[plan.chunks[i].sha for i in missing],
+                           checkpoint_path=_index_paths(plan.shard.index_path)["checkpoint"]) if missing else None
+    return _with_context_table(_finish_build(plan, new_vecs), provider, shard)
+
+def _with_context_table(index: RegIndex, client: Any, shard: "Shard") -> RegIndex:
+    # computed once per index version (persisted); the default shard only, as the seeds are CO-specific
+    if index.context_table is None and shard.name == DEFAULT_SHARD:
+        try:
+            build_context_table(index, client, shard.index_path)
+        except Exception as e:
+            log.warning(f"Could not precompute the base-context table: {e}")
+    return index
+
+async def build_or_load_index_async(client: Any, shard: Optional["Shard"] = None) -> RegIndex:
+    """build_or_load_index on an AsyncOpenAI client; file and CPU work runs in a thread."""
+    shard = shard or default_shard()
+    provider = as_provider(client)
+    plan = await asyncio.to_thread(_plan_build, shard, provider.model if provider is not None else model_id(EMBED_MODEL, EMBED_DIMENSIONS))
+    if isinstance(plan, RegIndex):
+        return await _with_context_table_async(plan, provider, shard)
+    missing = plan.missing
+    if missing and provider is None:
+        return _stale_or_fail(plan)
+    new_vecs = await embed_texts_async(provider, [plan.chunks[i].text for i in missing],
+                                       shas=[plan.chunks[i].sha for i in missing],
+                                       checkpoint_path=_index_paths(plan.shard.index_path)["checkpoint"]) if missing else None
+    index = await asyncio.to_thread(_finish_build, plan, new_vecs)
+    return await _with_context_table_async(index, provider, shard)
+
+async def _with_context_table_async(index: RegIndex, client: Any, shard: "Shard") -> RegIndex:
+    if index.context_table is None and shard.name == DEFAULT_SHARD:
+        try:
+            qvecs = None
+            provider = as_provider(client)
+            if provider is not None and provider.model == index.model and len(index):
+                qvecs = await _embed_queries_async(provider, [q for _, _, q, _ in _context_seeds()], RETRIEVAL_MODE)
+            await asyncio.to_thread(build_context_table, index, None, shard.index_path, qvecs)
+        except Exception as e:
+            log.warning(f"Could not precompute the base-context table: {e}")
+    return index
+
+def _build_shard(client: Any, shard: Shard) -> Optional[RegIndex]:
+    try:
+        return build_or_load_index(client, shard)
+    except Exception as e:
+        log.warning(f"Retrieval shard {shard.name} unavailable: {e}")
+        return None
+
+class ShardedIndex:
+    """The corpus as named shards, each a RegIndex.
+
+    Shards are built by open_corpus() and rebuilt(), never while serving a search. A
+    shard that isn't in memory yet is memory-mapped from its index files the first time
+    it is searched, so only shards in use occupy memory; one with no usable index files
+    is skipped. A shard's BM25 index is built before it serves (warm()). Instances are
+    not modified by rebuilds: rebuilt() returns a new ShardedIndex that shares the
+    untouched shards, so a caller holding this one keeps a consistent view.
+    """
+
+    def __init__(self, shards: Dict[str, Shard], client: Optional[OpenAI] = None,
+                 loaded: Optional[Dict[str, RegIndex]] = None):
+        self.shards = shards
+        self.client = client
+        self._loaded: Dict[str, RegIndex] = dict(loaded or {})
+        self._unavailable: set = set()  # shards whose index files could not be loaded
+        self._lock = threading.Lock()
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.shards)
+
+    @property
+    def loaded(self) -> Dict[str, RegIndex]:
+        return dict(self._loaded)
+
+    def shard(self, name: str) -> Optional[RegIndex]:
+        """The shard's index, loading its built files on first use; None if it is unknown
+        or has no usable index files."""
+        index = self._loaded.get(name)
+        if index is not None or name not in self.shards or name in self._unavailable:
+            return index
+        with self._lock:
+            index = self._loaded.get(name)
+            if index is None and name not in self._unavailable:
+                index = _load_existing_index(self.shards[name], convert=False)
+                if index is None:
+                    log.warning(f"Retrieval shard {name} has no usable index; skipped until a rebuild")
+                    self._unavailable.add(name)
+                else:
+                    index.lexical  # BM25 before the shard is visible to other requests
+                    self._loaded[name] = index
+        return index
+
+    def warm(self) -> "ShardedIndex":
+        """Build the BM25 index of every loaded shard now; returns self."""
+        for index in self._loaded.values():
+            index.lexical
+        return self
+
+    def resolve(self, names: Optional[List[str]] = None) -> List[str]:
+        """Shard names to search: `names`, else RETRIEVAL_SHARDS, else all; unknown names are dropped."""
+        wanted = names or RETRIEVAL_SHARDS or self.names
+        return [n for n in wanted if n in self.shards]
+
+    def locate(self, key: str) -> Optional[tuple]:
+        """(shard index, row) of a chunk key among the loaded shards."""
+        for index in self._loaded.values():
+            row = index.rows_by_key.get(key)
+            if row is not None:
+                return index, row
+        return None
+
+    def rebuilt(self, client: Optional[OpenAI], names: Optional[List[str]] = None) -> "ShardedIndex":
+        """A new ShardedIndex with `names` (default: every loaded shard) rebuilt from their
+        regs; other loaded shards are carried over as they are. Shard directories are
+        rediscovered, and the index files of shards not in memory are brought up to date
+        (new or previously failed shards included) without loading them."""
+        shards = discover_shards()
+        loaded = {n: i for n, i in self._loaded.items() if n in shards}
+        for name in (names if names is not None else list(loaded)):
+            if name not in shards:
+                raise KeyError(f"unknown retrieval shard {name!r}")
+            loaded[name] = build_or_load_index(client, shards[name])
+        for name in shards:
+            if name not in loaded:
+                _build_shard(client, shards[name])
+        return ShardedIndex(shards, client, loaded).warm()
+
+    @property
+    def version(self) -> str:
+        """Content id over the loaded shards' versions."""
+        ids = ",".join(f"{n}={i.version}" for n, i in sorted(self._loaded.items()))
+        return hashlib.sha256(ids.encode("utf-8")).hexdigest()[:12] if ids else "empty"
+
+    def stats(self) -> Dict[str, Any]:
+        """RegIndex.stats() per shard (None for shards not in memory: never searched, or
+        without usable index files), with totals over the loaded shards."""
+        loaded = self.loaded
+        return {
+            "version": self.version,
+            "chunks": len(self),
+            "memory_bytes": sum(sum(v for v in i.stats()["memory"].values() if not isinstance(v, bool))
+                                for i in loaded.values()),
+            "shards": {name: (loaded[name].stats() if name in loaded else None) for name in self.names},
+        }
+
+    def __len__(self) -> int:
+        return sum(len(i) for i in self._loaded.values())
+
+    def __bool__(self) -> bool:
+        return bool(self.shards)
+
+def open_corpus(client: Any, preload: Optional[List[str]] = None) -> ShardedIndex:
+    """ShardedIndex over discover_shards(). Every shard's index files are built, or
+    rebuilt where its regs changed; only `preload` (default: RETRIEVAL_SHARDS, else
+    DEFAULT_SHARD) stays in memory, the rest are loaded on first use."""
+    shards = discover_shards()
+    keep = set(preload if preload is not None else (RETRIEVAL_SHARDS or [DEFAULT_SHARD]))
+    loaded = {}
+    for name, shard in shards.items():
+        index = _build_shard(client, shard)
+        if index is not None and name in keep:
+            loaded[name] = index
+    return ShardedIndex(shards, client, loaded).warm()
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Row ids of the k highest scores, best first (argpartition, then sort only the k)."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+class _QueryVectorStore(CacheStore):
+    """Tier 2 of QUERY_CACHE: one SQLite connection, its I/O serialized by its own lock."""
+
+    label = "disk"
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT, dim INTEGER, vec BLOB, used_at REAL)"
+            )
+            self._db = db
+        return self._db
+
+    def load(self, keys: List[str], now: float) -> Dict[str, tuple]:
+        with self._lock:
+            db = self._conn()
+            rows = db.execute(
+                f"SELECT key, vec FROM query_embeddings WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchall()
+            if rows:
+                db.execute(f"UPDATE query_embeddings SET used_at = ? WHERE key IN "
+                           f"({','.join('?' * len(rows))})", [now, *(k for k, _ in rows)])
+                db.commit()
+        return {k: (np.frombuffer(v, dtype=np.float32), None) for k, v in rows}
+
+    def save(self, items: List[tuple], now: float, model: str = "") -> None:
+        rows = [(k, model, int(v.shape[0]), v.tobytes(), now) for k, v in items]
+        with self._lock:
+            db = self._conn()
+            db.executemany("INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            db.execute(
+                "DELETE FROM query_embeddings WHERE key IN (SELECT key FROM query_embeddings "
+                "ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (QUERY_CACHE_DISK_MAX,)
+            )
+            db.commit()
+
+    def wipe(self) -> None:
+        with self._lock:
+            db = self._conn()
+            db.execute("DELETE FROM query_embeddings")
+            db.commit()
+
+class QueryEmbeddingCache:
+    """Unit query vectors keyed on sha256(model + normalized query).
+
+    A TieredCache: an LRU of `max_entries` whose entries expire after `ttl` seconds, in
+    front of a SQLite table at `path` (no TTL: a model's embedding of a string doesn't
+    change), trimmed to QUERY_CACHE_DISK_MAX rows by last use.
+    """
+
+    def __init__(self, path: Optional[str], max_entries: int, ttl: float):
+        self.path = path
+        self._cache = TieredCache(_QueryVectorStore(path) if path else None, max_entries, ttl,
+                                  "Query embedding cache")
+
+    @staticmethod
+    def key(query: str, model: str) -> str:
+        # case and whitespace don't move an embedding enough to be worth a request
+        normalized = " ".join(query.split()).casefold()
+        return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get_many(self, queries: List[str], model: Optional[str] = None) -> List[Optional[np.ndarray]]:
+        """Cached vector per query, or None for a miss."""
+        model = model or EMBED_MODEL
+        return self._cache.get_many([self.key(q, model) for q in queries])
+
+    def put_many(self, queries: List[str], vecs: np.ndarray, model: Optional[str] = None) -> None:
+        model = model or EMBED_MODEL
+        items = [(self.key(q, model), np.ascontiguousarray(v, dtype=np.float32)) for q, v in zip(queries, vecs)]
+        self._cache.put_many(items, model=model)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+QUERY_CACHE = QueryEmbeddingCache(QUERY_CACHE_PATH, QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def query_cache_stats() -> Dict[str, Any]:
+    return QUERY_CACHE.stats()
+
+def _with_cached(queries: List[str], cached: List[Optional[np.ndarray]],
+                 fresh: Dict[str, np.ndarray]) -> np.ndarray:
+    return np.stack([v if v is not None else fresh[q] for q, v in zip(queries, cached)]).astype(np.float32, copy=False)
+
+def _embed_queries(provider: Optional[EmbeddingProvider], queries: List[str], mode: str) -> Optional[np.ndarray]:
+    """Unit query vectors (m, dim), from the cache or one embeddings request for the
+    misses; None when the mode doesn't need them or (hybrid only) the request failed.
+    Dense mode without a provider is a ValueError (hybrid falls back to lexical)."""
+    if mode == "lexical" or (mode == "hybrid" and provider is None):
+        return None
+    if provider is None:
+        raise ValueError("dense retrieval requires an embedding provider (a client, or EMBED_PROVIDER=local|fixture)")
+    cached = QUERY_CACHE.get_many(queries, provider.model)
+    misses = list(dict.fromkeys(q for q, v in zip(queries, cached) if v is None))
+    fresh: Dict[str, np.ndarray] = {}
+    if misses:
+        if mode == "dense":
+            vecs = _normalize_rows(provider.embed(misses)[0])
+        else:
+            try:
+                vecs = _normalize_rows(provider.with_timeout(QUERY_EMBED_TIMEOUT).embed(misses)[0])
+            except Exception as e:
+                log.warning(f"Query embedding failed; using lexical retrieval only: {e}")
+                return None
+        QUERY_CACHE.put_many(misses, vecs, provider.model)
+        fresh = dict(zip(misses, vecs))
+    return _with_cached(queries, cached, fresh)
+
+async def _embed_queries_async(provider: Optional[EmbeddingProvider], queries: List[str],
+                               mode: str) -> Optional[np.ndarray]:
+    """_embed_queries with the request awaited (embed_async). Cache lookups and writes hit
+    SQLite under a lock shared with request threads, so they run in a worker thread."""
+    if mode == "lexical" or (mode == "hybrid" and provider is None):
+        return None
+    if provider is None:
+        raise ValueError("dense retrieval requires an embedding provider (a client, or EMBED_PROVIDER=local|fixture)")
+    cached = await asyncio.to_thread(QUERY_CACHE.get_many, queries, provider.model)
+    misses = list(dict.fromkeys(q for q, v in zip(queries, cached) if v is None))
+    fresh: Dict[str, np.ndarray] = {}
+    if misses:
+        try:
+            limited = provider.with_timeout(QUERY_EMBED_TIMEOUT) if mode == "hybrid" else provider
+            vecs = _normalize_rows((await limited.embed_async(misses))[0])
+        except Exception as e:
+            if mode == "dense":
+                raise
+            log.warning(f"Query embedding failed; using lexical retrieval only: {e}")
+            return None
+        await asyncio.to_thread(QUERY_CACHE.put_many, misses, vecs, provider.model)
+        fresh = dict(zip(misses, vecs))
+    return _with_cached(queries, cached, fresh)
+
+_MODEL_MISMATCH_WARNED: set = set()
+
+def _usable_query_vectors(index: RegIndex, qvecs: Optional[np.ndarray], qmodel: Optional[str],
+                          mode: str) -> Optional[np.ndarray]:
+    """qvecs if they come from the model the index was built with; otherwise None
+    (hybrid degrades to lexical) or, in dense mode, an error."""
+    if qvecs is None or qmodel is None or qmodel == index.model:
+        return qvecs
+    if mode == "dense":
+        raise ValueError(f"query embedded with {qmodel!r} but the index was built with {index.model!r}")
+    if (qmodel, index.model) not in _MODEL_MISMATCH_WARNED:
+        _MODEL_MISMATCH_WARNED.add((qmodel, index.model))
+        log.warning(f"Index built with {index.model!r}, queries embedded with {qmodel!r}; dense search disabled.")
+    return None
+
+def _rrf(rankings: List[np.ndarray], n: int) -> np.ndarray:
+    """Reciprocal rank fusion of several best-first row-id lists into one score vector."""
+    fused = np.zeros(n, dtype=np.float32)
+    for ranked in rankings:
+        fused[ranked] += 1.0 / (RRF_K + 1 + np.arange(len(ranked), dtype=np.float32))
+    return fused
+
+def _rank(index: RegIndex, query: str, n: int, mode: str, rows: Optional[np.ndarray],
+          dense_hit: Optional[tuple]) -> tuple:
+    """(best-first row ids (up to n), their ranking scores, BM25 score vector or None)
+    for `query` under the given retrieval mode.
+
+    `rows` (ascending row ids) restricts the candidates; None searches everything.
+    `dense_hit` is the query's best-first dense (rows, scores), None if unavailable.
+    """
+    if mode == "dense":
+        return dense_hit[0][:n], dense_hit[1][:n], None
+    lex = index.lexical.scores(query)
+    if rows is not None:
+        masked = np.zeros_like(lex)
+        masked[rows] = lex[rows]
+        lex = masked
+    # only rows sharing at least one term take part in the lexical ranking
+    lex_ranked = _top_k(lex, min(_depth(n), int(np.count_nonzero(lex))))
+    if mode == "lexical" or dense_hit is None:
+        return lex_ranked[:n], lex[lex_ranked[:n]], lex
+    fused = _rrf([dense_hit[0], lex_ranked], len(index))
+    top = _top_k(fused, min(n, int(np.count_nonzero(fused))))
+    return top, fused[top], lex
+
+def _depth(n: int) -> int:
+    # candidates taken from each ranking before fusion
+    return max(4 * n, 50)
+
+def _check_mode(mode: Optional[str]) -> str:
+    mode = mode or RETRIEVAL_MODE
+    if mode not in ("dense", "lexical", "hybrid"):
+        raise ValueError(f"unknown retrieval mode {mode!r}")
+    return mode
+
+@dataclass
+class RetrievalHit:
+    chunk: RegChunk
+    score: Optional[float]           # the mode's ranking score: cosine, BM25 or fused RRF; None if pinned
+    dense: Optional[float] = None    # cosine similarity to the query, when it was embedded
+    lexical: Optional[float] = None  # BM25 score, when lexical scoring ran
+    pinned: bool = False             # a section cited in the query, placed ahead of the ranking
+    shard: Optional[str] = None
+
+class RetrievalResult(list):
+    """The top-k RegChunks, best first (a plain list to callers that only want chunks),
+    plus diagnostics: `hits` (per-chunk scores) and `timings` in ms per stage:
+    embed (query embedding, cache included), score (dense + lexical scoring), select
+    (citation pinning, fusion and shard merging) and total. Stage timings cover the
+    whole retrieve_many batch the query was part of."""
+
+    def __init__(self, hits: Optional[List[RetrievalHit]] = None, timings: Optional[Dict[str, float]] = None,
+                 mode: str = "", version: str = ""):
+        self.hits = list(hits or [])
+        super().__init__(h.chunk for h in self.hits)
+        self.timings = dict(timings or {})
+        self.mode = mode
+        self.version = version
+
+    def debug(self) -> Dict[str, Any]:
+        """JSON-ready diagnostics, for API responses."""
+        def num(v):
+            return round(float(v), 4) if v is not None else None
+        return {
+            "mode": self.mode,
+            "index_version": self.version,
+            "timings_ms": {stage: round(ms, 2) for stage, ms in self.timings.items()},
+            "hits": [{"key": h.chunk.key, "source": h.chunk.source, "score": num(h.score),
+                      "dense": num(h.dense), "lexical": num(h.lexical), "pinned": h.pinned,
+                      **({"shard": h.shard} if h.shard else {})} for h in self.hits],
+        }
+
+def _retrieve_with(index: RegIndex, queries: List[str], k: int, mode: str, rows: Optional[np.ndarray],
+                   qvecs: Optional[np.ndarray], qmodel: Optional[str] = None) -> List[RetrievalResult]:
+    """The CPU half of retrieve_many, given the query vectors (or None) and their model."""
+    qvecs = _usable_query_vectors(index, qvecs, qmodel, mode)
+    allowed = set(rows.tolist()) if rows is not None else None
+    n = k + max(1, k // 2)  # room for pinned citations
+    started = time.perf_counter()
+    dense = index.dense_top_many(qvecs, _depth(n), rows) if qvecs is not None else [None] * len(queries)
+    score_s = time.perf_counter() - started
+    select_s = 0.0
+
+    results = []
+    for j, (query, dense_hit) in enumerate(zip(queries, dense)):
+        t0 = time.perf_counter()
+        cited = [r for r in resolve_citations(index, query) if allowed is None or r in allowed]
+        pinned = cited[: max(1, k // 2)]
+        t1 = time.perf_counter()
+        ranked, scores, lex = _rank(index, query, k + len(pinned), mode, rows, dense_hit)
+        t2 = time.perf_counter()
+        score_of = {int(r): float(v) for r, v in zip(ranked, scores)}
+        out = (pinned + [r for r in score_of if r not in pinned])[:k]
+        # exact cosines for the k winners (quantized / fused rankings don't carry them)
+        cos = np.asarray(index.matrix[out]) @ qvecs[j] if qvecs is not None and out else None
+        hits = [RetrievalHit(index.chunks[r], None if r in pinned else score_of.get(r),
+                             dense=float(cos[i]) if cos is not None else None,
+                             lexical=float(lex[r]) if lex is not None else None, pinned=r in pinned)
+                for i, r in enumerate(out)]
+        results.append(RetrievalResult(hits, mode=mode, version=index.version))
+        select_s += (t1 - t0) + (time.perf_counter() - t2)
+        score_s += t2 - t1
+    for result in results:
+        result.timings.update(score=1000 * score_s, select=1000 * select_s)
+    return results
+
+_SHARD_POOL: Optional[ThreadPoolExecutor] = None
+_SHARD_POOL_LOCK = threading.Lock()
+
+def _shard_pool() -> ThreadPoolExecutor:
+    global _SHARD_POOL
+    with _SHARD_POOL_LOCK:
+        if _SHARD_POOL is None:
+            _SHARD_POOL = ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix="reg-shard")
+        return _SHARD_POOL
+
+def _search_one(index: RegIndex, queries: List[str], k: int, mode: str, filters: Optional[Dict[str, Any]],
+                qvecs: Optional[np.ndarray], qmodel: Optional[str] = None) -> List[RetrievalResult]:
+    started = time.perf_counter()
+    rows = index.select(filters)
+    if rows is not None and not len(rows):
+        return [RetrievalResult(mode=mode, version=index.version) for _ in queries]
+    results = _retrieve_with(index, queries, k, mode, rows, qvecs, qmodel)
+    for result in results:
+        result.timings["select"] += 1000 * (time.perf_counter() - started) - sum(result.timings.values())
+    return results
+
+def _search_shards(corpus: ShardedIndex, queries: List[str], k: int, mode: str,
+                   filters: Optional[Dict[str, Any]], names: List[str],
+                   qvecs: Optional[np.ndarray], qmodel: Optional[str] = None) -> List[RetrievalResult]:
+    """Search each shard (in parallel when several) and merge the per-shard top-k lists.
+
+    In dense mode, with every shard embedded by the same model, cosine scores are
+    comparable and the lists are merged by score. BM25 and fused scores aren't (idf is
+    per shard), so otherwise the lists are merged by rank, round-robin in shard order,
+    like a reciprocal-rank fusion. Pinned citations go first either way. Stage timings
+    are the slowest shard's (they run concurrently), plus the merge.
+    """
+    named = [(n, i) for n, i in ((n, corpus.shard(n)) for n in names) if i]
+    if not named:
+        return [RetrievalResult(mode=mode, version=corpus.version) for _ in queries]
+    if len(named) == 1:
+        per_shard = [_search_one(named[0][1], queries, k, mode, filters, qvecs, qmodel)]
+    else:
+        per_shard = list(_shard_pool().map(
+            lambda i: _search_one(i, queries, k, mode, filters, qvecs, qmodel), [i for _, i in named]))
+    by_score = mode == "dense" and len({i.model for _, i in named}) == 1
+    merged = []
+    for j in range(len(queries)):
+        started = time.perf_counter()
+        lists = [(name, results[j]) for (name, _), results in zip(named, per_shard)]
+        for name, result in lists:
+            for hit in result.hits:
+                hit.shard = name
+        hits = [result.hits[rank] for rank in range(k) for _, result in lists if rank < len(result.hits)]
+        if by_score:
+            # stable: pinned hits keep their round-robin order ahead of the scored ones
+            hits.sort(key=lambda h: (not h.pinned, -(h.score or 0.0) if not h.pinned else 0.0))
+        timings = {stage: max(result.timings.get(stage, 0.0) for _, result in lists) for stage in ("score", "select")}
+        timings["select"] += 1000 * (time.perf_counter() - started)
+        merged.append(RetrievalResult(hits[:k], timings, mode, corpus.version))
+    return merged
+
+def _stamp(results: List[RetrievalResult], started: float, embed_s: float) -> List[RetrievalResult]:
+    """Add the embed stage and the end-to-end total to each result's timings."""
+    total = 1000 * (time.perf_counter() - started)
+    for result in results:
+        result.timings = {"embed": 1000 * embed_s, **result.timings, "total": total}
+    return results
+
+def retrieve_many(client: Optional[OpenAI], index: Optional[RegIndex], queries: List[str], k: int = 4,
+                  mode: Optional[str] = None, filters: Optional[Dict[str, Any]] = None,
+                  shards: Optional[List[str]] = None) -> List[RetrievalResult]:
+    """retrieve() for several queries: one embeddings request, one matrix-matrix product.
+
+    Returns one top-k RetrievalResult per query, in order. `filters` applies to every
+    query. `index` may be a RegIndex or a ShardedIndex; for the latter, `shards` picks
+    the shards searched (default ShardedIndex.resolve()).
+    """
+    mode = _check_mode(mode)
+    if not index or not queries:
+        return [RetrievalResult(mode=mode) for _ in queries]
+    started = time.perf_counter()
+    provider = as_provider(client)
+    qmodel = provider.model if provider is not None else None
+    if isinstance(index, ShardedIndex):
+        names = index.resolve(shards)
+        if not names:
+            return [RetrievalResult(mode=mode) for _ in queries]
+        qvecs = _embed_queries(provider, queries, mode)
+        embed_s = time.perf_counter() - started
+        return _stamp(_search_shards(index, queries, k, mode, filters, names, qvecs, qmodel), started, embed_s)
+    if qmodel is not None and qmodel != index.model and mode == "hybrid":
+        provider = None  # vectors from another model are useless here; skip the request
+    qvecs = _embed_queries(provider, queries, mode)
+    embed_s = time.perf_counter() - started
+    return _stamp(_search_one(index, queries, k, mode, filters, qvecs, qmodel), started, embed_s)
+
+async def retrieve_many_async(client: Optional[AsyncOpenAI], index: Optional[RegIndex], queries: List[str],
+                              k: int = 4, mode: Optional[str] = None, filters: Optional[Dict[str, Any]] = None,
+                              shards: Optional[List[str]] = None) -> List[RetrievalResult]:
+    """retrieve_many on an AsyncOpenAI client. The query embedding is awaited; scoring
+    runs inline for small indexes and in a worker thread once the matrix is large
+    enough (ASYNC_SCORE_OFFLOAD elements) to hold up the event loop."""
+    mode = _check_mode(mode)
+    if not index or not queries:
+        return [RetrievalResult(mode=mode) for _ in queries]
+    started = time.perf_counter()
+    provider = as_provider(client)
+    qmodel = provider.model if provider is not None else None
+    if isinstance(index, ShardedIndex):
+        names = index.resolve(shards)
+        if not names:
+            return [RetrievalResult(mode=mode) for _ in queries]
+        qvecs = await _embed_queries_async(provider, queries, mode)
+        embed_s = time.perf_counter() - started
+        # shard loading and the fan-out both block, so they always leave the loop
+        results = await asyncio.to_thread(_search_shards, index, queries, k, mode, filters, names, qvecs, qmodel)
+        return _stamp(results, started, embed_s)
+    if qmodel is not None and qmodel != index.model and mode == "hybrid":
+        provider = None
+    qvecs = await _embed_queries_async(provider, queries, mode)
+    embed_s = time.perf_counter() - started
+    if len(index) * max(index.dim, 1) * len(queries) >= ASYNC_SCORE_OFFLOAD:
+        results = await asyncio.to_thread(_search_one, index, queries, k, mode, filters, qvecs, qmodel)
+    else:
+        results = _search_one(index, queries, k, mode, filters, qvecs, qmodel)
+    return _stamp(results, started, embed_s)
+
+async def retrieve_async(client: Optional[AsyncOpenAI], index: Optional[RegIndex], query: str, k: int = 4,
+                         mode: Optional[str] = None, filters: Optional[Dict[str, Any]] = None,
+                         shards: Optional[List[str]] = None) -> RetrievalResult:
+    """retrieve() on an AsyncOpenAI client; see retrieve_many_async."""
+    return (await retrieve_many_async(client, index, [query], k, mode, filters, shards))[0]
+
+def retrieve(client: Optional[OpenAI], index: Optional[RegIndex], query: str, k: int = 4,
+             mode: Optional[str] = None, filters: Optional[Dict[str, Any]] = None,
+             shards: Optional[List[str]] = None) -> RetrievalResult:
+    """Top-k chunks for `query` from a RegIndex or a ShardedIndex.
+
+    The result is a list of RegChunks, best first, that also carries each chunk's scores
+    (`.hits`), per-stage `.timings` in ms and `.debug()` for API responses.
+
+    mode: "dense" (embeddings only; ValueError without a provider), "lexical" (BM25
+    only; no network, `client` may be None) or "hybrid" (both, fused by reciprocal rank;
+    degrades to lexical if the query embedding fails or times out). Defaults to
+    RETRIEVAL_MODE.
+
+    filters: {facet: value(s)} over FACETS, e.g. {"outcome": "outcome8", "role": "deployer"}
+    or filters_for_outcome("outcome8"); only matching chunks are scored.
+
+    Statute sections cited explicitly in the query ("§ 6-1-1703(4)") are looked up in
+    the section table and take up to half of the k slots ahead of the ranked results.
+
+    shards: names of the ShardedIndex shards to search, in parallel (default: all, or
+    RETRIEVAL_SHARDS); each returns its own top-k and the lists are merged by rank.
+    """
+    return retrieve_many(client, index, [query], k, mode, filters, shards)[0]
+
+@dataclass
+class PackedContext:
+    text: str
+    chunks: List[RegChunk]  # the chunks that made it into `text`, in prompt order
+    tokens: int
+
+def _mmr_order(sim: np.ndarray, relevance: np.ndarray, lam: float) -> List[int]:
+    """Maximal marginal relevance ordering of all candidates (vectorized over candidates)."""
+    m = len(relevance)
+    picked: List[int] = []
+    max_sim = np.full(m, -np.inf, dtype=np.float32)
+    free = np.ones(m, dtype=bool)
+    for _ in range(m):
+        novelty = np.where(np.isfinite(max_sim), max_sim, 0.0)
+        score = np.where(free, lam * relevance - (1 - lam) * novelty, -np.inf)
+        j = int(np.argmax(score))
+        picked.append(j)
+        free[j] = False
+        max_sim = np.maximum(max_sim, sim[j])
+    return picked
+
+def _overlap(a: str, b: str, max_chars: int = 400) -> int:
+    """Length of the longest suffix of `a` that is a prefix of `b` (windowed chunkers repeat text)."""
+    for n in range(min(len(a), len(b), max_chars), 20, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+def _locate(index: Any, key: str) -> Optional[tuple]:
+    if isinstance(index, ShardedIndex):
+        return index.locate(key)
+    row = index.rows_by_key.get(key) if index is not None else None
+    return (index, row) if row is not None else None
+
+def pack_context(index: Optional[RegIndex], chunks: List[RegChunk], budget: Optional[int] = None,
+                 mmr_lambda: Optional[float] = None) -> PackedContext:
+    """Prompt context from retrieved `chunks` (best first) within `budget` tokens.
+
+    Candidates are taken in MMR order (rank relevance vs cosine similarity to chunks
+    already taken) and added greedily while they fit the budget; a chunk that doesn't
+    fit is skipped in favour of smaller ones. Chosen chunks that sit next to each other
+    in the same source are merged under one header with the repeated overlap removed,
+    and every merged key stays in the header so [S#] citations still resolve.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    lam = CONTEXT_MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+    chunks = list({c.key: c for c in chunks}.values())
+    if not chunks:
+        return PackedContext("", [], 0)
+
+    # (shard index, row) per chunk; rows of different shards are never adjacent
+    located = [_locate(index, c.key) for c in chunks]
+    rows = [(id(loc[0]), loc[1]) if loc is not None else None for loc in located]
+    sim = np.zeros((len(chunks), len(chunks)), dtype=np.float32)
+    known = [i for i, loc in enumerate(located) if loc is not None and loc[0].dim]
+    if known and len({located[i][0].dim for i in known}) == 1:
+        vecs = np.stack([np.asarray(located[i][0].matrix[located[i][1]], dtype=np.float32) for i in known])
+        sim[np.ix_(known, known)] = vecs @ vecs.T
+    relevance = np.linspace(1.0, 0.0, len(chunks), endpoint=False, dtype=np.float32)
+
+    chosen: List[int] = []
+    used = 0
+    for i in _mmr_order(sim, relevance, lam):
+        # priced as rendered on its own, header and separator included; merging only saves
+        c = chunks[i]
+        cost = _estimate_tokens(f"[{c.key}] {c.title} — {c.source}\n{c.text.strip()}\n") + 1
+        if used + cost <= budget or not chosen:  # always keep the best chunk
+            chosen.append(i)
+            used += cost
+
+    # merge runs of consecutive index rows from one source; blocks keep MMR order of their first member
+    position = {i: n for n, i in enumerate(chosen)}
+    by_row = sorted((i for i in chosen if rows[i] is not None), key=lambda i: rows[i])
+    blocks: List[List[int]] = [[i] for i in chosen if rows[i] is None]
+    for i in by_row:
+        prev = blocks[-1][-1] if blocks and rows[blocks[-1][-1]] is not None else None
+        if (prev is not None and rows[i] == (rows[prev][0], rows[prev][1] + 1)
+                and chunks[i].source == chunks[prev].source):
+            blocks[-1].append(i)
+        else:
+            blocks.append([i])
+    blocks.sort(key=lambda b: min(position[i] for i in b))
+
+    parts, included = [], []
+    for block in blocks:
+        first = chunks[block[0]]
+        text = first.text.strip()
+        for i in block[1:]:
+            nxt = chunks[i].text.strip()
+            text = text + "\n" + nxt[_overlap(text, nxt):]
+        keys = "".join(f"[{chunks[i].key}]" for i in block)
+        parts.append(f"{keys} {first.title} — {first.source}\n{text}\n")
+        included.extend(chunks[i] for i in block)
+    out = "\n".join(parts)
+    return PackedContext(out, included, _estimate_tokens(out))
+
+def measure_quantization_recall(index: RegIndex, queries: Optional[np.ndarray] = None,
+                                k: int = 5) -> Dict[str, Dict[str, float]]:
+    """Recall@k of float16/int8 search (coarse scan + float32 re-rank) vs exact float32.
+
+    `queries` defaults to the index's own vectors, i.e. every chunk asks for its neighbours.
+    """
+    exact_matrix = np.asarray(index.matrix)
+    queries = exact_matrix if queries is None else np.asarray(queries, dtype=np.float32)
+    truth = [set(_top_k(exact_matrix @ q, k).tolist()) for q in queries]
+    report: Dict[str, Dict[str, float]] = {}
+    for kind in ("float16", "int8"):
+        compact, scales = quantize(exact_matrix, kind)
+        qindex = RegIndex(index.chunks, exact_matrix, compact=compact, scales=scales)
+        started = time.perf_counter()
+        hits = sum(len(t & set(qindex.dense_top(q, k)[0].tolist())) for t, q in zip(truth, queries))
+        elapsed = time.perf_counter() - started
+        report[kind] = {
+            "recall_at_k": hits / max(1, sum(len(t) for t in truth)),
+            "matrix_bytes": compact.nbytes + (scales.nbytes if scales is not None else 0),
+            "ms_per_query": 1000 * elapsed / max(1, len(queries)),
+        }
+    report["float32"] = {"recall_at_k": 1.0, "matrix_bytes": exact_matrix.nbytes}
+    return report
+
+def measure_ann_recall(index: RegIndex, queries: Optional[np.ndarray] = None, k: int = 5,
+                       nprobes=(1, 4, 16, 64)) -> Dict[str, Dict[str, float]]:
+    """Recall@k and latency of IVF search at several nprobe settings vs exact search."""
+    exact_matrix = np.asarray(index.matrix)
+    queries = exact_matrix if queries is None else np.asarray(queries, dtype=np.float32)
+    ivf = index.ivf or IVFIndex.train(exact_matrix, ANN_NLIST)
+    started = time.perf_counter()
+    truth = [set(_top_k(exact_matrix @ q, k).tolist()) for q in queries]
+    report: Dict[str, Dict[str, float]] = {
+        "exact": {"recall_at_k": 1.0, "ms_per_query": 1000 * (time.perf_counter() - started) / max(1, len(queries))}
+    }
+    for nprobe in nprobes:
+        started = time.perf_counter()
+        hits = scanned = 0
+        for t, q, cand in zip(truth, queries, ivf.probe(queries, nprobe)):
+            top = cand[_top_k(exact_matrix[cand] @ q, k)]
+            hits += len(t & set(top.tolist()))
+            scanned += len(cand)
+        report[f"ivf nprobe={nprobe}"] = {
+            "recall_at_k": hits / max(1, sum(len(t) for t in truth)),
+            "rows_scanned": scanned / max(1, len(queries)),
+            "ms_per_query": 1000 * (time.perf_counter() - started) / max(1, len(queries)),
+        }
+    return report
+
+def measure_dimension_recall(index: RegIndex, client: Any, dims=(256, 512, 1024),
+                             queries: Optional[List[str]] = None, k: int = 5) -> Dict[str, Dict[str, float]]:
+    """Recall@k, matrix size and exact-search latency of shortened embeddings vs the
+    index's full-size vectors, over GOLDEN_QUERIES (or `queries`).
+
+    Shortened vectors are the renormalized prefixes of the full ones, which is what the
+    API returns for `dimensions` on text-embedding-3 models, so nothing is re-embedded
+    except the queries. Only meaningful for an index built at the model's native size.
+    """
+    provider = as_provider(client)
+    if provider is None or provider.model != index.model:
+        raise ValueError(f"queries must be embedded with the index's model ({index.model})")
+    queries = queries or GOLDEN_QUERIES
+    qvecs, _ = provider.embed(queries)
+    full = np.asarray(index.matrix)
+    report: Dict[str, Dict[str, float]] = {}
+    truth: List[set] = []
+    for d in sorted({int(d) for d in dims if 0 < int(d) < index.dim}) + [index.dim]:
+        matrix = full if d == index.dim else _normalize_rows(np.array(full[:, :d]))
+        q = _normalize_rows(np.array(qvecs[:, :d], dtype=np.float32))
+        started = time.perf_counter()
+        tops = [set(_top_k(matrix @ row, k).tolist()) for row in q]
+        elapsed = time.perf_counter() - started
+        if d == index.dim:
+            truth = tops
+        report[str(d)] = {"tops": tops, "matrix_bytes": matrix.nbytes,
+                          "ms_per_query": 1000 * elapsed / max(1, len(queries))}
+    for row in report.values():
+        tops = row.pop("tops")
+        row["recall_at_k"] = sum(len(t & p) for t, p in zip(truth, tops)) / max(1, sum(len(t) for t in truth))
+    return report
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Regulatory retrieval index tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_conv = sub.add_parser("convert", help="migrate regs_index.json to the binary index format")
+    p_conv.add_argument("json_path", nargs="?", default=LEGACY_JSON_PATH)
+    p_conv.add_argument("out", nargs="?", default=INDEX_PATH)
+    p_verify = sub.add_parser("verify", help="check an index's files against its checksum")
+    p_verify.add_argument("path", nargs="?", default=INDEX_PATH)
+    p_recall = sub.add_parser("recall", help="recall@k of quantized search against float32")
+    p_recall.add_argument("path", nargs="?", default=INDEX_PATH)
+    p_recall.add_argument("-k", type=int, default=5)
+    p_ann = sub.add_parser("ann-recall", help="recall@k of IVF search by nprobe against exact search")
+    p_ann.add_argument("path", nargs="?", default=INDEX_PATH)
+    p_ann.add_argument("-k", type=int, default=5)
+    p_ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    p_dims = sub.add_parser("dim-eval", help="recall@k / size / latency of shortened embeddings on golden queries")
+    p_dims.add_argument("path", nargs="?", default=INDEX_PATH)
+    p_dims.add_argument("-k", type=int, default=5)
+    p_dims.add_argument("--dims", type=int, nargs="+", default=[256, 512, 1024])
+    p_build = sub.add_parser("build", help="build or refresh the index files of every shard")
+    p_build.add_argument("--provider", choices=["openai", "local", "fixture"], default=None,
+                         help="embedding provider (default: EMBED_PROVIDER)")
+    args = parser.parse_args()
+    # build reports (dedup, embedding throughput) go to the "uvicorn" logger, which has no
+    # handler outside the server
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.cmd == "convert":
+        idx = convert_json_index(args.json_path, args.out)
+        print(f"converted {len(idx)} chunks (dim {idx.dim}) -> {_index_paths(args.out)['matrix']}")
+    elif args.cmd == "verify":
+        idx = load_index(args.path, verify=True)
+        print(f"ok: {len(idx)} chunks (dim {idx.dim}) {idx.version}")
+    elif args.cmd == "recall":
+        for kind, row in measure_quantization_recall(load_index(args.path), k=args.k).items():
+            print(kind, json.dumps(row))
+    elif args.cmd == "ann-recall":
+        report = measure_ann_recall(load_index(args.path), k=args.k, nprobes=args.nprobe)
+        for setting, row in report.items():
+            print(setting, json.dumps(row))
+    elif args.cmd == "dim-eval":
+        idx = load_index(args.path)
+        for d, row in measure_dimension_recall(idx, get_client(), dims=args.dims, k=args.k).items():
+            print(f"dims={d}", json.dumps(row))
+    elif args.cmd == "build":
+        provider = as_provider(get_client(), args.provider)
+        shards = discover_shards()
+        corpus = open_corpus(provider, preload=list(shards))
+        for name in shards:
+            idx = corpus.shard(name)
+            print(name, f"{len(idx)} chunks {idx.model} {idx.version}" if idx is not None else "unavailable")
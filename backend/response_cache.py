@@ -0,0 +1,130 @@
+# Content-addressed cache for generated documents and checklists.
+# Key: sha256 of (generator name, model, prompt-template version, canonicalized inputs), so
+# re-submitting the same survey answers (after navigating back and forth) is served without
+# an LLM call, while a prompt change (bump the version) or a model switch misses.
+#
+# A TieredCache: an in-process LRU in front of the CachedResponse table in the app database,
+# so entries survive restarts and are shared by workers. Both tiers expire entries after
+# RESPONSE_CACHE_TTL seconds (0 disables the cache); the table is trimmed to
+# RESPONSE_CACHE_MAX_ROWS by last use.
+
+import os, json, hashlib, threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from sqlmodel import SQLModel, Field, Session, select
+from sqlalchemy import delete
+from sqlalchemy.exc import SQLAlchemyError
+from tiered_cache import CacheStore, TieredCache
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_ROWS = int(os.getenv("RESPONSE_CACHE_MAX_ROWS", "5000"))
+
+class CachedResponse(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    generator: str = Field(index=True)
+    model: str
+    content: str
+    usage_json: str  # usage of the call that produced `content`
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime = Field(index=True)
+    used_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+def canonicalize(value: Any) -> Any:
+    """Inputs with formatting noise removed: whitespace collapsed in strings, empty answers
+    dropped, dict keys sorted (by json.dumps)."""
+    if isinstance(value, dict):
+        return {str(k): canonicalize(v) for k, v in value.items() if v not in (None, "", [], {})}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(v) for v in value]
+    if isinstance(value, str):
+        return " ".join(value.split())
+    return value
+
+def _utc(ts: float) -> datetime:
+    # naive UTC, like the datetime.utcnow defaults above
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None)
+
+class _ResponseStore(CacheStore):
+    """Tier 2: the CachedResponse table. Each call uses its own session."""
+
+    label = "db"
+    errors = (SQLAlchemyError,)
+
+    def __init__(self, engine: Any, ttl: float, max_rows: int):
+        self.engine = engine
+        self.ttl = ttl
+        self.max_rows = max_rows
+
+    def load(self, keys: List[str], now: float) -> Dict[str, tuple]:
+        found = {}
+        with Session(self.engine) as s:
+            rows = s.exec(select(CachedResponse).where(CachedResponse.key.in_(keys),
+                                                       CachedResponse.expires_at > _utc(now))).all()
+            for row in rows:
+                row.used_at = _utc(now)
+                s.add(row)
+                expires_at = row.expires_at.replace(tzinfo=timezone.utc).timestamp()
+                found[row.key] = ((row.content, json.loads(row.usage_json or "{}")), expires_at)
+            if rows:
+                s.commit()
+        return found
+
+    def save(self, items: List[tuple], now: float, generator: str = "", model: str = "") -> None:
+        with Session(self.engine) as s:
+            for key, (content, usage) in items:
+                s.merge(CachedResponse(key=key, generator=generator, model=model, content=content,
+                                       usage_json=json.dumps(usage), created_at=_utc(now),
+                                       expires_at=_utc(now + self.ttl), used_at=_utc(now)))
+            s.execute(delete(CachedResponse).where(CachedResponse.expires_at <= _utc(now)))
+            stale = select(CachedResponse.key).order_by(CachedResponse.used_at.desc()).offset(self.max_rows)
+            s.execute(delete(CachedResponse).where(CachedResponse.key.in_(stale.scalar_subquery())))
+            s.commit()
+
+    def wipe(self) -> None:
+        with Session(self.engine) as s:
+            s.execute(delete(CachedResponse)); s.commit()
+
+class ResponseCache:
+    """Generated text by content key; see the module comment for tiers and eviction."""
+
+    def __init__(self, engine: Any, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 max_rows: int = RESPONSE_CACHE_MAX_ROWS):
+        self.ttl = ttl
+        store = _ResponseStore(engine, ttl, max_rows) if engine is not None else None
+        self._cache = TieredCache(store, max_entries, ttl, "Response cache")
+        self._lock = threading.Lock()  # tokens_saved
+        self.tokens_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @staticmethod
+    def key(generator: str, model: str, version: Any, inputs: Dict[str, Any]) -> str:
+        blob = json.dumps({"generator": generator, "model": model, "version": version,
+                           "inputs": canonicalize(inputs)}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple]:
+        """(content, usage of the original call) or None."""
+        if not self.enabled:
+            return None
+        hit = self._cache.get_many([key])[0]
+        if hit is not None:
+            with self._lock:
+                self.tokens_saved += hit[1].get("total_tokens") or 0
+        return hit
+
+    def put(self, key: str, generator: str, model: str, content: str, usage: Optional[Dict[str, Any]]) -> None:
+        if not self.enabled or not content:
+            return
+        self._cache.put_many([(key, (content, dict(usage or {})))], generator=generator, model=model)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tokens_saved = self.tokens_saved
+        return {"enabled": self.enabled, **self._cache.stats(), "tokens_saved": tokens_saved}
@@ -0,0 +1,21 @@
+# Follow-up questions the compliance chat suggests, by the user's classification.
+# main.compliance_chat shows them; reg_retrieval also uses them as golden queries for
+# offline retrieval evaluation, so both stay in step.
+
+SUGGESTED_QUESTIONS = {
+    "developer": [
+        "What documentation must I provide to deployers?",
+        "What are my notification obligations to the Attorney General?",
+        "What is 'reasonable care' for developers?",
+    ],
+    "deployer": [
+        "How often must I conduct impact assessments?",
+        "What is required in a risk management program?",
+        "What are consumer notification requirements?",
+    ],
+    "general": [
+        "What is a 'consequential decision'?",
+        "What is 'algorithmic discrimination'?",
+        "When does SB 24-205 take effect?",
+    ],
+}
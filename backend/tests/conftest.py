@@ -0,0 +1,17 @@
+import os, sys
+
+# settings are read at import: no query-cache file in backend/, no network for embeddings
+os.environ.setdefault("QUERY_CACHE_PATH", "")
+os.environ.setdefault("EMBED_PROVIDER", "local")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import reg_retrieval
+from embeddings import LocalHashEmbeddings
+
+@pytest.fixture(scope="session")
+def regs_index(tmp_path_factory):
+    """The backend/regs corpus indexed with the local hashing embedder, in a temp dir."""
+    path = str(tmp_path_factory.mktemp("index") / "regs_index.npy")
+    shard = reg_retrieval.Shard(reg_retrieval.DEFAULT_SHARD, reg_retrieval.REGS_DIR, path)
+    return reg_retrieval.build_or_load_index(LocalHashEmbeddings(), shard)
@@ -0,0 +1,83 @@
+import asyncio, types
+import httpx
+import numpy as np
+import openai
+import pytest
+import llm_gateway
+import reg_retrieval
+from embeddings import EmbeddingProvider
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+class FakeCompletions:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def create(self, model, messages, **params):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        message = types.SimpleNamespace(content="ok")
+        return types.SimpleNamespace(model=model, usage=None, choices=[types.SimpleNamespace(message=message)])
+
+class FakeClient:
+    def __init__(self, *errors):
+        self.chat = types.SimpleNamespace(completions=FakeCompletions(errors))
+
+    def with_options(self, **options):
+        return self
+
+class AsyncAdapter:
+    def __init__(self, client):
+        async def create(**kw):
+            return client.chat.completions.create(**kw)
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=create))
+
+    def with_options(self, **options):
+        return self
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "_backoff", lambda attempt, error: 0.0)
+
+def test_complete_retries_transient_errors():
+    client = FakeClient(openai.APIConnectionError(request=REQUEST), openai.APIConnectionError(request=REQUEST))
+    result = llm_gateway.complete([{"role": "user", "content": "hi"}], "m", client=client)
+    assert result.content == "ok" and result.attempts == 3
+
+def test_complete_does_not_retry_timeouts():
+    client = FakeClient(openai.APITimeoutError(request=REQUEST))
+    with pytest.raises(openai.APITimeoutError):
+        llm_gateway.complete([{"role": "user", "content": "hi"}], "m", client=client)
+    assert client.chat.completions.calls == 1
+
+def test_complete_gives_up_after_max_retries():
+    errors = [openai.APIConnectionError(request=REQUEST)] * (llm_gateway.LLM_MAX_RETRIES + 1)
+    client = FakeClient(*errors)
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(llm_gateway.complete_async([{"role": "user", "content": "hi"}], "m", client=AsyncAdapter(client)))
+    assert client.chat.completions.calls == llm_gateway.LLM_MAX_RETRIES + 1
+
+class FlakyProvider(EmbeddingProvider):
+    model = "flaky"
+    retryable = llm_gateway.RETRYABLE
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def embed(self, texts):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise openai.APITimeoutError(request=REQUEST)  # idempotent: retried for embeddings
+        return np.ones((len(texts), 2), dtype=np.float32), None
+
+def test_embedding_batches_share_the_gateway_policy():
+    provider = FlakyProvider(failures=2)
+    vecs, _ = reg_retrieval._embed_batch_with_retry(provider, ["a", "b"])
+    assert vecs.shape == (2, 2) and provider.calls == 3
+    provider = FlakyProvider(failures=llm_gateway.EMBED_MAX_ATTEMPTS)
+    with pytest.raises(openai.APITimeoutError):
+        asyncio.run(reg_retrieval._embed_batch_with_retry_async(provider, ["a"]))
+    assert provider.calls == llm_gateway.EMBED_MAX_ATTEMPTS
@@ -0,0 +1,142 @@
+import asyncio, json, os
+import numpy as np
+import pytest
+import embeddings
+import reg_retrieval
+from embeddings import FixtureEmbeddings, LocalHashEmbeddings, append_jsonl
+from reg_retrieval import pack_context, retrieve, retrieve_async, _estimate_tokens, _read_checkpoint
+
+def test_packed_context_is_smaller_than_top5_verbatim(regs_index):
+    query = "What is 'reasonable care' for developers?"
+    # what the prompts carried before packing: the top 5 chunks, each rendered in full
+    top5 = retrieve(None, regs_index, query, k=5, mode="lexical")
+    verbatim = "\n".join(f"[{c.key}] {c.title} — {c.source}\n{c.text.strip()}\n" for c in top5)
+    packed = pack_context(regs_index, retrieve(None, regs_index, query, k=8, mode="lexical"))
+    assert packed.chunks
+    assert packed.tokens <= reg_retrieval.CONTEXT_TOKEN_BUDGET
+    assert packed.tokens <= _estimate_tokens(verbatim)
+
+def _rows(*shas, torn_after=None):
+    lines = []
+    for sha in shas:
+        lines.append(json.dumps({"sha": sha, "model": "m", "embedding": [1.0, 0.0]}) + "\n")
+        if sha == torn_after:
+            lines.append('{"sha": "torn", "model": "m", "embe')  # crash mid-write, no newline
+    return "".join(lines)
+
+def test_checkpoint_skips_torn_line_and_resumes_after_it(tmp_path):
+    path = str(tmp_path / "ckpt.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(_rows("a", torn_after="a"))
+    with append_jsonl(path) as f:  # what a resumed build does next
+        f.write(_rows("c", "d"))
+    assert sorted(_read_checkpoint(path, "m")) == ["a", "c", "d"]
+
+def test_fixture_embeddings_skip_torn_line(tmp_path):
+    path = str(tmp_path / "fixture.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(_rows("a", torn_after="a") + "\n" + _rows("c"))
+    assert sorted(FixtureEmbeddings(path).vectors) == ["a", "c"]
+
+def test_empty_filter_values(regs_index):
+    assert len(regs_index.select({"kind": []})) == 0
+    assert retrieve(None, regs_index, "impact assessment", mode="lexical", filters={"kind": []}) == []
+    # role/outcome: no value still matches the general (untagged) rows
+    general = regs_index.select({"role": []})
+    assert len(general) and set(general) <= set(regs_index.select({"role": "deployer"}))
+
+def test_dense_without_provider_is_a_clear_error(regs_index, monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBED_PROVIDER", "openai")  # no client -> no provider
+    with pytest.raises(ValueError, match="requires an embedding provider"):
+        retrieve(None, regs_index, "impact assessment", mode="dense")
+    with pytest.raises(ValueError, match="requires an embedding provider"):
+        asyncio.run(retrieve_async(None, regs_index, "impact assessment", mode="dense"))
+    assert retrieve(None, regs_index, "impact assessment", mode="hybrid")  # BM25 fallback
+
+@pytest.fixture(scope="module")
+def two_shards(regs_index, tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("shard")
+    (tmp / "ag.md").write_text(
+        "# Attorney General rules\n\nA deployer must complete an impact assessment annually and "
+        "notify the attorney general of algorithmic discrimination within ninety days.\n", encoding="utf-8")
+    ag = reg_retrieval.Shard("ag", str(tmp), str(tmp / "regs_index.ag.npy"), "AG-")
+    co = reg_retrieval.Shard(reg_retrieval.DEFAULT_SHARD, reg_retrieval.REGS_DIR, "")
+    ag_index = reg_retrieval.build_or_load_index(LocalHashEmbeddings(), ag)
+    return reg_retrieval.ShardedIndex({"co": co, "ag": ag}, None, {"co": regs_index, "ag": ag_index})
+
+def test_dense_shard_merge_is_by_score(two_shards):
+    hits = retrieve(LocalHashEmbeddings(), two_shards, "deployer impact assessment", k=6, mode="dense").hits
+    scores = [h.score for h in hits if not h.pinned]
+    assert {h.shard for h in hits} == {"co", "ag"}
+    assert scores == sorted(scores, reverse=True)
+
+def test_lexical_shard_merge_is_by_rank(two_shards):
+    hits = retrieve(None, two_shards, "deployer impact assessment", k=4, mode="lexical").hits
+    assert [h.shard for h in hits[:2]] == ["co", "ag"]  # round-robin, shard order
+
+def test_unloaded_shards_are_skipped_not_built(tmp_path):
+    shard = reg_retrieval.Shard("co", reg_retrieval.REGS_DIR, str(tmp_path / "regs_index.npy"))
+    corpus = reg_retrieval.ShardedIndex({"co": shard}, None)
+    assert retrieve(None, corpus, "impact assessment", mode="lexical") == []
+    assert not list(tmp_path.iterdir())
+
+def test_built_shard_is_loaded_on_first_search(two_shards):
+    corpus = reg_retrieval.ShardedIndex({"ag": two_shards.shards["ag"]}, None)
+    assert corpus.loaded == {}
+    hits = retrieve(None, corpus, "attorney general ninety days", mode="lexical").hits
+    assert hits and {h.shard for h in hits} == {"ag"}
+    assert list(corpus.loaded) == ["ag"]
+    assert corpus.stats()["shards"]["ag"]["chunks"] == len(corpus.loaded["ag"])
+
+def test_embedding_throughput_is_logged(caplog):
+    texts = [f"deployer notice {i}" for i in range(5)]
+    with caplog.at_level("INFO", logger="uvicorn"):
+        reg_retrieval.embed_texts(LocalHashEmbeddings(), texts)
+        asyncio.run(reg_retrieval.embed_texts_async(LocalHashEmbeddings(), texts))
+    lines = [r.getMessage() for r in caplog.records if "chunks/s" in r.getMessage()]
+    assert len(lines) == 2 and all("Embedded 5 chunks" in l and "tokens/s" in l for l in lines)
+
+def test_load_checks_shapes_but_hashes_only_on_request(two_shards):
+    path = two_shards.shards["ag"].index_path
+    paths = reg_retrieval._index_paths(path)
+    with open(paths["matrix"], "r+b") as f:  # flip the last vector byte; header intact
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 0xFF]))
+    try:
+        assert len(reg_retrieval.load_index(path))
+        with pytest.raises(reg_retrieval.IndexFormatError, match="checksum"):
+            reg_retrieval.load_index(path, verify=True)
+    finally:
+        with open(paths["matrix"], "r+b") as f:
+            f.seek(-1, 2)
+            f.write(last)
+    size = os.path.getsize(paths["text"])
+    with open(paths["text"], "ab") as f:
+        f.write(b"torn")
+    try:
+        with pytest.raises(reg_retrieval.IndexFormatError, match="index text"):
+            reg_retrieval.load_index(path)
+    finally:
+        os.truncate(paths["text"], size)
+
+@pytest.mark.parametrize("kind", ["float16", "int8"])
+def test_quantized_load_maps_files_without_reading_them(two_shards, monkeypatch, kind):
+    def full_read(*args):
+        raise AssertionError("the load read the whole matrix")
+    monkeypatch.setattr(reg_retrieval, "_checksum", full_read)  # hashing
+    monkeypatch.setattr(reg_retrieval, "quantize", full_read)   # quantizing in memory
+    index = reg_retrieval.load_index(two_shards.shards["ag"].index_path, quantization=kind)
+    assert index.quantization == kind
+    assert isinstance(index.matrix, np.memmap) and isinstance(index.compact, np.memmap)
+
+def test_shards_are_served_with_bm25_built(two_shards, monkeypatch):
+    ag = two_shards.shards["ag"]
+    monkeypatch.setattr(reg_retrieval, "discover_shards", lambda: {"ag": ag})
+    corpus = reg_retrieval.open_corpus(LocalHashEmbeddings(), preload=["ag"])
+    assert corpus.loaded["ag"]._lexical is not None
+    reloaded = corpus.rebuilt(LocalHashEmbeddings(), ["ag"])
+    assert reloaded.loaded["ag"] is not corpus.loaded["ag"] and reloaded.loaded["ag"]._lexical is not None
+    lazy = reg_retrieval.ShardedIndex({"ag": ag}, None)
+    assert lazy.shard("ag")._lexical is not None
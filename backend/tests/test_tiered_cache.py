@@ -0,0 +1,70 @@
+import sqlite3, threading, time
+import numpy as np
+from sqlmodel import SQLModel, create_engine
+from reg_retrieval import QueryEmbeddingCache
+from response_cache import ResponseCache
+from tiered_cache import CacheStore, TieredCache
+
+class SlowStore(CacheStore):
+    label = "disk"
+    errors = (sqlite3.Error,)
+
+    def __init__(self):
+        self.rows = {}
+        self.gate = threading.Event()
+
+    def load(self, keys, now):
+        self.gate.wait(5)
+        return {k: (self.rows[k], None) for k in keys if k in self.rows}
+
+    def save(self, items, now, **meta):
+        self.rows.update(items)
+
+    def wipe(self):
+        self.rows.clear()
+
+def test_store_io_does_not_block_memory_hits():
+    store = SlowStore()
+    cache = TieredCache(store, max_entries=8, ttl=60, name="test")
+    cache.put_many([("hot", 1)])
+    store.rows["cold"] = 2
+    loading = threading.Thread(target=lambda: cache.get_many(["cold"]))
+    loading.start()
+    time.sleep(0.05)  # the cold lookup is now waiting inside store.load
+    started = time.perf_counter()
+    assert cache.get_many(["hot"]) == [1]
+    assert time.perf_counter() - started < 1
+    store.gate.set(); loading.join()
+    assert cache.stats() == {"memory_hits": 1, "disk_hits": 1, "misses": 0, "hit_rate": 1.0,
+                             "memory_entries": 2, "disk_enabled": True}
+
+def test_store_error_disables_the_tier():
+    class Broken(SlowStore):
+        def load(self, keys, now):
+            raise sqlite3.OperationalError("disk I/O error")
+    cache = TieredCache(Broken(), max_entries=8, ttl=60, name="test")
+    assert cache.get_many(["a"]) == [None]
+    cache.put_many([("a", 1)])
+    assert cache.get_many(["a"]) == [1]
+    assert cache.stats()["disk_enabled"] is False
+
+def test_query_cache_reads_back_from_disk(tmp_path):
+    path = str(tmp_path / "q.sqlite3")
+    vec = np.arange(4, dtype=np.float32)
+    QueryEmbeddingCache(path, 8, 60).put_many(["What is  a Provider?"], vec[None], "m")
+    fresh = QueryEmbeddingCache(path, 8, 60)
+    got = fresh.get_many(["what is a provider?", "other"], "m")
+    assert np.array_equal(got[0], vec) and got[1] is None
+    assert fresh.stats()["disk_hits"] == 1
+
+def test_response_cache_reads_back_from_db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    SQLModel.metadata.create_all(engine)
+    key = ResponseCache.key("checklist", "m", 1, {"q1": "  yes "})
+    ResponseCache(engine).put(key, "checklist", "m", "doc", {"total_tokens": 7})
+    fresh = ResponseCache(engine)
+    assert fresh.get(key) == ("doc", {"total_tokens": 7})
+    assert fresh.get(key) == ("doc", {"total_tokens": 7})
+    stats = fresh.stats()
+    assert (stats["db_hits"], stats["memory_hits"], stats["tokens_saved"]) == (1, 1, 14)
+    assert ResponseCache(engine, ttl=0).get(key) is None
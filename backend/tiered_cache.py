@@ -0,0 +1,129 @@
+# Two-tier cache shared by reg_retrieval (query embeddings in a SQLite file) and
+# response_cache (generated documents in the app database).
+# - Tier 1: in-process LRU of `max_entries`; an entry expires `ttl` seconds after it was
+#   stored or loaded, or earlier if the store says so
+# - Tier 2: a CacheStore; memory misses are looked up there, writes go to both tiers
+# - The lock guards only the LRU and the counters. Store I/O runs outside it, so a slow
+#   disk or database never holds up lookups that hit memory; a store that needs its I/O
+#   serialized (one SQLite connection) takes its own lock
+# - A store error disables tier 2 and is logged once; the cache never fails a request
+
+import logging, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+log = logging.getLogger("uvicorn")
+
+class CacheStore:
+    """The persistent tier of a TieredCache. Times are unix seconds."""
+
+    label = "store"   # names the tier in stats ("<label>_hits", "<label>_enabled")
+    errors: tuple = ()  # exception types that disable the tier instead of propagating
+
+    def load(self, keys: List[str], now: float) -> Dict[str, Tuple[Any, Optional[float]]]:
+        """{key: (value, expires_at or None)} for the live entries among `keys`."""
+        raise NotImplementedError
+
+    def save(self, items: List[Tuple[str, Any]], now: float, **meta) -> None:
+        """Store (key, value) pairs; `meta` is whatever the owning cache passes along."""
+        raise NotImplementedError
+
+    def wipe(self) -> None:
+        raise NotImplementedError
+
+class TieredCache:
+    """See the module comment."""
+
+    def __init__(self, store: Optional[CacheStore], max_entries: int, ttl: float, name: str):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name  # for log messages
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._store_failed = store is None
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _store_error(self, e: Exception) -> None:
+        with self._lock:
+            if self._store_failed:
+                return
+            self._store_failed = True
+        log.warning(f"{self.name}: {self.store.label} tier disabled ({e})")
+
+    def _remember(self, key: str, value: Any, expires_at: float) -> None:
+        self._mem[key] = (expires_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """Cached value per key, or None for a miss."""
+        now = time.time()
+        out: List[Optional[Any]] = [None] * len(keys)
+        with self._lock:
+            for i, k in enumerate(keys):
+                hit = self._mem.get(k)
+                if hit is not None and hit[0] > now:
+                    self._mem.move_to_end(k)
+                    out[i] = hit[1]
+                    self.memory_hits += 1
+                elif hit is not None:
+                    del self._mem[k]
+            todo = [i for i, v in enumerate(out) if v is None]
+            use_store = bool(todo) and not self._store_failed
+        found: Dict[str, Tuple[Any, Optional[float]]] = {}
+        if use_store:
+            try:
+                found = self.store.load(list(dict.fromkeys(keys[i] for i in todo)), now)
+            except self.store.errors as e:
+                self._store_error(e)
+        with self._lock:
+            for i in todo:
+                hit = found.get(keys[i])
+                if hit is not None:
+                    value, expires_at = hit
+                    out[i] = value
+                    self.store_hits += 1
+                    self._remember(keys[i], value, min(now + self.ttl, expires_at or float("inf")))
+            self.misses += sum(1 for v in out if v is None)
+        return out
+
+    def put_many(self, items: List[Tuple[str, Any]], **meta) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            for k, v in items:
+                self._remember(k, v, now + self.ttl)
+            use_store = not self._store_failed
+        if use_store:
+            try:
+                self.store.save(items, now, **meta)
+            except self.store.errors as e:
+                self._store_error(e)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            use_store = not self._store_failed
+        if use_store:
+            try:
+                self.store.wipe()
+            except self.store.errors as e:
+                self._store_error(e)
+
+    def stats(self) -> Dict[str, Any]:
+        label = self.store.label if self.store is not None else "store"
+        with self._lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                f"{label}_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.store_hits) / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._mem),
+                f"{label}_enabled": not self._store_failed,
+            }
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Load test for /api/chat/documentation-helper.
+# Fires --requests helper calls, --concurrency at a time, against a running server
+# (DEMO_MODE=0 with a key, so they really reach the model). Meanwhile it probes a cheap
+# endpoint (/api/health) every --probe-interval seconds.
+#
+# If helper calls block the event loop, they run one after another. Wall time then
+# approaches requests x mean latency, and health probes stall for a whole LLM call.
+# When they don't block, wall time stays near (requests / concurrency) x mean latency and
+# probe latency stays at its idle level.
+#
+#   python ops/load_test.py --url http://127.0.0.1:8000 --concurrency 20 --requests 60
+#
+# --fake-latency S ignores --url. The script serves the helper router in-process on a free
+# local port, with a stand-in for the OpenAI client that waits S seconds per call. That
+# needs no key, network or database, so the result is reproducible anywhere:
+#
+#   python ops/load_test.py --fake-latency 1 --concurrency 10 --requests 20
+
+import argparse, asyncio, os, socket, statistics, sys, threading, time, types
+import httpx
+
+def _summary(samples):
+    if not samples:
+        return "n=0"
+    s = sorted(samples)
+    p95 = s[min(len(s) - 1, int(0.95 * len(s)))]
+    return (f"n={len(s)} p50={1000 * statistics.median(s):.0f}ms "
+            f"p95={1000 * p95:.0f}ms max={1000 * s[-1]:.0f}ms")
+
+async def _probe(client, path, interval, stop, samples):
+    while not stop.is_set():
+        t = time.perf_counter()
+        try:
+            await client.get(path)
+            samples.append(time.perf_counter() - t)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+async def _helper(client, sem, body, latencies, errors):
+    async with sem:
+        t = time.perf_counter()
+        try:
+            r = await client.post("/api/chat/documentation-helper", json=body)
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - t)
+        except httpx.HTTPError as e:
+            errors.append(f"{type(e).__name__}: {e}")
+
+def _fake_server(latency):
+    """Start intake's router behind a fake model that answers after `latency` seconds.
+    Returns (uvicorn server, its thread, base url)."""
+    os.environ["DEMO_MODE"] = "0"  # intake reads it at import
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "backend"))
+    import uvicorn
+    from fastapi import FastAPI
+    import intake
+
+    class Completions:
+        async def create(self, model, messages, **params):
+            await asyncio.sleep(latency)
+            message = types.SimpleNamespace(content='{"message": "ok"}')
+            return types.SimpleNamespace(model=model, usage=None, choices=[types.SimpleNamespace(message=message)])
+
+    class FakeClient:
+        chat = types.SimpleNamespace(completions=Completions())
+
+        def with_options(self, **options):
+            return self
+
+    intake.get_async_client = FakeClient
+    app = FastAPI()
+    app.include_router(intake.router)
+    app.get("/api/health")(lambda: {"status": "ok"})
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+async def run(args):
+    body = {"message": args.message,
+            "context": {"outcome": "outcome8",
+                        "questions": [{"id": "q1", "text": "Describe the purpose of the AI system."}]}}
+    limits = httpx.Limits(max_connections=args.concurrency + 2)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        idle = []
+        stop = asyncio.Event()
+        probing = asyncio.create_task(_probe(client, args.probe_path, args.probe_interval, stop, idle))
+        await asyncio.sleep(1.0)
+        stop.set(); await probing
+
+        latencies, errors, loaded = [], [], []
+        stop = asyncio.Event()
+        probing = asyncio.create_task(_probe(client, args.probe_path, args.probe_interval, stop, loaded))
+        sem = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(_helper(client, sem, body, latencies, errors) for _ in range(args.requests)))
+        wall = time.perf_counter() - started
+        stop.set(); await probing
+
+    print(f"helper:           {_summary(latencies)} errors={len(errors)}")
+    print(f"probe (idle):     {_summary(idle)}")
+    print(f"probe (loaded):   {_summary(loaded)}")
+    if latencies:
+        mean = statistics.mean(latencies)
+        ideal = mean * -(-args.requests // args.concurrency)
+        serial = mean * args.requests
+        print(f"wall {wall:.1f}s, {args.requests / wall:.1f} req/s "
+              f"(concurrent ~{ideal:.1f}s, serialized ~{serial:.1f}s)")
+    for e in errors[:5]:
+        print("  " + e)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent load test for the documentation helper")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--message", default="Help me with Question 1: we screen rental applications with a scoring model.")
+    parser.add_argument("--probe-path", default="/api/health")
+    parser.add_argument("--probe-interval", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--fake-latency", type=float, default=None,
+                        help="serve the helper in-process with a fake model taking this many seconds per call")
+    args = parser.parse_args()
+    server = None
+    if args.fake_latency is not None:
+        server, thread, args.url = _fake_server(args.fake_latency)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join()